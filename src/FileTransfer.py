@@ -5,27 +5,34 @@ import logging
 import struct
 import os
 from pathlib import Path
+from sys import getsizeof
 
 from lib.RDTSocketSR import RDTSocketSR, RDT_HEADER_LENGTH
+from lib.exceptions import TransferError
+
+
+PACKET_HEADER = struct.Struct("i")
+# Size of the file, before the name in a SEND_SIZED request
+FILE_SIZE = struct.Struct("q")
+# Packets of a file read with a single readv
+READ_BATCH = 64
 
 
 class Packet:
-    type = 0
-    data = ''
+    __slots__ = ('type', 'data')
 
     def __init__(self, type, data="".encode()):
         self.type = type
         self.data = data
 
     def serialize(self):
-        return struct.pack("i {}s".format(len(self.data)),
-                           self.type, self.data)
+        return PACKET_HEADER.pack(self.type) + self.data
 
+    # The payload is a memoryview over the received bytes, it isn't copied
     @classmethod
     def fromSerializedPacket(cls, serializedPacket):
-        packet = struct.unpack("i ", serializedPacket[:4])
-        packet = (*packet, serializedPacket[4:])
-        return cls(*packet)
+        type, = PACKET_HEADER.unpack_from(serializedPacket)
+        return cls(type, memoryview(serializedPacket)[PACKET_HEADER.size:])
 
 
 SERVER_PORT = 12000
@@ -37,41 +44,238 @@ class FileTransfer:
     ERROR = 2
     OK = 3
     BUSY_FILE = 4
+    SEND_SIZED = 5  # Upload that declares the size of the file
+    NO_SPACE = 6    # The storage can't hold the declared size
+    OVERLOADED = 7  # The server doesn't take more clients now
     MSS = 1500
     CONFIG_LEN = 209
     HEADER_PACKET = 4
     PAYLOAD = MSS - RDT_HEADER_LENGTH - HEADER_PACKET
 
     #   This function receive packets and write payload in the file
-    #   sent as argument.
+    #   sent as argument. Returns the amount of bytes written.
     @classmethod
     def recv_file(self, connSocket, file):
-        bytes = b'a'
+        written = 0
+        bytes = connSocket.recv()
         while bytes != b'':
+            written += self.write_packet(file, bytes)
             bytes = connSocket.recv()
+        return written
 
-            if (bytes != b''):
-                packet = Packet.fromSerializedPacket(bytes)
-                if (packet.type == self.ERROR):
-                    # TODO cambiar este nombre poco descriptivo...
-                    raise RuntimeError  # TODO TODO TODO TODO TODO
-                file.write(packet.data)
-        return
+    #   Writes the payload of a received packet in the file, returns the
+    #   amount of bytes written. An ERROR packet aborts the transfer
+    @classmethod
+    def write_packet(self, file, bytes):
+        packet = Packet.fromSerializedPacket(bytes)
+        if (packet.type == self.ERROR):
+            raise TransferError("The peer aborted the transfer")
+        return file.write(packet.data)
 
+    #   Same as recv_file, but every packet is written with pwrite at its
+    #   offset of the file as soon as it arrives, even out of order (see
+    #   RDTSocketSR.recvDirect). Every packet but the last one must be
+    #   full, as read_packets sends them.
     @classmethod
-    def send_file(self, connSocket, file):
-        file_bytes = file.read(self.PAYLOAD)
-        while file_bytes != b'':
-            packet = Packet(self.OK, file_bytes)
-            bytes_sent = connSocket.send(packet.serialize())
+    def recv_file_direct(self, connSocket, file):
+        slot = PACKET_HEADER.size + self.PAYLOAD
+        fd = file.fileno()
+        fileEnd = 0
+
+        def place(offset, data):
+            nonlocal fileEnd
+            index, misaligned = divmod(offset, slot)
+            type, = PACKET_HEADER.unpack_from(data)
+            if (misaligned or type != self.OK):
+                raise TransferError(
+                    "Invalid packet placed at {}".format(offset))
+            data = data[PACKET_HEADER.size:]
+            offset = index * self.PAYLOAD
+            fileEnd = max(fileEnd, offset + len(data))
+            while len(data) > 0:
+                written = os.pwrite(fd, data, offset)
+                data = data[written:]
+                offset += written
+
+        connSocket.recvDirect(place)
+        return fileEnd
+
+    #   'cache' is an optional ChunkCache, shared by the downloads of the
+    #   same files (see read_packets). With it the checksum of the payloads
+    #   is cached too, and only the RDT header is checksummed by packet
+    @classmethod
+    def send_file(self, connSocket, file, cache=None):
+        for packet in self.file_packets(connSocket, file, cache):
+            bytes_sent = connSocket.send(*packet)
 
             if bytes_sent == b'':
                 return
-            file_bytes = file.read(self.PAYLOAD)
+
+    #   Yields the arguments of connSocket.send for every packet of the
+    #   file: the packet, and its payload checksum if there is a cache
+    @classmethod
+    def file_packets(self, connSocket, file, cache=None):
+        if cache is None:
+            return ((packet,) for packet in self.read_packets(file))
+        return self.read_checksummed_packets(
+            file, cache, connSocket.checksumEngine)
+
+    #   Reads the file already framed as OK packets: READ_BATCH slots of a
+    #   buffer get their header and a preadv fills the payloads, so the
+    #   file is copied once (by the kernel) and it isn't joined to the
+    #   headers. Yields a memoryview of each packet, it stays valid while
+    #   the RDT socket keeps it (a new buffer is used by batch).
+    #   With a ChunkCache the framed batches are looked up by (path, mtime,
+    #   offset) before reading them, and cached after.
+    @classmethod
+    def read_packets(self, file, cache=None):
+        slot = PACKET_HEADER.size + self.PAYLOAD
+        for view, nbytes, checksums in self.read_chunks(file, cache):
+            for i in range(0, len(view), slot):
+                yield view[i:i + slot]
+
+    #   Same as read_packets, but yields every packet with the part of its
+    #   RDT checksum that depends on the payload (see
+    #   ChecksumEngine.calculatePayload). They are calculated once by chunk,
+    #   before caching it, with the engine of the server
+    @classmethod
+    def read_checksummed_packets(self, file, cache, checksumEngine):
+        slot = PACKET_HEADER.size + self.PAYLOAD
+        for view, nbytes, checksums in self.read_chunks(
+                file, cache, checksumEngine):
+            yield from zip(
+                (view[i:i + slot] for i in range(0, len(view), slot)),
+                checksums)
+
+    #   Yields the batches of read_packets as (framed packets, file bytes,
+    #   payload checksums), from the cache if possible. The checksums are
+    #   a tuple for 'checksumEngine', empty without it.
+    #   Cached chunks aren't modified: a chunk cached with the checksums of
+    #   another engine gets them calculated again, only for this reader
+    @classmethod
+    def read_chunks(self, file, cache=None, checksumEngine=None):
+        fd = file.fileno()
+        offset = 0
+        engineName = None if checksumEngine is None else checksumEngine.name
+        if cache is not None:
+            mtime = os.fstat(fd).st_mtime_ns
+        while True:
+            chunk = None
+            if cache is not None:
+                chunk = cache.get((file.name, mtime, offset))
+            if chunk is None:
+                view, nbytes = self.read_batch(fd, offset)
+                if nbytes == 0:
+                    return
+                chunk = (view, nbytes, engineName,
+                         self.payload_checksums(view, checksumEngine))
+                if cache is not None:
+                    cache.put((file.name, mtime, offset), chunk,
+                              len(view) + self.checksums_size(chunk[3]))
+            view, nbytes, chunkEngineName, checksums = chunk
+            if chunkEngineName != engineName:
+                checksums = self.payload_checksums(view, checksumEngine)
+            yield (view, nbytes, checksums)
+            if nbytes < READ_BATCH * self.PAYLOAD:  # End of the file
+                return
+            offset += nbytes
+
+    #   Returns the payload part of the checksum of every packet of the
+    #   framed batch, or () without engine
+    @classmethod
+    def payload_checksums(self, view, checksumEngine):
+        if checksumEngine is None:
+            return ()
+        slot = PACKET_HEADER.size + self.PAYLOAD
+        return tuple(checksumEngine.calculatePayload(view[i:i + slot])
+                     for i in range(0, len(view), slot))
+
+    #   Bytes taken by the payload checksums of a chunk, they are counted
+    #   with it in the budget of the ChunkCache
+    @classmethod
+    def checksums_size(self, checksums):
+        size = getsizeof(checksums)
+        for checksum in checksums:
+            size += getsizeof(checksum)
+            if isinstance(checksum, tuple):
+                size += sum(getsizeof(part) for part in checksum)
+        return size
+
+    #   Reads up to READ_BATCH packets of the file from 'offset', returns
+    #   a memoryview of the framed packets and the amount of file bytes
+    @classmethod
+    def read_batch(self, fd, offset):
+        slot = PACKET_HEADER.size + self.PAYLOAD
+        buffer = bytearray(READ_BATCH * slot)
+        view = memoryview(buffer)
+        payloads = []
+        for i in range(READ_BATCH):
+            PACKET_HEADER.pack_into(buffer, i * slot, self.OK)
+            payloads.append(view[i * slot + PACKET_HEADER.size:(i + 1) * slot])
+        nbytes = os.preadv(fd, payloads, offset)
+        # A short read is completed, only the last packet of the file
+        # can be shorter (see recv_file_direct)
+        while 0 < nbytes < READ_BATCH * self.PAYLOAD:
+            packets, rest = divmod(nbytes, self.PAYLOAD)
+            read = os.preadv(
+                fd, [payloads[packets][rest:]] + payloads[packets + 1:],
+                offset + nbytes)
+            if read == 0:
+                break
+            nbytes += read
+        packets, rest = divmod(nbytes, self.PAYLOAD)
+        length = packets * slot + (PACKET_HEADER.size + rest if rest else 0)
+        return (view[:length], nbytes)
 
     #   Send a request for the socket
     @classmethod
     def request(cls, socket, type, data):
-        packet = Packet(type, data.encode()).serialize()
-        socket.send(packet)
+        socket.send(cls.request_packet(type, data))
+        return
+
+    #   Returns the serialized packet of a request or response
+    @classmethod
+    def request_packet(cls, type, data):
+        return Packet(type, data.encode()).serialize()
+
+    #   Send an upload request that declares the size of the file, so the
+    #   server can reserve it (or reject it) before the transfer
+    @classmethod
+    def request_upload(cls, socket, name, size):
+        packet = Packet(cls.SEND_SIZED, FILE_SIZE.pack(size) + name.encode())
+        socket.send(packet.serialize())
+        return
+
+    #   Returns the type, file name and declared size (None if unknown) of
+    #   a request. A SEND_SIZED request is returned as SEND
+    @classmethod
+    def parse_request(cls, packet):
+        if packet.type == cls.SEND_SIZED:
+            size, = FILE_SIZE.unpack_from(packet.data)
+            name = packet.data[FILE_SIZE.size:].tobytes().decode()
+            return (cls.SEND, name, size)
+        return (packet.type, packet.data.tobytes().decode(), None)
+
+    #   Same as recv_file, send_file and request for the coroutines of
+    #   AsyncRDTSocketSR
+    @classmethod
+    async def recv_file_async(self, connSocket, file):
+        written = 0
+        bytes = await connSocket.recv()
+        while bytes != b'':
+            written += self.write_packet(file, bytes)
+            bytes = await connSocket.recv()
+        return written
+
+    @classmethod
+    async def send_file_async(self, connSocket, file, cache=None):
+        for packet in self.file_packets(connSocket, file, cache):
+            bytes_sent = await connSocket.send(*packet)
+
+            if bytes_sent == b'':
+                return
+
+    @classmethod
+    async def request_async(cls, socket, type, data):
+        await socket.send(cls.request_packet(type, data))
         return
@@ -9,8 +9,10 @@ from socket import AF_INET, SOCK_STREAM
 
 from FileTransfer import FileTransfer, Packet
 from lib.exceptions import ServerUnreachable, LostConnection
-from lib.RDTSocketSR import RDTSocketSR
+from lib.RDTSocketSR import RDTSocketSR, WINDOWSIZE
 from lib.RDTSocketSW import RDTSocketSW
+from lib.ChecksumEngine import CHECKSUM_ENGINES, DEFAULT_CHECKSUM
+from lib.CongestionControl import CONGESTION_CONTROLS, DEFAULT_CONGESTION_CONTROL
 import time
 
 RDT_SR = 1
@@ -90,7 +92,44 @@ def getArgs():
         metavar='',
         help='use Stop and Wait as RDT protocol')
 
-    return parser.parse_args()
+    optionals.add_argument(
+        '-c',
+        '--checksum',
+        type=str,
+        choices=list(CHECKSUM_ENGINES),
+        default=DEFAULT_CHECKSUM,
+        metavar='',
+        help='checksum engine ({}), must match the server one'.format(
+            ', '.join(CHECKSUM_ENGINES)))
+    optionals.add_argument(
+        '-w',
+        '--window',
+        type=int,
+        default=WINDOWSIZE,
+        metavar='',
+        help='max bytes in flight and receive buffer size of Selective Repeat (default {})'.format(
+            WINDOWSIZE))
+    optionals.add_argument(
+        '-cc',
+        '--congestion-control',
+        type=str,
+        choices=list(CONGESTION_CONTROLS),
+        default=DEFAULT_CONGESTION_CONTROL,
+        dest='congestionControl',
+        metavar='',
+        help='congestion control of Selective Repeat ({})'.format(
+            ', '.join(CONGESTION_CONTROLS)))
+    optionals.add_argument(
+        '-D',
+        '--direct-placement',
+        action='store_true',
+        dest='directPlacement',
+        help='write every packet at its offset of the file as soon as it arrives, without buffering the out of order ones (Selective Repeat only)')
+
+    args = parser.parse_args()
+    if args.directPlacement and args.rdtType == RDT_SW:
+        parser.error('--direct-placement only supports Selective Repeat')
+    return args
 
 
 args = getArgs()
@@ -109,9 +148,10 @@ try:
         exit()
 
     if args.rdtType == RDT_SR:
-        client_socket = RDTSocketSR()
+        client_socket = RDTSocketSR(
+            args.checksum, args.window, args.window, args.congestionControl)
     else:
-        client_socket = RDTSocketSW()
+        client_socket = RDTSocketSW(args.checksum)
 
     client_socket.connect((args.host, args.port))
 
@@ -122,7 +162,10 @@ try:
     responsePacket = Packet.fromSerializedPacket(client_socket.recv())
     if responsePacket.type == FileTransfer.OK:
         startTime = time.time_ns()
-        FileTransfer.recv_file(client_socket, file)
+        if args.directPlacement:
+            FileTransfer.recv_file_direct(client_socket, file)
+        else:
+            FileTransfer.recv_file(client_socket, file)
         finishTime = time.time_ns()
 
         elapsedTime = (finishTime - startTime) / 1000000  # Convert ns to ms
@@ -140,6 +183,12 @@ try:
         file.close()
         os.remove(args.dst)
         exit()
+    if responsePacket.type == FileTransfer.OVERLOADED:
+        logging.info("The server is overloaded, try again later")
+        client_socket.closeReceiver()
+        file.close()
+        os.remove(args.dst)
+        exit()
 except ServerUnreachable:
     logging.info("Server unreachable...")
 except LostConnection:
@@ -0,0 +1,110 @@
+import time
+
+from collections import deque
+from threading import Condition, Lock
+
+# Reasons returned by 'admit'
+ADMITTED = 0
+QUEUE_FULL = 1          # Every worker is busy and the queue is full
+CLIENT_LIMIT = 2        # The client has too many connections
+
+
+"""
+    Bounded queue of the accepted connections of a server that wait for a
+        free worker of its pool.
+    A connection is admitted if there is room in the queue and its client
+        (by IP) has less than 'maxPerClient' connections queued or being
+        served (0 is no limit), otherwise the server must reject it.
+    Keeps the queue depth and the time connections waited for a worker.
+    It's thread safe.
+"""
+
+
+class AdmissionQueue:
+    def __init__(self, maxQueued, maxPerClient=0):
+        self.maxQueued = maxQueued
+        self.maxPerClient = maxPerClient
+        self.lock = Lock()
+        self.queued = deque()                    # (item, clientIP, admittedAt)
+        # Notified when a connection is queued
+        self.queueChanged = Condition(self.lock)
+        self.connectionsByClient = {}            # clientIP -> queued + served
+
+        self.admitted = 0
+        self.rejectedQueueFull = 0
+        self.rejectedClientLimit = 0
+        self.maxDepth = 0
+        self.waits = 0
+        self.totalWait = 0                       # Seconds
+        self.maxWait = 0
+
+    """
+        Queues 'item' for a worker, returns ADMITTED or the reason why it
+            was rejected
+    """
+
+    def admit(self, item, clientIP):
+        self.lock.acquire()
+        connections = self.connectionsByClient.get(clientIP, 0)
+        if(len(self.queued) >= self.maxQueued):
+            self.rejectedQueueFull += 1
+            result = QUEUE_FULL
+        elif(self.maxPerClient and connections >= self.maxPerClient):
+            self.rejectedClientLimit += 1
+            result = CLIENT_LIMIT
+        else:
+            self.connectionsByClient[clientIP] = connections + 1
+            self.queued.append((item, clientIP, time.monotonic()))
+            self.admitted += 1
+            self.maxDepth = max(self.maxDepth, len(self.queued))
+            self.queueChanged.notify()
+            result = ADMITTED
+        self.lock.release()
+        return result
+
+    """
+        Blocks until a connection is queued and returns (item, clientIP,
+            seconds it waited)
+    """
+
+    def get(self):
+        self.lock.acquire()
+        while(not self.queued):
+            self.queueChanged.wait()
+        item, clientIP, admittedAt = self.queued.popleft()
+        wait = time.monotonic() - admittedAt
+        self.waits += 1
+        self.totalWait += wait
+        self.maxWait = max(self.maxWait, wait)
+        self.lock.release()
+        return (item, clientIP, wait)
+
+    # Called by the worker when it finishes serving a connection of 'get'
+    def done(self, clientIP):
+        self.lock.acquire()
+        connections = self.connectionsByClient[clientIP] - 1
+        if(connections == 0):
+            del self.connectionsByClient[clientIP]
+        else:
+            self.connectionsByClient[clientIP] = connections
+        self.lock.release()
+
+    def getDepth(self):
+        self.lock.acquire()
+        depth = len(self.queued)
+        self.lock.release()
+        return depth
+
+    def getStats(self):
+        self.lock.acquire()
+        stats = {
+            'depth': len(self.queued),
+            'maxDepth': self.maxDepth,
+            'admitted': self.admitted,
+            'rejectedQueueFull': self.rejectedQueueFull,
+            'rejectedClientLimit': self.rejectedClientLimit,
+            'avgWait': self.totalWait / self.waits if self.waits else 0,
+            'maxWait': self.maxWait,
+        }
+        self.lock.release()
+        return stats
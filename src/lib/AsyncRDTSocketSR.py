@@ -0,0 +1,565 @@
+import asyncio
+import time
+import logging
+
+from socket import SOL_SOCKET, SO_RCVBUF
+
+from lib.exceptions import LostConnection, ServerUnreachable
+from lib.RDTPacket import RDTPacket, RDT_HEADER_LENGTH
+from lib.ChecksumEngine import getChecksumEngine, DEFAULT_CHECKSUM
+from lib.ReceiveWindow import ADDED
+from lib.CongestionControl import DEFAULT_CONGESTION_CONTROL
+from lib.ConnectionDemultiplexer import RECEIVE_BUFFER_SIZE
+from lib.SelectiveRepeat import (
+    SelectiveRepeat, TIMEOUT, FAST, NAKED, INPUT_BUFFER_SIZE, WINDOWSIZE,
+    NRETRIES, RECEIVE_TIMEOUT, DELAYED_ACK_TIME)
+
+# Seconds waited for the FINACK before resending the FIN
+FINACK_TIMEOUT = 1
+
+
+"""
+    Hands the datagrams received by an asyncio endpoint to its socket
+"""
+
+
+class RDTDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, rdtSocket):
+        self.rdtSocket = rdtSocket
+
+    def datagram_received(self, data, address):
+        self.rdtSocket.datagramReceived(data, address)
+
+    def error_received(self, exc):
+        logging.debug("Datagram endpoint error: {}".format(exc))
+
+
+"""
+    Selective Repeat over asyncio. The protocol is the SelectiveRepeat of
+        RDTSocketSR (same packets, ACKs with SACK blocks, NAKs, flow and
+        congestion control), so each side can use either of them.
+    Everything runs in the event loop thread: datagrams are handled by
+        'datagramReceived', timers are 'loop.call_later' handles and
+        send/recv/accept wait on asyncio Events, so there are no locks nor
+        threads by connection.
+    As a multiplexed RDTSocketSR, the connections of a server use the
+        listening endpoint and are found by the client address.
+"""
+
+
+class AsyncRDTSocketSR:
+    ##############################
+    #         COMMON API         #
+    ##############################
+    def __init__(
+            self,
+            checksumEngine=DEFAULT_CHECKSUM,
+            windowSize=WINDOWSIZE,
+            inputBufferSize=INPUT_BUFFER_SIZE,
+            congestionControl=DEFAULT_CONGESTION_CONTROL):
+        self.srcIP = ''  # Default source addr
+        self.srcPort = 0  # Default source port
+        self.destIP = None
+        self.destPort = None
+
+        self.loop = None
+        self.transport = None                    # Shared by a server
+
+        # Both sides of a connection must use the same engine
+        self.checksumEngine = getChecksumEngine(checksumEngine)
+        # Windows, ACKs and retransmissions, shared with RDTSocketSR
+        self.selectiveRepeat = SelectiveRepeat(
+            self.checksumEngine, windowSize, inputBufferSize, congestionControl)
+
+        # Server variables
+        self.listening = False
+        self.maxQueuedConnections = 0
+        self.connections = {}                    # By client address
+        self.unacceptedConnections = []
+        # Set by handleSYN when there is a new connection
+        self.unacceptedConnectionsChanged = asyncio.Event()
+
+        # Client / ServerClient variables
+        self.mainSocket = None                   # None if client, parent if ServerClient
+        self.synACKReceived = None               # Future of connect
+
+        self.lostConnection = False
+        self.requestedClose = False
+        self.closed = False
+        self.receivedFINACK = asyncio.Event()
+
+        # Set when the expected packet arrives or close is requested
+        self.inputBufferChanged = asyncio.Event()
+        # The timer that will ACK the packets received not ACKed yet
+        self.delayedACKTimer = None
+        # Set when packets are removed from outPutWindow or it may grow
+        self.outPutWindowChanged = asyncio.Event()
+        # Pending resend timer of every packet in outPutWindow, by seqNum
+        self.resendTimers = {}
+
+    def getDestinationAddress(self):
+        return (self.destIP, self.destPort)
+
+    def getAdvertisedWindow(self):
+        return self.selectiveRepeat.inputBuffer.getFreeSpace()
+
+    """
+        Creates the UDP endpoint of the socket, a server must call it before
+            'listen'. With 'reusePort' several processes can bind the same
+            address (SO_REUSEPORT)
+    """
+
+    async def bind(self, address, reusePort=False):
+        self.srcIP, self.srcPort = address
+        await self.openEndpoint(reusePort)
+        # Every connection of the server is received by this endpoint
+        try:
+            self.transport.get_extra_info('socket').setsockopt(
+                SOL_SOCKET, SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        except OSError:
+            logging.debug("Cannot set SO_RCVBUF", exc_info=True)
+        logging.debug(
+            "Binding the socket to {}:{}".format(
+                self.srcIP, self.srcPort))
+
+    async def openEndpoint(self, reusePort=False):
+        self.loop = asyncio.get_running_loop()
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: RDTDatagramProtocol(self),
+            local_addr=(self.srcIP or '0.0.0.0', self.srcPort),
+            reuse_port=reusePort or None)
+        self.srcPort = self.transport.get_extra_info('sockname')[1]
+
+    """
+        Called by RDTDatagramProtocol with every datagram of the endpoint
+    """
+
+    def datagramReceived(self, data, address):
+        packet = RDTPacket.fromSerializedPacket(data)
+        if(self.listening):
+            connection = self.connections.get(address)
+            if(packet.isSYN()):
+                self.handleSYN(packet, address)
+            elif(connection is not None):
+                connection.handlePacket(packet)
+        elif(packet.isSYNACK()):
+            if(self.synACKReceived is not None and
+                    not self.synACKReceived.done() and
+                    address[0] == self.destIP):
+                self.synACKReceived.set_result(packet)
+        elif(address == (self.destIP, self.destPort)):
+            self.handlePacket(packet)
+
+    #####################################
+    #         LISTEN/ACCEPT API         #
+    #####################################
+
+    def listen(self, maxQueuedConnections):
+        self.maxQueuedConnections = maxQueuedConnections
+        self.listening = True
+        logging.debug("Now server is listening...")
+
+    """
+        It's used by the server.
+        Performs the 2whs with the client, creates a new connection and
+            appends it to unacceptedConnections.
+        If the client was already connected (SYNACK lost) resends the SYNACK
+    """
+
+    def handleSYN(self, packet, address):
+        connection = self.connections.get(address)
+        if(connection is None):
+            logging.info(
+                "Requested connection from [{}:{}]".format(
+                    *address))
+            if(len(self.unacceptedConnections) >= self.maxQueuedConnections):
+                logging.info(
+                    "Refused connection from [{}:{}] due pending connections overflow".format(
+                        *address))
+                return
+            connection = self.createConnection(
+                address, packet.seqNum, packet.window)
+            self.connections[address] = connection
+            self.unacceptedConnections.append(connection)
+            self.unacceptedConnectionsChanged.set()
+        else:
+            logging.debug(
+                "Requested connection from [{}:{}], wich is already connected".format(
+                    *address))
+        synAckPacket = RDTPacket.makeSYNACKPacket(
+            connection.selectiveRepeat.seqNum,
+            connection.selectiveRepeat.ackNum,
+            self.srcPort,
+            connection.getAdvertisedWindow())
+        self.transport.sendto(synAckPacket.serialize(), address)
+
+    def createConnection(self, clientAddress, initialAckNum, peerWindow):
+        selectiveRepeat = self.selectiveRepeat
+        newConnection = AsyncRDTSocketSR(
+            self.checksumEngine,
+            selectiveRepeat.windowSize,
+            selectiveRepeat.inputBuffer.capacity,
+            type(selectiveRepeat.congestionControl))
+        newConnection.loop = self.loop
+        newConnection.transport = self.transport
+        newConnection.srcIP, newConnection.srcPort = (self.srcIP, self.srcPort)
+        newConnection.destIP, newConnection.destPort = clientAddress
+        newConnection.selectiveRepeat.ackNum = initialAckNum
+        newConnection.selectiveRepeat.setPeerWindow(peerWindow)
+        newConnection.setRateLimits(
+            selectiveRepeat.sharedRateLimit, selectiveRepeat.connectionRate,
+            selectiveRepeat.connectionBurst)
+        newConnection.setPacing(selectiveRepeat.pacer is not None)
+        newConnection.mainSocket = self
+        return newConnection
+
+    async def accept(self):
+        logging.debug("Waiting for new connections")
+        while(not self.unacceptedConnections):
+            self.unacceptedConnectionsChanged.clear()
+            await self.unacceptedConnectionsChanged.wait()
+        connection = self.unacceptedConnections.pop(0)
+        addr = connection.getDestinationAddress()
+        logging.info("Accepted connection {}:{}".format(*addr))
+        return (connection, addr)
+
+    def closeConnectionSocket(self, destinationAddress):
+        connection = self.connections.pop(destinationAddress, None)
+        if(connection in self.unacceptedConnections):
+            self.unacceptedConnections.remove(connection)
+
+    ##################
+    #   Client API   #
+    ##################
+
+    """
+        Performs the 2whs, the SYN is resent with the RTO backed off until
+            the SYNACK arrives
+    """
+
+    async def connect(self, destAddr):
+        self.destIP, self.destPort = destAddr
+        if(self.transport is None):
+            await self.openEndpoint()
+
+        logging.info(
+            "Establishing connection with server {}:{}".format(
+                *destAddr))
+        selectiveRepeat = self.selectiveRepeat
+        self.synACKReceived = self.loop.create_future()
+        synAckPacket = None
+        for synSent in range(NRETRIES):
+            synPacket = RDTPacket.makeSYNPacket(
+                selectiveRepeat.seqNum, self.getAdvertisedWindow())
+            sentAt = time.monotonic()
+            self._send(synPacket)
+            try:
+                synAckPacket = await asyncio.wait_for(
+                    asyncio.shield(self.synACKReceived),
+                    selectiveRepeat.rttEstimator.getRTO(synSent))
+                break
+            except asyncio.TimeoutError:
+                logging.debug("Assuming Lost SYNACK, retrying")
+        if(synAckPacket is None):
+            logging.info("Error establishing connection")
+            self.transport.close()
+            raise ServerUnreachable
+        if(synSent == 0):  # Karn's rule
+            selectiveRepeat.rttEstimator.addSample(time.monotonic() - sentAt)
+
+        selectiveRepeat.ackNum = synAckPacket.seqNum
+        selectiveRepeat.setPeerWindow(synAckPacket.window)
+        # The server may serve the connection from another port
+        self.destPort = int(synAckPacket.data.tobytes().decode())
+        logging.info(
+            "Connection established with Server {}:{}".format(
+                *destAddr))
+        return True
+
+    #########################
+    #   COMMUNICATION API   #
+    #########################
+
+    # See SelectiveRepeat.setRateLimits
+    def setRateLimits(self, sharedLimit=None, rate=0, burst=0):
+        self.selectiveRepeat.setRateLimits(sharedLimit, rate, burst)
+
+    # See SelectiveRepeat.setPacing
+    def setPacing(self, pacing):
+        self.selectiveRepeat.setPacing(pacing)
+
+    def _send(self, packet):
+        if(not self.requestedClose):
+            self.transport.sendto(
+                packet.serialize(), (self.destIP, self.destPort))
+
+    """
+        Handles a packet received by the connection, as
+            RDTSocketSR.handlePacket does
+    """
+
+    def handlePacket(self, packet):
+        selectiveRepeat = self.selectiveRepeat
+        if(packet.isCorrupt(self.checksumEngine)):
+            logging.debug(
+                "Connection({}:{}), Discarding corrupted Packet(seqno={}, l={})".format(
+                    self.destIP, self.destPort, packet.seqNum, len(packet.data)))
+            if(packet.isData()):
+                self._send(selectiveRepeat.makeNAKPacket(packet.seqNum))
+        elif(packet.isACK()):
+            self.updateOutPutWindow(
+                packet.ackNum, packet.window, packet.getSACKBlocks())
+        elif(packet.isNAK()):
+            self.updateOutPutWindow(packet.ackNum, packet.window)
+            self.retransmit(packet.seqNum, NAKED)
+        elif(packet.isFIN()):
+            logging.debug(
+                "Connection({}:{}), Received FIN Packet".format(
+                    self.destIP, self.destPort))
+            self.sendDelayedACK()
+            self._send(RDTPacket.makeFINACKPacket(
+                selectiveRepeat.seqNum, selectiveRepeat.ackNum,
+                self.checksumEngine))
+            self.requestedClose = True
+            self.inputBufferChanged.set()
+        elif(packet.isFINACK()):
+            self.receivedFINACK.set()
+        else:
+            expected = packet.seqNum == selectiveRepeat.ackNum
+            result, previousCumulativeAck = selectiveRepeat.offer(packet)
+            if(result == ADDED and expected):
+                self.inputBufferChanged.set()
+            ackPacket, delayACK = selectiveRepeat.acknowledge(
+                packet, result, previousCumulativeAck)
+            if(ackPacket is not None):
+                self.cancelDelayedACK()
+                self._send(ackPacket)
+            elif(delayACK and self.delayedACKTimer is None):
+                self.delayedACKTimer = self.loop.call_later(
+                    DELAYED_ACK_TIME, self.sendDelayedACK)
+
+    # See RDTSocketSR.updateOutPutWindow
+    def updateOutPutWindow(self, ackNum, peerWindow, sackBlocks=()):
+        acked, lost, changed = self.selectiveRepeat.onACK(
+            ackNum, peerWindow, sackBlocks)
+        for seqNum in acked:
+            timer = self.resendTimers.pop(seqNum, None)
+            if(timer is not None):
+                timer.cancel()
+        for seqNum in lost:
+            self.retransmit(seqNum, FAST)
+        if(changed):
+            self.outPutWindowChanged.set()
+
+    """
+        Resends a packet of outPutWindow before its timer and restarts it,
+            keeping the tries it had left
+    """
+
+    def retransmit(self, seqNum, reason):
+        packet = self.selectiveRepeat.retransmit(seqNum, reason)
+        if(packet is None):
+            return
+        self._send(packet)
+        timer = self.resendTimers.get(seqNum)
+        if(timer is not None):
+            timer.cancel()
+            self.resendTimers[seqNum] = self.loop.call_later(
+                self.selectiveRepeat.getResendTimeout(seqNum), self.resend,
+                seqNum)
+
+    def cancelDelayedACK(self):
+        if(self.delayedACKTimer is not None):
+            self.delayedACKTimer.cancel()
+            self.delayedACKTimer = None
+
+    def sendDelayedACK(self):
+        self.delayedACKTimer = None
+        ackPacket = self.selectiveRepeat.makeDelayedACKPacket()
+        if(ackPacket is not None):
+            self._send(ackPacket)
+
+    #####################
+    #   * Receive API   #
+    #####################
+
+    """
+        Returns next expected (in order) packet's payload, or b'' once the
+            other side closed the connection
+    """
+
+    async def recv(self):
+        selectiveRepeat = self.selectiveRepeat
+        deadline = self.loop.time() + RECEIVE_TIMEOUT
+        while(selectiveRepeat.getExpectedInput() is None and
+                not self.requestedClose):
+            remaining = deadline - self.loop.time()
+            if(remaining <= 0):
+                self.lostConnection = True
+                raise LostConnection
+            self.inputBufferChanged.clear()
+            try:
+                await asyncio.wait_for(
+                    self.inputBufferChanged.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        packet, ackPacket = selectiveRepeat.popExpectedInput()
+        if(ackPacket is not None):
+            self.cancelDelayedACK()
+            self._send(ackPacket)
+        if(packet is None):
+            logging.debug(
+                "Connection({}:{}) requested close. Socket cannot receive any more packets".format(
+                    self.destIP, self.destPort))
+            return b''
+        return packet.data
+
+    ##################
+    #   * Send API   #
+    ##################
+
+    """
+        Sends 'bytes' as soon as the window allows it and returns its length,
+            the packet is resent by 'resend' after the RTO.
+        'payloadChecksum' as in RDTSocketSR.send
+    """
+
+    async def send(self, bytes, payloadChecksum=None):
+        if(self.closed or self.receivedFINACK.is_set()):
+            return 0
+
+        selectiveRepeat = self.selectiveRepeat
+        while(selectiveRepeat.outPutWindowIsFull(len(bytes)) and
+                not self.lostConnection):
+            self.outPutWindowChanged.clear()
+            if(selectiveRepeat.outPutWindow.bytesInFlight > 0):
+                await self.outPutWindowChanged.wait()
+                continue
+            # Closed peer window: waits for its window update, if it's lost
+            # the window is probed with this packet after the RTO
+            try:
+                await asyncio.wait_for(
+                    self.outPutWindowChanged.wait(),
+                    selectiveRepeat.rttEstimator.getRTO())
+            except asyncio.TimeoutError:
+                break
+
+        if(self.lostConnection):
+            raise LostConnection
+        # The other connections run while it sleeps
+        if(selectiveRepeat.isThrottled()):
+            delay = selectiveRepeat.getThrottleDelay(
+                len(bytes) + RDT_HEADER_LENGTH,
+                selectiveRepeat.getPacedWindow())
+            if(delay > 0):
+                await asyncio.sleep(delay)
+
+        packet = selectiveRepeat.makeDataPacket(bytes, payloadChecksum)
+        self._send(packet)
+        self.resendTimers[packet.seqNum] = self.loop.call_later(
+            selectiveRepeat.onSend(packet), self.resend, packet.seqNum)
+        return len(bytes)
+
+    """
+        Called by the event loop after the RTO of a packet not ACKed,
+            resends it with the RTO backed off
+    """
+
+    def resend(self, seqNum):
+        if(self.closed or self.receivedFINACK.is_set()):
+            return
+        selectiveRepeat = self.selectiveRepeat
+        if(selectiveRepeat.getTriesLeft(seqNum) <= 0):
+            self.lostConnection = True
+            selectiveRepeat.loseConnection()
+            self.cancelResendTimers()
+            self.outPutWindowChanged.set()
+            return
+        packet = selectiveRepeat.retransmit(seqNum, TIMEOUT)
+        if(packet is None):
+            return
+        logging.debug(
+            "Connection({}:{}), Resending Packet(seqno={}), tries left={}".format(
+                self.destIP, self.destPort, seqNum,
+                selectiveRepeat.getTriesLeft(seqNum)))
+        self._send(packet)
+        self.resendTimers[seqNum] = self.loop.call_later(
+            selectiveRepeat.getResendTimeout(seqNum), self.resend, seqNum)
+
+    def cancelResendTimers(self):
+        for timer in self.resendTimers.values():
+            timer.cancel()
+        self.resendTimers = {}
+        self.selectiveRepeat.resendTries = {}
+
+    def getStats(self):
+        return self.selectiveRepeat.getStats()
+
+    ###################
+    #   * Close API   #
+    ###################
+
+    async def sendFIN(self):
+        for tries in range(NRETRIES, 0, -1):
+            logging.debug(
+                "Connection({}:{}), sending FIN Packet, tries left={}".format(
+                    self.destIP, self.destPort, tries))
+            self._send(RDTPacket.makeFINPacket(
+                self.selectiveRepeat.seqNum, self.selectiveRepeat.ackNum,
+                self.checksumEngine))
+            try:
+                await asyncio.wait_for(
+                    self.receivedFINACK.wait(), FINACK_TIMEOUT)
+                logging.debug(
+                    "Connection({}:{}) correctly closed...".format(
+                        self.destIP, self.destPort))
+                return
+            except asyncio.TimeoutError:
+                pass
+        logging.debug(
+            "Connection({}:{}) cannot close correctly, assuming other side currently closed...".format(
+                self.destIP, self.destPort))
+
+    """
+        Waits until every packet was ACKed, then closes with FIN/FINACK
+    """
+
+    async def closeSender(self):
+        while(not self.selectiveRepeat.outPutWindow.isEmpty()):
+            self.outPutWindowChanged.clear()
+            await self.outPutWindowChanged.wait()
+        if(not self.lostConnection):
+            await self.sendFIN()
+        self.close()
+
+    async def closeReceiver(self):
+        self.close()
+
+    def close(self):
+        if(self.closed):
+            return
+        if(self.mainSocket is not None):
+            self.mainSocket.closeConnectionSocket(
+                self.getDestinationAddress())
+        self.sendDelayedACK()
+        self.requestedClose = True
+        self.closed = True
+        self.inputBufferChanged.set()
+        self.cancelResendTimers()
+        self.cancelDelayedACK()
+        if(self.mainSocket is None and self.transport is not None):
+            self.transport.close()
+        logging.debug("Connection({}:{}), stats: {}".format(
+            self.destIP, self.destPort, self.getStats()))
+
+    def closeServer(self):
+        logging.info("Closing server socket...")
+        self.listening = False
+        if(self.loop is None or self.loop.is_closed()):
+            return  # The loop closed its endpoints
+        for connection in list(self.connections.values()):
+            connection.close()
+        if(self.transport is not None):
+            self.transport.close()
+        logging.info("Server socket closed...")
@@ -0,0 +1,253 @@
+import struct
+import zlib
+from collections import OrderedDict
+from threading import Lock
+
+# Fields covered by the checksum: seqNum, ackNum, window, syn, ack, fin, nak
+CHECKSUM_FIELDS = struct.Struct("i i i ? ? ? ?")
+PADDING = b'\x00'
+# Payload lengths whose CRC32 zeros tables are kept (see getZerosTables):
+# the full packets of a file share one, the last one of every file is short
+ZEROS_TABLES_CACHE_SIZE = 4
+
+
+class ChecksumEngine:
+    name = None
+
+    """
+        Returns the header fields covered by the checksum (16 bytes), the
+            payload is covered too but it isn't joined to them
+    """
+
+    def checksummedBytes(self, packet):
+        return CHECKSUM_FIELDS.pack(
+            packet.seqNum,
+            packet.ackNum,
+            packet.window,
+            packet.syn,
+            packet.ack,
+            packet.fin,
+            packet.nak)
+
+    """
+        Returns the covered bytes as sequences of 16 bit words: the header
+            fields and views over the payload, which isn't copied. An odd
+            length payload is padded with 1 byte
+    """
+
+    def checksummedWords(self, packet):
+        return ([memoryview(self.checksummedBytes(packet)).cast('H')] +
+                self.payloadWords(packet.data))
+
+    def payloadWords(self, data):
+        data = memoryview(data)
+        if(len(data) % 2 != 0):
+            return [data[:-1].cast('H'),
+                    memoryview(data[-1:].tobytes() + PADDING).cast('H')]
+        return [data.cast('H')]
+
+    def calculate(self, packet):
+        raise NotImplementedError
+
+    """
+        Incremental API, for payloads sent many times (see
+            FileTransfer.read_checksummed_packets): 'calculatePayload'
+            returns the part of the checksum that only depends on the
+            payload, and 'calculateWithPayload' the checksum of a packet
+            with that payload, processing only its header.
+        Both give the same value than 'calculate'. By default nothing is
+            saved, engines override them
+    """
+
+    def calculatePayload(self, data):
+        return None
+
+    def calculateWithPayload(self, packet, payloadChecksum):
+        return self.calculate(packet)
+
+    """
+        Batch API, checksums a whole window of packets in one call
+    """
+
+    def calculateMany(self, packets):
+        calculate = self.calculate
+        return [calculate(packet) for packet in packets]
+
+    def verify(self, packet):
+        return packet.checksum == self.calculate(packet)
+
+    """
+        Returns the packets (of the given window) whose checksum doesn't match
+    """
+
+    def findCorrupted(self, packets):
+        checksums = self.calculateMany(packets)
+        return [packet for packet, checksum in zip(packets, checksums)
+                if packet.checksum != checksum]
+
+
+class LegacyChecksum(ChecksumEngine):
+    """
+        Same algorithm (and so, same values on the wire) used originally by
+            RDTPacket: every 16 bit word is added twice the running sum and
+            the carry is wrapped around.
+        Iterates over memoryviews instead of unpacking a tuple and calling
+            carryAroundAdd for every word.
+    """
+    name = 'legacy'
+
+    def calculate(self, packet):
+        return self.addWords(0, self.checksummedWords(packet))
+
+    def addWords(self, checksum, wordsList):
+        for words in wordsList:
+            for word in words:
+                checksum += checksum + word
+                checksum = (checksum & 0xffff) + (checksum >> 16)
+        return checksum
+
+    """
+        Modulo 0xffff the sum doubles the checksum before adding a word,
+            so after the n payload words the header part is multiplied by
+            2^n: the payload part is (sum modulo 0xffff, 2^n modulo 0xffff).
+        The running sum never exceeds 0x10002, so it's the value modulo
+            0xffff, unless that value is below 4 (it could be it plus
+            0xffff): then the packet is checksummed from scratch
+    """
+
+    def calculatePayload(self, data):
+        words = self.payloadWords(data)
+        return (self.addWords(0, words) % 0xffff,
+                pow(2, sum(len(w) for w in words), 0xffff))
+
+    def calculateWithPayload(self, packet, payloadChecksum):
+        payloadSum, multiplier = payloadChecksum
+        header = [memoryview(self.checksummedBytes(packet)).cast('H')]
+        checksum = (self.addWords(0, header) * multiplier + payloadSum) % 0xffff
+        if(checksum < 4):
+            return self.calculate(packet)
+        return checksum
+
+
+class InternetChecksum(ChecksumEngine):
+    """
+        Ones-complement sum of 16 bit words (RFC 1071).
+        The sums are done by 'sum' over memoryviews, the carries are
+            folded at the end.
+    """
+    name = 'internet'
+
+    def calculate(self, packet):
+        checksum = 0
+        for words in self.checksummedWords(packet):
+            checksum += sum(words)
+        return self.fold(checksum)
+
+    def fold(self, checksum):
+        while(checksum >> 16):
+            checksum = (checksum & 0xffff) + (checksum >> 16)
+        return checksum
+
+    # The sum of the payload words, before folding the carries
+    def calculatePayload(self, data):
+        return sum(sum(words) for words in self.payloadWords(data))
+
+    def calculateWithPayload(self, packet, payloadChecksum):
+        header = memoryview(self.checksummedBytes(packet)).cast('H')
+        return self.fold(sum(header) + payloadChecksum)
+
+
+class CRC32Checksum(ChecksumEngine):
+    """
+        CRC32 (zlib) of the covered bytes, it doesn't need padding.
+        The value is returned as a signed 32 bit int so it fits in the 'i'
+            field of the RDT header.
+    """
+    name = 'crc32'
+
+    def __init__(self):
+        # Length -> tables, least recently used first. The engine is shared
+        # by every connection of the process, so it's bounded and locked
+        self.lockZerosTables = Lock()
+        self.zerosTables = OrderedDict()
+
+    def calculate(self, packet):
+        checksum = zlib.crc32(packet.data, zlib.crc32(
+            self.checksummedBytes(packet)))
+        return self.toSigned(checksum)
+
+    def toSigned(self, checksum):
+        if(checksum >= 0x80000000):
+            checksum -= 0x100000000
+        return checksum
+
+    """
+        The CRC of header + payload is the CRC of the payload XOR the CRC of
+            the header advanced by len(payload) zero bytes (as zlib's
+            crc32_combine). Advancing is linear in the CRC bits, so it's
+            done with 4 tables of 256 values (by byte of the CRC), kept
+            for the last ZEROS_TABLES_CACHE_SIZE payload lengths
+    """
+
+    def calculatePayload(self, data):
+        return zlib.crc32(data)
+
+    def calculateWithPayload(self, packet, payloadCRC):
+        t0, t1, t2, t3 = self.getZerosTables(len(packet.data))
+        crc = zlib.crc32(self.checksummedBytes(packet))
+        return self.toSigned(
+            t0[crc & 0xff] ^ t1[(crc >> 8) & 0xff] ^
+            t2[(crc >> 16) & 0xff] ^ t3[crc >> 24] ^ payloadCRC)
+
+    def getZerosTables(self, length):
+        self.lockZerosTables.acquire()
+        tables = self.zerosTables.get(length)
+        if(tables is not None):
+            self.zerosTables.move_to_end(length)
+        self.lockZerosTables.release()
+        if(tables is None):
+            tables = self.makeZerosTables(length)
+            self.lockZerosTables.acquire()
+            self.zerosTables[length] = tables
+            while(len(self.zerosTables) > ZEROS_TABLES_CACHE_SIZE):
+                self.zerosTables.popitem(last=False)
+            self.lockZerosTables.release()
+        return tables
+
+    def makeZerosTables(self, length):
+        zeros = bytes(length)
+        # Image of every bit, zlib conditions the register with ~
+        bits = [zlib.crc32(zeros, (1 << bit) ^ 0xffffffff) ^ 0xffffffff
+                for bit in range(32)]
+        tables = []
+        for byte in range(4):
+            table = [0] * 256
+            for value in range(1, 256):
+                lowest = (value & -value).bit_length() - 1
+                table[value] = (table[value & (value - 1)] ^
+                                bits[8 * byte + lowest])
+            tables.append(table)
+        return tuple(tables)
+
+CHECKSUM_ENGINES = {
+    LegacyChecksum.name: LegacyChecksum(),
+    InternetChecksum.name: InternetChecksum(),
+    CRC32Checksum.name: CRC32Checksum(),
+}
+DEFAULT_CHECKSUM = LegacyChecksum.name
+
+
+"""
+    Returns the engine registered with that name.
+    An engine instance can be passed too, it's returned as is.
+"""
+
+
+def getChecksumEngine(engine=DEFAULT_CHECKSUM):
+    if(isinstance(engine, ChecksumEngine)):
+        return engine
+    if(engine not in CHECKSUM_ENGINES):
+        raise ValueError(
+            "Unknown checksum engine '{}', available: {}".format(
+                engine, ", ".join(CHECKSUM_ENGINES)))
+    return CHECKSUM_ENGINES[engine]
@@ -0,0 +1,111 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+"""
+    LRU cache of file chunks with a budget of bytes, shared by the
+        downloads of a server.
+    Chunks are keyed by (path, mtime, offset): a file rewritten gets a new
+        mtime, so its old chunks are never returned and age out of the
+        cache (or are dropped at once with 'invalidate').
+    The chunks must not be modified once they are cached, they are given
+        to every reader as they are. Whatever is cached with a chunk counts
+        against the budget too (see 'put').
+    It's thread safe.
+"""
+
+
+class ChunkCache:
+    def __init__(self, budget):
+        self.budget = budget                     # Bytes
+        self.lock = Lock()
+        self.chunks = OrderedDict()              # Least recently used first
+        self.sizes = {}                          # key -> bytes counted
+        self.keysByPath = {}                     # path -> set of keys
+        self.size = 0                            # Bytes cached
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        self.lock.acquire()
+        n = len(self.chunks)
+        self.lock.release()
+        return n
+
+    """
+        Returns the value cached for (path, mtime, offset), or None
+    """
+
+    def get(self, key):
+        self.lock.acquire()
+        value = self.chunks.get(key)
+        if(value is None):
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.chunks.move_to_end(key)
+        self.lock.release()
+        return value
+
+    """
+        Caches 'value' (a tuple with the chunk first) and evicts the least
+            recently used chunks until the cache fits in the budget. 'size'
+            is the bytes it takes, the chunk and what comes with it (only
+            the chunk by default). A value larger than the budget isn't
+            cached
+    """
+
+    def put(self, key, value, size=None):
+        if(size is None):
+            size = len(value[0])
+        if(size > self.budget):
+            return
+        self.lock.acquire()
+        if(key not in self.chunks):
+            self.chunks[key] = value
+            self.sizes[key] = size
+            self.keysByPath.setdefault(key[0], set()).add(key)
+            self.size += size
+            while(self.size > self.budget):
+                oldKey, oldValue = self.chunks.popitem(last=False)
+                self.forget(oldKey, oldValue)
+                self.evictions += 1
+        self.lock.release()
+
+    # Drops every chunk of 'path', whatever its mtime
+    def invalidate(self, path):
+        self.lock.acquire()
+        for key in self.keysByPath.get(path, set()).copy():
+            self.forget(key, self.chunks.pop(key))
+        self.lock.release()
+
+    # Called with the lock acquired
+    def forget(self, key, value):
+        self.size -= self.sizes.pop(key)
+        keys = self.keysByPath[key[0]]
+        keys.discard(key)
+        if(not keys):
+            del self.keysByPath[key[0]]
+
+    def resetStats(self):
+        self.lock.acquire()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock.release()
+
+    def getStats(self):
+        self.lock.acquire()
+        lookups = self.hits + self.misses
+        stats = {
+            'budget': self.budget,
+            'size': self.size,
+            'chunks': len(self.chunks),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / lookups if lookups else 0,
+            'evictions': self.evictions,
+        }
+        self.lock.release()
+        return stats
@@ -0,0 +1,155 @@
+INITIAL_WINDOW_SEGMENTS = 4   # RFC 3390
+# Max growth per ACK in slow start, an ACK may cover several packets
+# (RFC 3465)
+ABC_LIMIT_SEGMENTS = 2
+MIN_SSTHRESH_SEGMENTS = 2
+# Pacing rate over window / SRTT: in slow start the window doubles every RTT,
+# so it's paced faster (as Linux does)
+PACING_GAIN = 1.25
+SLOW_START_PACING_GAIN = 2
+CONGESTION_AVOIDANCE_PACING_GAIN = 1.2
+
+
+"""
+    Congestion control of a Selective Repeat sender, it owns the congestion
+        window (bytes in flight allowed by the network).
+    RDTSocketSR drives it with the events of the connection:
+    * onSend: a new packet was sent (retransmissions aren't notified)
+    * onAck: an ACK acknowledged new bytes (one or more packets), with its
+        RTT sample (None if they were retransmitted)
+    * onLoss: the retransmission timer of a packet expired
+    * onFastRetransmit: a packet was resent because later packets were
+        ACKed (by default handled as any other loss)
+    And sends while bytesInFlight < min(getWindow(), receiver window).
+    With pacing the window is sent at getPacingGain() * window / SRTT bytes
+        per second.
+    New algorithms (CUBIC, BBR-like...) subclass it and are registered in
+        CONGESTION_CONTROLS.
+    It isn't thread safe, RDTSocketSR guards it with 'lockOutPutWindow'.
+"""
+
+
+class CongestionControl:
+    name = None
+
+    def __init__(self, mss):
+        self.mss = mss
+
+    def getWindow(self):
+        raise NotImplementedError
+
+    def onSend(self, seqNum, nbytes):
+        pass
+
+    def onAck(self, ackedBytes, rtt):
+        pass
+
+    def onLoss(self, seqNum):
+        pass
+
+    def onFastRetransmit(self, seqNum):
+        self.onLoss(seqNum)
+
+    def getPacingGain(self):
+        return PACING_GAIN
+
+    def getStats(self):
+        return {'cwnd': self.getWindow()}
+
+
+class NoCongestionControl(CongestionControl):
+    """
+        Only the receiver window limits the sender (original behaviour)
+    """
+    name = 'none'
+
+    def getWindow(self):
+        return float('inf')
+
+
+class RenoCongestionControl(CongestionControl):
+    """
+        Slow start and AIMD (RFC 5681):
+        * Slow start: cwnd grows by the ACKed bytes (up to two MSS per
+            ACK) until ssthresh
+        * Congestion avoidance: cwnd grows one MSS per RTT (byte counting)
+        * Timeout: ssthresh = cwnd / 2 and cwnd restarts from one MSS
+        * Fast retransmit: ssthresh = cwnd = cwnd / 2, ACKs keep arriving
+        Only the first loss of a window reduces it, the packets sent before
+            the reduction are lost in the same congestion event
+    """
+    name = 'reno'
+
+    def __init__(self, mss):
+        super().__init__(mss)
+        self.cwnd = INITIAL_WINDOW_SEGMENTS * mss
+        self.ssthresh = float('inf')
+        self.nextSeqNum = 0          # Next byte to send
+        self.recoverySeqNum = 0      # Losses before it were already handled
+        self.losses = 0
+
+    def getWindow(self):
+        return self.cwnd
+
+    def onSend(self, seqNum, nbytes):
+        self.nextSeqNum = max(self.nextSeqNum, seqNum + nbytes)
+
+    def onAck(self, ackedBytes, rtt):
+        if(self.cwnd < self.ssthresh):
+            self.cwnd += min(ackedBytes, ABC_LIMIT_SEGMENTS * self.mss)
+        else:
+            self.cwnd += self.mss * ackedBytes / self.cwnd
+
+    def onLoss(self, seqNum):
+        if(self.startCongestionEvent(seqNum)):
+            self.cwnd = self.mss
+
+    def onFastRetransmit(self, seqNum):
+        if(self.startCongestionEvent(seqNum)):
+            self.cwnd = self.ssthresh
+
+    def getPacingGain(self):
+        if(self.cwnd < self.ssthresh):
+            return SLOW_START_PACING_GAIN
+        return CONGESTION_AVOIDANCE_PACING_GAIN
+
+    # Returns False if the loss belongs to the current congestion event
+    def startCongestionEvent(self, seqNum):
+        if(seqNum < self.recoverySeqNum):
+            return False
+        self.losses += 1
+        self.ssthresh = max(self.cwnd / 2, MIN_SSTHRESH_SEGMENTS * self.mss)
+        self.recoverySeqNum = self.nextSeqNum
+        return True
+
+    def getStats(self):
+        return {
+            'cwnd': self.cwnd,
+            'ssthresh': self.ssthresh,
+            'congestionEvents': self.losses,
+        }
+
+
+CONGESTION_CONTROLS = {
+    NoCongestionControl.name: NoCongestionControl,
+    RenoCongestionControl.name: RenoCongestionControl,
+}
+DEFAULT_CONGESTION_CONTROL = RenoCongestionControl.name
+
+
+"""
+    Returns a new instance (every connection has its own window) of the
+        algorithm registered with that name.
+    A CongestionControl subclass can be passed too.
+"""
+
+
+def getCongestionControl(congestionControl, mss):
+    if(isinstance(congestionControl, type) and
+            issubclass(congestionControl, CongestionControl)):
+        return congestionControl(mss)
+    if(congestionControl not in CONGESTION_CONTROLS):
+        raise ValueError(
+            "Unknown congestion control '{}', available: {}".format(
+                congestionControl, ", ".join(CONGESTION_CONTROLS)))
+    return CONGESTION_CONTROLS[congestionControl](mss)
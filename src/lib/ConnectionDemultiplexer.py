@@ -0,0 +1,216 @@
+import logging
+import selectors
+import socket as sockets
+
+from collections import deque
+from threading import Condition, Lock, Thread
+from socket import timeout, SOL_SOCKET, SO_RCVBUF
+
+# Seconds between checks of the 'running' flag
+POLL_TIMEOUT = 1
+# Datagrams read in a row when the socket is readable, before selecting again
+MAX_DATAGRAMS_PER_EVENT = 64
+# Kernel buffer of the shared socket, it receives what the sockets of every
+# connection received (capped by net.core.rmem_max on Linux)
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+# Datagrams kept for a connection that isn't reading them (as the kernel
+# buffer of a UDP socket would), the rest are dropped
+MAX_QUEUED_DATAGRAMS = 64
+# recvfrom without blocking the loop, if the platform doesn't support it a
+# single datagram is read by event
+DONTWAIT = getattr(sockets, 'MSG_DONTWAIT', 0)
+
+
+"""
+    Socket-like endpoint of one peer of a ConnectionDemultiplexer.
+    Datagrams sent go out through the shared UDP socket, the received ones
+        are queued by the demultiplexer loop and read with
+        recvfrom/recvfrom_into (honoring settimeout), so RDT sockets can
+        use it instead of a socket of their own.
+    Closing it only unregisters the peer, the shared socket stays open.
+"""
+
+
+class DemultiplexedSocket:
+    def __init__(self, demultiplexer, address):
+        self.demultiplexer = demultiplexer
+        self.address = address
+        self.timeout = None
+
+        self.lock = Lock()
+        self.datagrams = deque()
+        # Notified when a datagram is queued or the socket is closed
+        self.datagramsChanged = Condition(self.lock)
+        self.droppedDatagrams = 0
+        self.closed = False
+
+    """
+        Queues a copy of the datagram, called by the demultiplexer loop
+    """
+
+    def deliver(self, data, address=None):
+        self.lock.acquire()
+        if(self.closed or len(self.datagrams) >= MAX_QUEUED_DATAGRAMS):
+            self.droppedDatagrams += 1
+        else:
+            self.datagrams.append(bytes(data))
+            self.datagramsChanged.notify()
+        self.lock.release()
+
+    def popDatagram(self):
+        self.lock.acquire()
+        if(not self.datagrams and not self.closed):
+            self.datagramsChanged.wait(self.timeout)
+        if(not self.datagrams):
+            closed = self.closed
+            self.lock.release()
+            if(closed):
+                raise OSError("Demultiplexed socket is closed")
+            raise timeout("timed out")
+        data = self.datagrams.popleft()
+        self.lock.release()
+        return data
+
+    def recvfrom(self, bufsize):
+        return (self.popDatagram()[:bufsize], self.address)
+
+    def recvfrom_into(self, buffer, nbytes=0):
+        data = self.popDatagram()
+        if(nbytes):
+            data = data[:nbytes]
+        buffer[:len(data)] = data
+        return (len(data), self.address)
+
+    def sendto(self, data, address):
+        return self.demultiplexer.socket.sendto(data, address)
+
+    def sendmsg(self, buffers, ancdata=(), flags=0, address=None):
+        return self.demultiplexer.socket.sendmsg(
+            buffers, ancdata, flags, address)
+
+    def settimeout(self, value):
+        self.timeout = value
+
+    def gettimeout(self):
+        return self.timeout
+
+    def getsockname(self):
+        return self.demultiplexer.socket.getsockname()
+
+    def close(self):
+        self.demultiplexer.unregister(self.address)
+        self.lock.acquire()
+        self.closed = True
+        self.datagrams.clear()
+        self.datagramsChanged.notify_all()
+        self.lock.release()
+
+
+"""
+    Serves every connection of a server from its listening UDP socket.
+    A single thread waits on a selector (epoll, kqueue...) and hands every
+        datagram to the handler registered for its peer address, or to
+        'onUnknownPeer' (new connections). Handlers run in the loop thread,
+        so they must not block, and receive a view over a buffer reused by
+        the next datagram: they must copy what they keep.
+    It replaces a socket and a receiving thread by connection.
+"""
+
+
+class ConnectionDemultiplexer:
+    def __init__(self, socket, onUnknownPeer, bufferSize):
+        self.socket = socket
+        self.onUnknownPeer = onUnknownPeer
+        self.buffer = bytearray(bufferSize)
+
+        self.lockHandlers = Lock()
+        self.handlers = {}                       # By peer address
+
+        self.selector = selectors.DefaultSelector()
+        self.lockRunning = Lock()
+        self.running = False
+        self.thread = None
+
+    """
+        Registers a peer and returns its DemultiplexedSocket.
+        Its datagrams are passed to 'handler(data, address)', by default
+            they are queued in the returned socket
+    """
+
+    def register(self, address, handler=None):
+        demultiplexedSocket = DemultiplexedSocket(self, address)
+        self.lockHandlers.acquire()
+        self.handlers[address] = handler or demultiplexedSocket.deliver
+        self.lockHandlers.release()
+        return demultiplexedSocket
+
+    def unregister(self, address):
+        self.lockHandlers.acquire()
+        self.handlers.pop(address, None)
+        self.lockHandlers.release()
+
+    def getAmountOfPeers(self):
+        self.lockHandlers.acquire()
+        n = len(self.handlers)
+        self.lockHandlers.release()
+        return n
+
+    def isRunning(self):
+        self.lockRunning.acquire()
+        v = self.running
+        self.lockRunning.release()
+        return v
+
+    def start(self):
+        # Blocking mode, senders of other threads wait for buffer space
+        self.socket.settimeout(None)
+        try:
+            self.socket.setsockopt(SOL_SOCKET, SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        except OSError:
+            logging.debug("Demultiplexer, cannot set SO_RCVBUF", exc_info=True)
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.lockRunning.acquire()
+        self.running = True
+        self.lockRunning.release()
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True  # Closes with the main thread
+        self.thread.start()
+
+    def stop(self):
+        self.lockRunning.acquire()
+        self.running = False
+        self.lockRunning.release()
+        if(self.thread is not None):
+            self.thread.join()
+        self.selector.close()
+
+    def run(self):
+        while(self.isRunning()):
+            for key, _ in self.selector.select(POLL_TIMEOUT):
+                self.readDatagrams(key.fileobj)
+
+    """
+        Dispatches the datagrams already received by the socket, without
+            blocking
+    """
+
+    def readDatagrams(self, socket):
+        view = memoryview(self.buffer)
+        maxDatagrams = MAX_DATAGRAMS_PER_EVENT if DONTWAIT else 1
+        for _ in range(maxDatagrams):
+            try:
+                nbytes, address = socket.recvfrom_into(
+                    self.buffer, len(self.buffer), DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:  # ICMP errors of previous sends, closed socket
+                logging.debug("Demultiplexer, recvfrom failed", exc_info=True)
+                return
+            self.lockHandlers.acquire()
+            handler = self.handlers.get(address, self.onUnknownPeer)
+            self.lockHandlers.release()
+            try:
+                handler(view[:nbytes], address)
+            except Exception:
+                logging.exception(
+                    "Demultiplexer, handler of {}:{} failed".format(*address))
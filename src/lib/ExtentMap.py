@@ -0,0 +1,67 @@
+from bisect import bisect_left, bisect_right
+
+
+"""
+    Set of byte ranges [start, end), kept sorted and merged: adjacent or
+        overlapping ranges become a single extent.
+    Used by PlacementWindow to remember which segments of the stream were
+        received without keeping their data.
+    It isn't thread safe.
+"""
+
+
+class ExtentMap:
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.size = 0                            # Bytes covered
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, start, end):
+        if(start >= end):
+            return
+        # Extents that touch [start, end) are merged with it
+        first = bisect_left(self.ends, start)
+        last = bisect_right(self.starts, end)
+        if(first < last):
+            start = min(start, self.starts[first])
+            end = max(end, self.ends[last - 1])
+            self.size -= sum(
+                self.ends[i] - self.starts[i] for i in range(first, last))
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+        self.size += end - start
+
+    def covers(self, start, end):
+        i = bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
+
+    """
+        Returns the end of the extent that contains 'start' (the contiguous
+            data from there), or 'start' if there is none
+    """
+
+    def contiguousEnd(self, start):
+        i = bisect_right(self.starts, start) - 1
+        if(i >= 0 and self.ends[i] > start):
+            return self.ends[i]
+        return start
+
+    # Forgets every byte before 'seqNum'
+    def removeBefore(self, seqNum):
+        while(self.starts and self.starts[0] < seqNum):
+            if(self.ends[0] <= seqNum):
+                self.size -= self.ends[0] - self.starts[0]
+                del self.starts[0]
+                del self.ends[0]
+            else:
+                self.size -= seqNum - self.starts[0]
+                self.starts[0] = seqNum
+
+    # Extents beyond 'seqNum', as [start, end] lists
+    def getExtents(self, seqNum):
+        i = bisect_right(self.ends, seqNum)
+        return [[self.starts[j], self.ends[j]]
+                for j in range(i, len(self.starts))]
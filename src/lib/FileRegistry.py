@@ -0,0 +1,82 @@
+import time
+
+from threading import Condition
+
+# Value of a file taken by a writer, instead of its amount of readers
+WRITING = -1
+
+
+"""
+    Table of the files in use by a server, by name: any amount of readers
+        (downloads) of a file run together, a writer (upload) takes it
+        alone.
+    A writer can wait for the file to be free. While it waits the file
+        takes no new readers, so a stream of downloads can't postpone it
+        forever.
+    The dicts and the condition can be proxies of a multiprocessing.Manager,
+        to share the table between server processes.
+"""
+
+
+class FileRegistry:
+    def __init__(self, files=None, waitingWriters=None, condition=None):
+        # name -> amount of readers, or WRITING
+        self.files = {} if files is None else files
+        # name -> amount of writers waiting for it
+        self.waitingWriters = {} if waitingWriters is None else waitingWriters
+        # Notified when a file is released
+        self.released = Condition() if condition is None else condition
+
+    """
+        Returns True if the file was taken for reading, False if a writer
+            has it or is waiting for it
+    """
+
+    def acquireRead(self, name):
+        self.released.acquire()
+        readers = self.files.get(name, 0)
+        acquired = readers != WRITING and name not in self.waitingWriters
+        if(acquired):
+            self.files[name] = readers + 1
+        self.released.release()
+        return acquired
+
+    """
+        Returns True if the file was taken for writing, waiting up to
+            'timeout' seconds for its readers or writer to release it
+    """
+
+    def acquireWrite(self, name, timeout=0):
+        deadline = time.monotonic() + timeout
+        self.released.acquire()
+        waiting = False
+        while(name in self.files):
+            remaining = deadline - time.monotonic()
+            if(remaining <= 0):
+                break
+            if(not waiting):
+                self.waitingWriters[name] = self.waitingWriters.get(name, 0) + 1
+                waiting = True
+            self.released.wait(remaining)
+        if(waiting):
+            writers = self.waitingWriters[name] - 1
+            if(writers == 0):
+                del self.waitingWriters[name]
+            else:
+                self.waitingWriters[name] = writers
+        acquired = name not in self.files
+        if(acquired):
+            self.files[name] = WRITING
+        self.released.release()
+        return acquired
+
+    # Releases a file taken by acquireRead or acquireWrite
+    def release(self, name):
+        self.released.acquire()
+        readers = self.files[name]
+        if(readers == WRITING or readers == 1):
+            del self.files[name]
+            self.released.notify_all()
+        else:
+            self.files[name] = readers - 1
+        self.released.release()
@@ -0,0 +1,73 @@
+from threading import Lock
+
+from lib.RDTPacket import RDTPacket
+
+
+class PooledRDTPacket(RDTPacket):
+    # Datagram buffer owned by the packet, 'data' is a view over it
+    __slots__ = ('buffer',)
+
+
+"""
+    Recycles received packets together with the bytearray where each
+        datagram was received, so the receiving thread doesn't allocate
+        a packet and a datagram for every 'recvfrom'.
+    It can be shared by every connection, at most 'maxPackets' free packets
+        are kept, the rest are left to the garbage collector.
+"""
+
+
+class PacketPool:
+    def __init__(self, maxPackets, bufferSize):
+        self.maxPackets = maxPackets
+        self.bufferSize = bufferSize
+
+        self.lock = Lock()
+        self.freePackets = []
+        self.created = 0
+        self.recycled = 0
+
+    """
+        Returns a packet with an empty buffer of 'bufferSize' bytes,
+            the datagram must be received in 'packet.buffer' and parsed
+            with 'packet.load'
+    """
+
+    def borrow(self):
+        self.lock.acquire()
+        if(self.freePackets):
+            packet = self.freePackets.pop()
+            self.recycled += 1
+            self.lock.release()
+            return packet
+        self.created += 1
+        self.lock.release()
+
+        packet = PooledRDTPacket.__new__(PooledRDTPacket)
+        packet.buffer = bytearray(self.bufferSize)
+        packet.data = b''
+        return packet
+
+    """
+        Gives back a packet to the pool, it must not be used anymore
+            (neither its data)
+    """
+
+    def giveBack(self, packet):
+        if(not isinstance(packet, PooledRDTPacket)):
+            return
+        packet.data = b''  # Releases the view over the buffer
+        self.lock.acquire()
+        if(len(self.freePackets) < self.maxPackets):
+            self.freePackets.append(packet)
+        self.lock.release()
+
+    def getStats(self):
+        self.lock.acquire()
+        stats = {
+            'created': self.created,
+            'recycled': self.recycled,
+            'free': len(self.freePackets),
+        }
+        self.lock.release()
+        return stats
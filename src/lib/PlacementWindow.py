@@ -0,0 +1,120 @@
+from lib.ExtentMap import ExtentMap
+from lib.ReceiveWindow import ADDED, DUPLICATE, OLD, FULL
+
+
+"""
+    Receive window of a Selective Repeat receiver that doesn't store the
+        packets: every new segment is handed to 'place(seqNum, data)' as
+        soon as it arrives (even out of order) and only its extent is
+        remembered, so the packet can be reused right away.
+    Same interface than ReceiveWindow, except that data is delivered when
+        it's placed: the receiver moves ackNum with 'deliver' and there
+        is nothing to 'get' or 'pop'.
+    Placing takes three steps, so the write doesn't hold the lock of the
+        receiver: 'offer' claims the segment, 'place' writes it and
+        'placed' marks it as received ('abandon' if the write failed).
+        Claimed segments count as duplicates and take their space, but
+        they aren't ACKed until they are placed.
+    The capacity (the window advertised) still bounds the bytes received
+        beyond the contiguous data, but they take no memory.
+    It isn't thread safe, RDTSocketSR guards it (and ackNum) with
+        'lockInputBuffer'. 'place' doesn't touch the window, it's called
+        without it.
+"""
+
+
+class PlacementWindow:
+    storesPackets = False
+
+    def __init__(self, capacity, place):
+        self.capacity = capacity                 # Bytes
+        self.placeData = place
+        self.extents = ExtentMap()
+        self.claimed = {}                        # seqNum -> length, not placed yet
+        self.claimedBytes = 0
+        self.cumulativeAck = None
+        self.lastAddedSeqNum = None
+
+    def __len__(self):
+        return len(self.extents)
+
+    def getFreeSpace(self):
+        return max(self.capacity - self.extents.size - self.claimedBytes, 0)
+
+    """
+        'ackNum' is the next expected byte. A new segment is claimed (ADDED),
+            the caller must 'place' it and then call 'placed' or 'abandon'.
+            The expected segment is claimed even if the window is full
+    """
+
+    def offer(self, packet, ackNum):
+        seqNum = packet.seqNum
+        end = seqNum + len(packet.data)
+        if(seqNum != ackNum and ackNum >= end):
+            return OLD
+        if(seqNum in self.claimed or self.extents.covers(seqNum, end)):
+            return DUPLICATE
+        if(seqNum != ackNum and self.extents.size + self.claimedBytes +
+                len(packet.data) > self.capacity):
+            return FULL
+        self.claimed[seqNum] = len(packet.data)
+        self.claimedBytes += len(packet.data)
+        return ADDED
+
+    # Writes a claimed segment, it may raise
+    def place(self, packet):
+        self.placeData(packet.seqNum, packet.data)
+
+    # The claimed segment was written, it's received from now on
+    def placed(self, packet, ackNum):
+        self.unclaim(packet)
+        self.extents.add(packet.seqNum, packet.seqNum + len(packet.data))
+        self.lastAddedSeqNum = packet.seqNum
+        self.advance(ackNum)
+
+    # The claimed segment couldn't be written, it can be offered again
+    def abandon(self, packet):
+        self.unclaim(packet)
+
+    def unclaim(self, packet):
+        self.claimedBytes -= self.claimed.pop(packet.seqNum)
+
+    # Moves cumulativeAck to the end of the contiguous placed data
+    def advance(self, ackNum):
+        if(self.cumulativeAck is None or self.cumulativeAck < ackNum):
+            self.cumulativeAck = ackNum
+        self.cumulativeAck = self.extents.contiguousEnd(self.cumulativeAck)
+
+    def getCumulativeAck(self, ackNum):
+        self.advance(ackNum)
+        return self.cumulativeAck
+
+    """
+        Delivers the contiguous placed data: returns the new ackNum and
+            frees its space in the window
+    """
+
+    def deliver(self, ackNum):
+        ackNum = self.getCumulativeAck(ackNum)
+        self.extents.removeBefore(ackNum)
+        return ackNum
+
+    """
+        Returns up to 'maxBlocks' [start, end) ranges placed beyond
+            cumulativeAck, the one with the last added segment first
+            (RFC 2018)
+    """
+
+    def getSACKBlocks(self, ackNum, maxBlocks):
+        blocks = self.extents.getExtents(self.getCumulativeAck(ackNum))
+        for i, block in enumerate(blocks):
+            if(block[0] <= self.lastAddedSeqNum < block[1]):
+                blocks.insert(0, blocks.pop(i))
+                break
+        return blocks[:maxBlocks]
+
+    def get(self, seqNum):
+        return None
+
+    def pop(self, seqNum):
+        return None
@@ -1,21 +1,28 @@
 import struct
-import math
 
-RDT_HEADER_LENGTH = 15
+from lib.ChecksumEngine import getChecksumEngine
 
+# seqNum, ackNum, window, checksum, syn, ack, fin, nak
+RDT_HEADER = struct.Struct("i i i i ? ? ? ?")
+RDT_HEADER_LENGTH = RDT_HEADER.size  # 20
+# ACK packets carry as payload up to MAX_SACK_BLOCKS [start, end) ranges
+# received beyond ackNum
+SACK_BLOCK = struct.Struct("i i")
+MAX_SACK_BLOCKS = 4
 
-class RDTPacket:
-    seqNum = 0
-    ackNum = 0
-
-    # Flags
-    ack = False
-    syn = False
-    fin = False
 
-    #rwnd = None
-    #checksum = None
-    data = "".encode()
+class RDTPacket:
+    # No per-instance __dict__, a window can hold thousands of packets
+    __slots__ = (
+        'seqNum',
+        'ackNum',
+        'window',
+        'checksum',
+        'syn',
+        'ack',
+        'fin',
+        'nak',
+        'data')
 
     def __init__(
             self,
@@ -25,36 +32,80 @@ class RDTPacket:
             syn,
             ack,
             fin,
-            data="".encode()):
+            data="".encode(),
+            checksumEngine=None,
+            window=0,
+            nak=False,
+            payloadChecksum=None):
         self.seqNum = seqNum
         self.ackNum = ackNum
+        # Free space (bytes) in the receive buffer of the sender of the packet
+        self.window = window
         self.syn = syn
         self.ack = ack
         self.fin = fin
+        self.nak = nak
         self.data = data
         if(checksum is None):
-            self.checksum = self.calculateChecksum()
+            self.checksum = self.calculateChecksum(
+                checksumEngine, payloadChecksum)
         else:
             self.checksum = checksum
 
     # https://stackoverflow.com/questions/3753589/packing-and-unpacking-variable-length-array-string-using-the-struct-module-in-py
     @classmethod
     def fromSerializedPacket(cls, serializedPacket):
-        packet = struct.unpack("i i i ? ? ?",
-                               serializedPacket[:RDT_HEADER_LENGTH])
-        packet = (*packet, serializedPacket[RDT_HEADER_LENGTH:])
-        return cls(*packet)
+        return cls.__new__(cls).load(serializedPacket)
+
+    """
+        Parses the datagram into this packet (used to recycle packets).
+        The payload is a memoryview over the datagram, it isn't copied
+    """
+
+    def load(self, serializedPacket):
+        (self.seqNum, self.ackNum, self.window, self.checksum, self.syn,
+         self.ack, self.fin, self.nak) = RDT_HEADER.unpack_from(
+             serializedPacket)
+        if(len(serializedPacket) == RDT_HEADER_LENGTH):  # ACK, FIN...
+            self.data = b''
+        else:
+            self.data = memoryview(serializedPacket)[RDT_HEADER_LENGTH:]
+        return self
 
     @classmethod
-    def makeSYNPacket(cls, seqNum):
-        return cls(seqNum, 0, None, True, False, False)
+    def makeSYNPacket(cls, seqNum, window=0):
+        return cls(seqNum, 0, None, True, False, False, window=window)
 
     @classmethod
-    def makeACKPacket(cls, ackNum):
-        return cls(0, ackNum, None, False, True, False)
+    def makeACKPacket(
+            cls, ackNum, window=0, sackBlocks=(), checksumEngine=None):
+        return cls(
+            0,
+            ackNum,
+            None,
+            False,
+            True,
+            False,
+            b''.join([SACK_BLOCK.pack(*block) for block in sackBlocks]),
+            checksumEngine,
+            window=window)
+
+    # Asks for the retransmission of the (corrupted) packet 'seqNum'
+    @classmethod
+    def makeNAKPacket(cls, seqNum, ackNum, window=0, checksumEngine=None):
+        return cls(
+            seqNum,
+            ackNum,
+            None,
+            False,
+            False,
+            False,
+            checksumEngine=checksumEngine,
+            window=window,
+            nak=True)
 
     @classmethod
-    def makeSYNACKPacket(cls, seqNum, ackNum, newServerPort):
+    def makeSYNACKPacket(cls, seqNum, ackNum, newServerPort, window=0):
         return cls(
             seqNum,
             ackNum,
@@ -62,54 +113,70 @@ class RDTPacket:
             True,
             True,
             False,
-            str(newServerPort).encode())
+            str(newServerPort).encode(),
+            window=window)
 
     @classmethod
-    def makeFINPacket(cls, seqNum=0, ackNum=0):
-        return cls(seqNum, ackNum, None, False, False, True)
+    def makeFINPacket(cls, seqNum=0, ackNum=0, checksumEngine=None):
+        return cls(
+            seqNum, ackNum, None, False, False, True,
+            checksumEngine=checksumEngine)
 
     @classmethod
-    def makeFINACKPacket(cls, seqNum=0, ackNum=0):
-        return cls(seqNum, ackNum, None, False, True, True)
-
+    def makeFINACKPacket(cls, seqNum=0, ackNum=0, checksumEngine=None):
+        return cls(
+            seqNum, ackNum, None, False, True, True,
+            checksumEngine=checksumEngine)
+
+    def serializeHeader(self):
+        return RDT_HEADER.pack(
+            self.seqNum,
+            self.ackNum,
+            self.window,
+            self.checksum,
+            self.syn,
+            self.ack,
+            self.fin,
+            self.nak)
+
+    # Header and payload are joined in a single allocation
     def serialize(self):
-        return struct.pack("i i i ? ? ? {}s".format(len(self.data)),
-                           self.seqNum,
-                           self.ackNum,
-                           self.checksum,
-                           self.syn,
-                           self.ack,
-                           self.fin,
-                           self.data)
+        if(not self.data):  # ACK, FIN...
+            return self.serializeHeader()
+        return self.serializeHeader() + self.data
+
+    # Header and payload as separate buffers, for the scatter/gather send
+    # of socket.sendmsg: the payload isn't copied to join them
+    def serializeBuffers(self):
+        if(not self.data):  # ACK, FIN...
+            return [self.serializeHeader()]
+        return [self.serializeHeader(), self.data]
 
     def carryAroundAdd(self, a, b):
         c = a + b
         return (c & 0xffff) + (c >> 16)
 
-    def calculateChecksum(self):
-        checksum = 0
-        serializedFields = struct.pack("i i ? ? ? {}s".format(len(
-            self.data)), self.seqNum, self.ackNum, self.syn, self.ack, self.fin, self.data)
+    """
+        Calculates the checksum with the given engine (see ChecksumEngine),
+            by default the original algorithm is used.
+        'payloadChecksum' is the part of the payload, if it was calculated
+            before with the same engine (ChecksumEngine.calculatePayload)
+    """
 
-        if(len(serializedFields) % 2 != 0):  # Agrego 1 byte de padding si el numero de bytes es impar
-            serializedFields += struct.pack("B", 0)
+    def calculateChecksum(self, checksumEngine=None, payloadChecksum=None):
+        if(checksumEngine is None):
+            checksumEngine = getChecksumEngine()
+        if(payloadChecksum is not None):
+            return checksumEngine.calculateWithPayload(self, payloadChecksum)
+        return checksumEngine.calculate(self)
 
-        if(len(serializedFields) % 2 == 0):  # Divido en numeros de 16 bits
-            serializedFields = struct.unpack(
-                "%dH" %
-                math.floor(
-                    len(serializedFields) /
-                    2),
-                serializedFields)
+    def isCorrupt(self, checksumEngine=None):
+        return self.checksum != self.calculateChecksum(checksumEngine)
 
-        for i in range(0, len(serializedFields)):
-            # Si los ultimos 16 bytes tenian padding de 1 byte, shifteo
-            if(i == len(serializedFields) - 1 and serializedFields[i] < 0x100):
-                serializedFields[i] << 8
-            w = checksum + serializedFields[i]
-            checksum = self.carryAroundAdd(checksum, w)
-
-        return checksum
+    def getSACKBlocks(self):
+        if(not self.data or len(self.data) % SACK_BLOCK.size != 0):
+            return ()
+        return SACK_BLOCK.iter_unpack(self.data)
 
     def isSYN(self):
         return self.syn
@@ -125,3 +192,11 @@ class RDTPacket:
 
     def isFINACK(self):
         return self.fin and self.ack
+
+    def isNAK(self):
+        return self.nak
+
+    # Data packets carry no flags, ACKs carry the SACK blocks as payload
+    def isData(self):
+        return bool(self.data) and not (
+            self.syn or self.ack or self.fin or self.nak)
@@ -1,27 +1,40 @@
 import time
 import logging
-import random
 
 from lib.exceptions import LostConnection, ServerUnreachable
-from threading import Lock, Thread, Timer
-from socket import socket, AF_INET, SOCK_DGRAM, SHUT_RD, timeout
-from lib.RDTPacket import RDTPacket, RDT_HEADER_LENGTH
+from threading import Condition, Event, Lock, Thread
+import socket as sockets
+from socket import socket, AF_INET, SOCK_DGRAM, SHUT_RD, SOL_SOCKET, timeout
+from lib.RDTPacket import RDTPacket, RDT_HEADER_LENGTH, SACK_BLOCK
+from lib.ChecksumEngine import getChecksumEngine, DEFAULT_CHECKSUM
+from lib.PacketPool import PacketPool
+from lib.RetransmissionScheduler import retransmissionScheduler
+from lib.ReceiveWindow import ADDED, DUPLICATE, OLD, FULL
+from lib.PlacementWindow import PlacementWindow
+from lib.CongestionControl import DEFAULT_CONGESTION_CONTROL
+from lib.ConnectionDemultiplexer import ConnectionDemultiplexer
+from lib.SelectiveRepeat import (
+    SelectiveRepeat, TIMEOUT, FAST, NAKED, MSS, INPUT_BUFFER_SIZE, WINDOWSIZE,
+    NRETRIES, RECEIVE_TIMEOUT, DELAYED_ACK_TIME)
 from sys import getsizeof
 
 
-MSS = 1500
-WINDOWSIZE = 10
-INPUT_BUFFER_SIZE = 44  # UDP buffer size = 65535, 44 MSS
-NRETRIES = 18  # see doc
-RESEND_TIME = 0.5
-RECEIVE_TIMEOUT = NRETRIES * RESEND_TIME
+PACKET_POOL_SIZE = 1024
+
+# Received packets are recycled by every connection
+packetPool = PacketPool(PACKET_POOL_SIZE, MSS + RDT_HEADER_LENGTH)
 
 
 class RDTSocketSR:
     ##############################
     #         COMMON API         #
     ##############################
-    def __init__(self):
+    def __init__(
+            self,
+            checksumEngine=DEFAULT_CHECKSUM,
+            windowSize=WINDOWSIZE,
+            inputBufferSize=INPUT_BUFFER_SIZE,
+            congestionControl=DEFAULT_CONGESTION_CONTROL):
         # https://stackoverflow.com/questions/1365265/on-localhost-how-do-i-pick-a-free-port-number
         self.srcIP = ''  # Default source addr
         self.srcPort = 0  # Default source port
@@ -30,136 +43,154 @@ class RDTSocketSR:
 
         self.socket = socket(AF_INET, SOCK_DGRAM)
 
-        self.lockSequenceNumber = Lock()
-        self.seqNum = random.randint(0, 1000)
+        # Both sides of a connection must use the same engine
+        self.checksumEngine = getChecksumEngine(checksumEngine)
 
-        self.lockAcknowledgmentNumber = Lock()
-        self.ackNum = 0                          # expected next byte
+        # Windows, ACKs and retransmissions, shared with AsyncRDTSocketSR.
+        # seqNum is only changed by send, with lockOutPutWindow acquired
+        self.selectiveRepeat = SelectiveRepeat(
+            self.checksumEngine, windowSize, inputBufferSize, congestionControl)
         logging.debug(
             "Configuring new Socket. Initial sequence number: {}".format(
-                self.seqNum))
+                self.selectiveRepeat.seqNum))
+
+        # The flags of the connection state are Events: they are read by
+        # every packet sent and received, and is_set doesn't take a lock
 
         # Server variables
-        self.lockListening = Lock()
-        self.listening = False
+        self.listening = Event()
         self.listeningThread = None
+        self.maxQueuedConnections = 0
+        # Serves every connection from 'self.socket', see listen
+        self.demultiplexer = None
 
         self.lockUnacceptedConnections = Lock()
         self.unacceptedConnections = {}          # Waiting for accept socket map
+        # Notified by listenThread when there is a new connection
+        self.unacceptedConnectionsChanged = Condition(
+            self.lockUnacceptedConnections)
         self.lockAcceptedConnections = Lock()
         self.acceptedConnections = {}            # Accepted socket map
 
         # Client / ServerClient variables
         self.mainSocket = None                   # None if client, parent if ServerClient
 
-        # True if a resend tries more than NRETRIES times
-        self.lockLostConnection = Lock()
-        self.lostConnection = False
+        # Set if a resend tries more than NRETRIES times
+        self.lostConnection = Event()
 
         self.receivingThread = None
 
+        # Guards the receive half of selectiveRepeat (inputBuffer, ackNum)
+        # and the delayed ACK timer
         self.lockInputBuffer = Lock()
-        # Map where will be store the incoming packets
-        self.inputBuffer = {}
+        # Notified when the expected packet arrives or close is requested
+        self.inputBufferChanged = Condition(self.lockInputBuffer)
+        # Last packet returned by recv, its data is valid until next recv
+        self.deliveredPacket = None
+        # The timer that will ACK the packets received not ACKed yet
+        self.delayedACKTimer = None
+        # Raised by the 'place' function of recvDirect, it's reraised there
+        self.placementError = None
+        # Guards the send half of selectiveRepeat (outPutWindow, seqNum...)
+        # and the resend timers
         self.lockOutPutWindow = Lock()
-        self.outPutWindow = []                   # Window of packets sent
-
-        self.lockReceivedFINACK = Lock()
-        self.receivedFINACK = False
+        # Notified when packets are removed from outPutWindow
+        self.outPutWindowChanged = Condition(self.lockOutPutWindow)
+        # Pending resend timer of every packet in outPutWindow, by seqNum
+        self.resendTimers = {}
 
-        self.lockRequestedClose = Lock()
-        self.requestedClose = False
-
-        self.lockClosed = Lock()
-        self.closed = False
+        self.receivedFINACK = Event()
+        self.requestedClose = Event()
+        self.closed = Event()
 
     def getSeqNum(self):
-        v = self.seqNum
-        return v
-
-    def addToSeqNum(self, n):
-        self.lockSequenceNumber.acquire()
-        self.seqNum += n
-        self.lockSequenceNumber.release()
+        return self.selectiveRepeat.seqNum
 
     def getAckNum(self):
-        v = self.ackNum
-        return v
+        return self.selectiveRepeat.ackNum
 
     def setAckNum(self, newAckNum):
-        self.lockAcknowledgmentNumber.acquire()
-        self.ackNum = newAckNum
-        self.lockAcknowledgmentNumber.release()
+        self.lockInputBuffer.acquire()
+        self.selectiveRepeat.ackNum = newAckNum
+        self.lockInputBuffer.release()
 
     def addToAckNum(self, n):
-        self.lockAcknowledgmentNumber.acquire()
-        self.ackNum += n
-        self.lockAcknowledgmentNumber.release()
+        self.lockInputBuffer.acquire()
+        self.selectiveRepeat.ackNum += n
+        self.lockInputBuffer.release()
+
+    def changeFlag(self, flag, newValue):
+        if(newValue):
+            flag.set()
+        else:
+            flag.clear()
 
     def isListening(self):
-        self.lockListening.acquire()
-        v = self.listening
-        self.lockListening.release()
-        return v
+        return self.listening.is_set()
 
     def changeFlagListening(self, newListeningValue):
-        self.lockListening.acquire()
-        self.listening = newListeningValue
-        self.lockListening.release()
+        self.changeFlag(self.listening, newListeningValue)
 
     def isLostConnection(self):
-        self.lockLostConnection.acquire()
-        v = self.lostConnection
-        self.lockLostConnection.release()
-        return v
+        return self.lostConnection.is_set()
 
     def changeFlagLostConnection(self, newLostConnectionValue):
-        self.lockLostConnection.acquire()
-        self.lostConnection = newLostConnectionValue
-        self.lockLostConnection.release()
+        self.changeFlag(self.lostConnection, newLostConnectionValue)
 
     def hasReceivedFINACK(self):
-        self.lockReceivedFINACK.acquire()
-        v = self.receivedFINACK
-        self.lockReceivedFINACK.release()
-        return v
+        return self.receivedFINACK.is_set()
 
+    # Wakes up sendFIN
     def changeFlagReceivedFINACK(self, newReceivedFINACKValue):
-        self.lockReceivedFINACK.acquire()
-        self.receivedFINACK = newReceivedFINACKValue
-        self.lockReceivedFINACK.release()
+        self.changeFlag(self.receivedFINACK, newReceivedFINACKValue)
 
     def wasRequestedClose(self):
-        self.lockRequestedClose.acquire()
-        v = self.requestedClose
-        self.lockRequestedClose.release()
-        return v
+        return self.requestedClose.is_set()
 
     def changeFlagRequestedClose(self, newRequestedCloseValue):
-        self.lockRequestedClose.acquire()
-        self.requestedClose = newRequestedCloseValue
-        self.lockRequestedClose.release()
+        self.changeFlag(self.requestedClose, newRequestedCloseValue)
+
+        # Wakes up recv
+        self.lockInputBuffer.acquire()
+        self.inputBufferChanged.notify_all()
+        self.lockInputBuffer.release()
 
     def isClosed(self):
-        self.lockClosed.acquire()
-        v = self.closed
-        self.lockClosed.release()
-        return v
+        return self.closed.is_set()
 
     def changeFlagClosed(self, newClosedValue):
-        self.lockClosed.acquire()
-        self.closed = newClosedValue
-        self.lockClosed.release()
+        self.changeFlag(self.closed, newClosedValue)
 
     def getExpectedInput(self):
         self.lockInputBuffer.acquire()
-        v = self.inputBuffer.get(self.getAckNum())
+        v = self.selectiveRepeat.getExpectedInput()
         self.lockInputBuffer.release()
         return v
 
+    """
+        Removes the expected packet from inputBuffer and moves ackNum
+            to the next one
+    """
+
+    def popExpectedInput(self):
+        self.lockInputBuffer.acquire()
+        packet, ackPacket = self.selectiveRepeat.popExpectedInput()
+        if(ackPacket is not None):
+            self.cancelDelayedACK()
+        self.lockInputBuffer.release()
+        if(ackPacket is not None):
+            self._send(ackPacket)
+        return packet
+
+    def getAdvertisedWindow(self):
+        self.lockInputBuffer.acquire()
+        window = self.selectiveRepeat.inputBuffer.getFreeSpace()
+        self.lockInputBuffer.release()
+        return window
+
     def isOutPutWindowEmpty(self):
         self.lockOutPutWindow.acquire()
-        ret = len(self.outPutWindow) == 0
+        ret = self.selectiveRepeat.outPutWindow.isEmpty()
         self.lockOutPutWindow.release()
         return ret
 
@@ -169,9 +200,6 @@ class RDTSocketSR:
     def matchDestAddr(self, addr):
         return addr == (self.destIP, self.destPort)
 
-    def matchesACK(self, packet, ackNum):
-        return packet.seqNum + len(packet.data) == ackNum
-
     #####################################
     #         LISTEN/ACCEPT API         #
     #####################################
@@ -188,13 +216,21 @@ class RDTSocketSR:
         self.destPort = address[1]
 
     """
-        It's used by the server in order to assign an specific address to the socket
+        It's used by the server in order to assign an specific address to the socket.
+        With 'reusePort' several processes can bind the same address, the
+            kernel spreads the clients among them (SO_REUSEPORT)
     """
 
-    def bind(self, address):
+    def bind(self, address, reusePort=False):
         ip, port = address
         self.srcIP = ip
         self.srcPort = port
+        if(reusePort):
+            # Not every platform has it, so it's only looked up when needed
+            reusePortOption = getattr(sockets, 'SO_REUSEPORT', None)
+            if(reusePortOption is None):
+                raise OSError('SO_REUSEPORT is not supported by this platform')
+            self.socket.setsockopt(SOL_SOCKET, reusePortOption, 1)
         self.socket.bind(address)
         self.srcPort = self.socket.getsockname()[1]
         logging.debug(
@@ -203,24 +239,32 @@ class RDTSocketSR:
 
     """
         It's used by the server.
-        Create a thread where it will listen for new connections
+        Create a thread where it will listen for new connections.
+        If 'multiplex', the connections don't have a socket nor a receiving
+            thread of their own: the datagrams of every client arrive to
+            this socket and a ConnectionDemultiplexer hands them to their
+            connection
     """
 
-    def listen(self, maxQueuedConnections):
-        self.listeningThread = Thread(target=self.listenThread,
-                                      args=(maxQueuedConnections,))
-        self.listeningThread.daemon = True  # Closes with the main thread
+    def listen(self, maxQueuedConnections, multiplex=False):
+        self.maxQueuedConnections = maxQueuedConnections
         self.changeFlagListening(True)
-        self.listeningThread.start()
+        if(multiplex):
+            self.demultiplexer = ConnectionDemultiplexer(
+                self.socket, self.handleListenDatagram, MSS + RDT_HEADER_LENGTH)
+            self.demultiplexer.start()
+        else:
+            self.listeningThread = Thread(target=self.listenThread)
+            self.listeningThread.daemon = True  # Closes with the main thread
+            self.listeningThread.start()
         logging.debug("Now server is listening...")
 
     """
         It's used by the server.
-        If receive a SYN message, performs the 2whs with the client,
-            creates a new socket and appends it to unacceptedConnections...
+        Receives the SYN messages, see handleSYN
     """
 
-    def listenThread(self, maxQueuedConnections):
+    def listenThread(self):
         self.socket.settimeout(1)
         data, address = (None, None)
 
@@ -230,43 +274,72 @@ class RDTSocketSR:
             except timeout:
                 continue  # Checks while condition again
             packet = RDTPacket.fromSerializedPacket(data)
+            if(packet.isSYN()):
+                self.handleSYN(packet, address)
+
+    """
+        It's used by the server, called by the demultiplexer with the
+            datagrams of unknown clients
+    """
+
+    def handleListenDatagram(self, data, address):
+        packet = RDTPacket.fromSerializedPacket(bytes(data))
+        if(packet.isSYN()):
+            self.handleSYN(packet, address)
+
+    """
+        It's used by the server.
+        Performs the 2whs with the client, creates a new socket and appends
+            it to unacceptedConnections...
+        If the client was already connected (SYNACK lost) resends the SYNACK
+    """
 
-            if(packet.isSYN() and self.isNewClient(address)):
+    def handleSYN(self, packet, address):
+        if(self.isNewClient(address)):
+            logging.info(
+                "Requested connection from [{}:{}]".format(
+                    *address))
+            if(self.getAmountOfPendingConnections() >= self.maxQueuedConnections):
                 logging.info(
-                    "Requested connection from [{}:{}]".format(
+                    "Refused connection from [{}:{}] due pending connections overflow".format(
                         *address))
-                if(self.getAmountOfPendingConnections() >= maxQueuedConnections):
-                    logging.info(
-                        "Refused connection from [{}:{}] due pending connections overflow".format(
-                            *address))
-                    continue
-
-                newConnection = self.createConnection(address, packet.seqNum)
+                return
 
-                self.lockUnacceptedConnections.acquire()
-                self.unacceptedConnections[newConnection.getDestinationAddress(
-                )] = newConnection
-                self.lockUnacceptedConnections.release()
+            newConnection = self.createConnection(
+                address, packet.seqNum, packet.window)
 
-                synAckPacket = RDTPacket.makeSYNACKPacket(
-                    newConnection.seqNum, newConnection.ackNum, newConnection.srcPort)
-                self.socket.sendto(synAckPacket.serialize(), address)
+            self.lockUnacceptedConnections.acquire()
+            self.unacceptedConnections[newConnection.getDestinationAddress(
+            )] = newConnection
+            self.unacceptedConnectionsChanged.notify()
+            self.lockUnacceptedConnections.release()
 
-                logging.debug(
-                    "Sent server Sequence number: {} y ACK number {}".format(
-                        newConnection.seqNum, newConnection.ackNum))
+            synAckPacket = RDTPacket.makeSYNACKPacket(
+                newConnection.getSeqNum(),
+                newConnection.getAckNum(),
+                newConnection.srcPort,
+                newConnection.getAdvertisedWindow())
+            self.socket.sendto(synAckPacket.serialize(), address)
 
-            elif(packet.isSYN() and not self.isNewClient(address)):
-                logging.debug(
-                    "Requested connection from [{}:{}], wich is already connected".format(
-                        *address))
-                newConnection = self.getClient(address)
-                synAckPacket = RDTPacket.makeSYNACKPacket(
-                    newConnection.seqNum, newConnection.ackNum, newConnection.srcPort)
-                self.socket.sendto(synAckPacket.serialize(), address)
-                logging.debug(
-                    "Resending SYNACK server sequence number: {} y ACK number {}".format(
-                        newConnection.seqNum, newConnection.ackNum))
+            logging.debug(
+                "Sent server Sequence number: {} y ACK number {}".format(
+                    newConnection.getSeqNum(), newConnection.getAckNum()))
+        else:
+            logging.debug(
+                "Requested connection from [{}:{}], wich is already connected".format(
+                    *address))
+            newConnection = self.getClient(address)
+            if(newConnection is None):  # Closed meanwhile
+                return
+            synAckPacket = RDTPacket.makeSYNACKPacket(
+                newConnection.getSeqNum(),
+                newConnection.getAckNum(),
+                newConnection.srcPort,
+                newConnection.getAdvertisedWindow())
+            self.socket.sendto(synAckPacket.serialize(), address)
+            logging.debug(
+                "Resending SYNACK server sequence number: {} y ACK number {}".format(
+                    newConnection.getSeqNum(), newConnection.getAckNum()))
 
     """
         It's used by the server.
@@ -305,14 +378,32 @@ class RDTSocketSR:
         Creates a new connection in order to handle a new client communication
     """
 
-    def createConnection(self, clientAddress, initialAckNum):
-        newConnection = RDTSocketSR()
-        newConnection.bind((self.srcIP, 0))
-        newConnection.socket.settimeout(2)  # 2 second timeout
+    def createConnection(self, clientAddress, initialAckNum, peerWindow):
+        selectiveRepeat = self.selectiveRepeat
+        newConnection = RDTSocketSR(
+            self.checksumEngine,
+            selectiveRepeat.windowSize,
+            selectiveRepeat.inputBuffer.capacity,
+            type(selectiveRepeat.congestionControl))
+        newConnection.selectiveRepeat.setPeerWindow(peerWindow)
+        newConnection.setRateLimits(
+            selectiveRepeat.sharedRateLimit, selectiveRepeat.connectionRate,
+            selectiveRepeat.connectionBurst)
+        newConnection.setPacing(selectiveRepeat.pacer is not None)
         newConnection.setDestinationAddress(clientAddress)
-        newConnection.ackNum = initialAckNum
+        newConnection.selectiveRepeat.ackNum = initialAckNum
         newConnection.mainSocket = self
-        newConnection.waitForPackets()
+        if(self.demultiplexer is not None):
+            # The client keeps talking to the listening socket
+            newConnection.socket.close()
+            newConnection.srcIP, newConnection.srcPort = (
+                self.srcIP, self.srcPort)
+            newConnection.socket = self.demultiplexer.register(
+                clientAddress, newConnection.handleDatagram)
+        else:
+            newConnection.bind((self.srcIP, 0))
+            newConnection.socket.settimeout(2)  # 2 second timeout
+            newConnection.waitForPackets()
         return newConnection
 
     def getAmountOfPendingConnections(self):
@@ -330,14 +421,21 @@ class RDTSocketSR:
     """
         It's used by the server.
         Pops an unaccepted connection from 'self.unacceptedConnections' and returns it
+        If it's empty, blocks the thread until listenThread adds one
     """
 
     def popUnacceptedConnection(self):
         self.lockUnacceptedConnections.acquire()
-        # Obtains the first key value pair in 'unacceptedConnections'
-        addr, connection = next(iter(self.unacceptedConnections.items()))
-        del self.unacceptedConnections[addr]
-        self.lockUnacceptedConnections.release()
+        # KeyboardInterrupt/SystemExit while waiting, the lock is released for
+        # the closing of the server
+        try:
+            while(not self.unacceptedConnections):
+                self.unacceptedConnectionsChanged.wait()
+            # Obtains the first key value pair in 'unacceptedConnections'
+            addr, connection = next(iter(self.unacceptedConnections.items()))
+            del self.unacceptedConnections[addr]
+        finally:
+            self.lockUnacceptedConnections.release()
         return (addr, connection)
 
     """
@@ -349,9 +447,6 @@ class RDTSocketSR:
     def accept(self):
         logging.debug("Waiting for new connections")
 
-        while(self.unacceptedConnectionsIsEmpty()):
-            time.sleep(0.2)
-
         addr, connection = self.popUnacceptedConnection()
 
         self.lockAcceptedConnections.acquire()
@@ -375,15 +470,20 @@ class RDTSocketSR:
         logging.info(
             "Establishing connection with server {}:{}".format(
                 *destAddr))
-        self.socket.settimeout(2)  # 2 second timeout
         synAckPacket, addr = (None, None)
         receivedSYNACK = False
         tries = NRETRIES
+        synSent = 0
 
         while(not receivedSYNACK and tries > 0):
             try:
-                synPacket = RDTPacket.makeSYNPacket(self.getSeqNum())
+                self.socket.settimeout(
+                    self.selectiveRepeat.rttEstimator.getRTO(NRETRIES - tries))
+                synPacket = RDTPacket.makeSYNPacket(
+                    self.getSeqNum(), self.getAdvertisedWindow())
+                sentAt = time.monotonic()
                 self._send(synPacket)
+                synSent += 1
                 logging.debug(
                     "Sent SYN Packet, waiting for ACK. Tries left={}".format(tries))
                 data, addr = self.socket.recvfrom(MSS)
@@ -393,6 +493,9 @@ class RDTSocketSR:
             except timeout:
                 tries -= 1
                 logging.debug("Assuming Lost SYNACK, retrying".format(tries))
+        if(receivedSYNACK and synSent == 1):  # Karn's rule
+            self.selectiveRepeat.rttEstimator.addSample(
+                time.monotonic() - sentAt)
         if(tries == 0):
             logging.info("Error establishing connection")
             logging.debug("Assuming server not reachable")
@@ -403,10 +506,11 @@ class RDTSocketSR:
                 *destAddr))
 
         self.setAckNum(synAckPacket.seqNum)
+        self.selectiveRepeat.setPeerWindow(synAckPacket.window)
         logging.debug(
             "Received {} as first sequence number".format(self.getAckNum()))
 
-        self.destPort = int(synAckPacket.data.decode())
+        self.destPort = int(synAckPacket.data.tobytes().decode())
         logging.debug("Changing server port to {}".format(self.destPort))
 
         self.waitForPackets()
@@ -416,85 +520,139 @@ class RDTSocketSR:
     #   COMMUNICATION API   #
     #########################
 
-    def updateOutPutWindow(self, ackNum):
-        # If is present, change the ACK boolean in OutPutWindow for that
-        # element
-        self.lockOutPutWindow.acquire()
-        self.outPutWindow = [
-            (x[0], x[1] or self.matchesACK(
-                x[0], ackNum)) for x in self.outPutWindow]
+    """
+        Handles the ACKed packets (cumulative ACK and SACK blocks, see
+            SelectiveRepeat.onACK): cancels their timers and fast
+            retransmits the packets lost before them
+    """
 
-        # Remove all cumulative ACKed packets from outPutWindow
-        while(self.outPutWindow and self.outPutWindow[0][1]):
-            self.outPutWindow.pop(0)
+    def updateOutPutWindow(self, ackNum, peerWindow, sackBlocks=()):
+        self.lockOutPutWindow.acquire()
+        acked, lost, changed = self.selectiveRepeat.onACK(
+            ackNum, peerWindow, sackBlocks)
+        # ACKed packets won't be resent
+        for seqNum in acked:
+            if(seqNum in self.resendTimers):
+                retransmissionScheduler.cancel(self.resendTimers.pop(seqNum))
+        for seqNum in lost:
+            self.retransmit(seqNum, FAST)
+        if(changed):
+            self.outPutWindowChanged.notify_all()
         self.lockOutPutWindow.release()
 
     """
-        Checks if a packet should be added to input buffer.
-        If it's the inmmediate expected packet ignores other conditions
+        Resends a packet before its timer expires, lost according to the
+            ACKs of the packets sent after it (FAST) or received corrupted
+            (NAKED), and restarts its timer keeping the tries it had left.
+        Must be called with lockOutPutWindow acquired
     """
 
-    def shouldAddToInputBuffer(self, packet):
+    def retransmit(self, seqNum, reason):
+        packet = self.selectiveRepeat.retransmit(seqNum, reason)
+        if(packet is None):
+            return
+        logging.debug(
+            "Connection({}:{}), {} Packet(seqno={}, ackno={}, l={})".format(
+                self.destIP, self.destPort,
+                "Fast retransmitting" if reason == FAST else "Retransmitting NAKed",
+                packet.seqNum, packet.ackNum, len(packet.data)))
+        self._send(packet)
+        if(seqNum in self.resendTimers):
+            retransmissionScheduler.cancel(self.resendTimers[seqNum])
+            self.resendTimers[seqNum] = retransmissionScheduler.schedule(
+                self.selectiveRepeat.getResendTimeout(seqNum), self.resend,
+                (seqNum,))
 
-        self.lockInputBuffer.acquire()
-        alreadyInBuffer = self.inputBuffer.get(packet.seqNum) is not None
-        isInputBufferFull = len(self.inputBuffer) >= INPUT_BUFFER_SIZE
-        self.lockInputBuffer.release()
+    """
+        Resends a packet the receiver got corrupted (NAK). The network
+            delivered it, so the congestion window isn't reduced
+    """
 
-        isExpectedPacket = self.getAckNum() == packet.seqNum
-        isOldPacket = self.getAckNum() >= packet.seqNum + len(packet.data)
-        return isExpectedPacket or (
-            not isInputBufferFull and not alreadyInBuffer and not isOldPacket)
+    def retransmitNAKed(self, seqNum):
+        self.lockOutPutWindow.acquire()
+        self.retransmit(seqNum, NAKED)
+        self.lockOutPutWindow.release()
 
     """
-        Checks if a packet should by ACKed
+        Adds a packet to input buffer if it's new and there is space for it
+            (see SelectiveRepeat.offer and acknowledge).
+        Returns the tuple (result, ACK packet to send or None), result is
+            ADDED, DUPLICATE, OLD (both are ACKed again) or FULL.
+        The ACKs not sent now are sent by 'sendDelayedACK'
     """
 
-    def shouldACK(self, packet):
-        isOldPacket = self.getAckNum() >= packet.seqNum + len(packet.data)
-
+    def addToInputBuffer(self, packet):
         self.lockInputBuffer.acquire()
-        isInBuffer = self.inputBuffer.get(packet.seqNum)
+        expected = packet.seqNum == self.selectiveRepeat.ackNum
+        result, previousCumulativeAck = self.selectiveRepeat.offer(packet)
+        if(result == ADDED and
+                not self.selectiveRepeat.inputBuffer.storesPackets and
+                not self.placeSegment(packet)):
+            self.lockInputBuffer.release()
+            return (FULL, None)
+        if(result == ADDED and expected):
+            self.inputBufferChanged.notify_all()
+
+        ackPacket, delayACK = self.selectiveRepeat.acknowledge(
+            packet, result, previousCumulativeAck)
+        if(ackPacket is not None):
+            self.cancelDelayedACK()
+        elif(delayACK and self.delayedACKTimer is None):
+            self.delayedACKTimer = retransmissionScheduler.schedule(
+                DELAYED_ACK_TIME, self.sendDelayedACK)
         self.lockInputBuffer.release()
-
-        return isOldPacket or isInBuffer
+        return (result, ackPacket)
 
     """
-        Finds the packet in outPutWindow that matchs that seqNum and returns
-            the tuple (packet, wasACKed boolean)
+        Writes a segment claimed by the PlacementWindow of recvDirect, and
+            delivers the placed data as soon as it's contiguous. Returns
+            False if it couldn't be written, the error is raised by
+            recvDirect.
+        Must be called with lockInputBuffer acquired, it's released while
+            writing: a slow disk must not delay the threads that take it
+            (retransmissionScheduler sends the delayed ACKs of every
+            connection)
     """
 
-    def findPacket(self, seqNum):
-        self.lockOutPutWindow.acquire()
-
-        for tuplePacketAck in self.outPutWindow:
-            if(tuplePacketAck[0].seqNum == seqNum):
-                self.lockOutPutWindow.release()
-                return tuplePacketAck
+    def placeSegment(self, packet):
+        inputBuffer = self.selectiveRepeat.inputBuffer
+        self.lockInputBuffer.release()
+        try:
+            inputBuffer.place(packet)
+        except Exception as e:
+            self.lockInputBuffer.acquire()
+            self.selectiveRepeat.abandon(packet)
+            self.placementError = e
+            self.inputBufferChanged.notify_all()
+            return False
+        self.lockInputBuffer.acquire()
+        self.selectiveRepeat.placed(packet)
+        return True
 
-        self.lockOutPutWindow.release()
-        return None
+    # An ACK is being sent. Must be called with lockInputBuffer acquired
+    def cancelDelayedACK(self):
+        if(self.delayedACKTimer is not None):
+            retransmissionScheduler.cancel(self.delayedACKTimer)
+            self.delayedACKTimer = None
 
     """
-        Checks if a sent packet's sequence number was ACKed
+        Sends the ACK of the packets received and not ACKed yet, if any.
+        Called by 'retransmissionScheduler' DELAYED_ACK_TIME after the first
+            of them, and before closing
     """
 
-    def wasACKED(self, seqNum):
-        tuplePacketAck = self.findPacket(seqNum)
-        if tuplePacketAck is not None:
-            return tuplePacketAck[1]
-
-        self.lockOutPutWindow.acquire()
-        if(len(self.outPutWindow) != 0):
-            ret = seqNum < self.outPutWindow[0][0].seqNum
-            self.lockOutPutWindow.release()
-            return ret
-        self.lockOutPutWindow.release()
-        return seqNum < self.getSeqNum()
+    def sendDelayedACK(self):
+        self.lockInputBuffer.acquire()
+        ackPacket = self.selectiveRepeat.makeDelayedACKPacket()
+        self.delayedACKTimer = None
+        self.lockInputBuffer.release()
+        if(ackPacket is not None):
+            self._send(ackPacket)
 
-    def outPutWindowIsFull(self):
+    # See SelectiveRepeat.outPutWindowIsFull
+    def outPutWindowIsFull(self, nbytes=0):
         self.lockOutPutWindow.acquire()
-        ret = len(self.outPutWindow) == WINDOWSIZE
+        ret = self.selectiveRepeat.outPutWindowIsFull(nbytes)
         self.lockOutPutWindow.release()
         return ret
 
@@ -504,16 +662,29 @@ class RDTSocketSR:
 
     """
         Receives using UDP socket
-        Returns the first received packet that belongs to the connection
+        Returns the first received packet that belongs to the connection.
+        The packet is borrowed from 'packetPool', it should be given back
+            once it's not needed anymore
     """
 
     def _recv(self, bufsize):
+        packet = packetPool.borrow()
         receivedSuccessfully = False
-        data, addr = (None, None)
-        while(not receivedSuccessfully):
-            data, addr = self.socket.recvfrom(bufsize + RDT_HEADER_LENGTH)
-            receivedSuccessfully = self.matchDestAddr(addr)
-        return RDTPacket.fromSerializedPacket(data)
+        nbytes, addr = (None, None)
+        try:
+            while(not receivedSuccessfully):
+                nbytes, addr = self.socket.recvfrom_into(
+                    packet.buffer, bufsize + RDT_HEADER_LENGTH)
+                receivedSuccessfully = self.matchDestAddr(addr)
+        except BaseException:
+            packetPool.giveBack(packet)
+            raise
+        return packet.load(memoryview(packet.buffer)[:nbytes])
+
+    def giveBackDeliveredPacket(self):
+        if(self.deliveredPacket is not None):
+            packetPool.giveBack(self.deliveredPacket)
+            self.deliveredPacket = None
 
     """
         It's used by the Client/Client-Server
@@ -532,11 +703,7 @@ class RDTSocketSR:
     """
         It's used by the Client/Client-Server
         Loops receiving every packet that arrives to 'self.socket'
-            and handles it.
-        * If is FIN then 'interrupt' the connection
-        * If is ACK then update outPutWindow
-        * Else adds packets to InputBuffer if its necessary and
-            sends an ACK, or discards it.
+            and handles it (see handlePacket)
     """
 
     def waitForPacketsThread(self):
@@ -547,97 +714,150 @@ class RDTSocketSR:
                 packet = self._recv(MSS)
             except timeout:
                 continue  # Checks while condition again
+            self.handlePacket(packet)
+        logging.info("Now socket is not receiving packets anymore...")
+
+    """
+        It's used by the Client-Server of a multiplexed server, instead of
+            'waitForPacketsThread'.
+        Called by the demultiplexer loop with every datagram of the client,
+            'data' is copied into a packet of 'packetPool'
+    """
+
+    def handleDatagram(self, data, address):
+        packet = packetPool.borrow()
+        nbytes = len(data)
+        packet.buffer[:nbytes] = data
+        packet.load(memoryview(packet.buffer)[:nbytes])
+        if(packet.isSYN()):
+            self.mainSocket.handleSYN(packet, address)  # SYNACK was lost
+            packetPool.giveBack(packet)
+        elif(self.wasRequestedClose()):
+            packetPool.giveBack(packet)
+        else:
+            self.handlePacket(packet)
+
+    """
+        Handles a packet received by the connection:
+        * If is corrupt then discards it (and NAKs it)
+        * If is ACK/NAK then update outPutWindow
+        * If is FIN then 'interrupt' the connection
+        * Else adds packets to InputBuffer if its necessary and
+            sends an ACK, or discards it.
+    """
 
-            if packet.isACK():
+    def handlePacket(self, packet):
+        if packet.isCorrupt(self.checksumEngine):
+            # Isn't buffered nor ACKed, a corrupted data packet is asked
+            # again right away instead of waiting for its timer. Corrupted
+            # ACKs are just dropped, the next one carries the same info
+            nakPacket = None
+            if(packet.isData()):
+                self.lockInputBuffer.acquire()
+                nakPacket = self.selectiveRepeat.makeNAKPacket(packet.seqNum)
+                self.lockInputBuffer.release()
+            logging.debug(
+                "Connection({}:{}), Discarding corrupted Packet(seqno={}, ackno={}, l={})".format(
+                    self.destIP, self.destPort, packet.seqNum, packet.ackNum, len(
+                        packet.data)))
+            packetPool.giveBack(packet)
+            if(nakPacket is not None):
+                self._send(nakPacket)
+        elif packet.isACK():
+            logging.debug(
+                "Connection({}:{}), Received ACK Packet(seqno={}, ackno={}, l={})".format(
+                    self.destIP, self.destPort, packet.seqNum, packet.ackNum, len(
+                        packet.data)))
+            self.updateOutPutWindow(
+                packet.ackNum, packet.window, packet.getSACKBlocks())
+            packetPool.giveBack(packet)
+        elif packet.isNAK():
+            logging.debug(
+                "Connection({}:{}), Received NAK Packet(seqno={}, ackno={})".format(
+                    self.destIP, self.destPort, packet.seqNum, packet.ackNum))
+            self.updateOutPutWindow(packet.ackNum, packet.window)
+            self.retransmitNAKed(packet.seqNum)
+            packetPool.giveBack(packet)
+        elif packet.isFIN():
+            logging.debug(
+                "Connection({}:{}), Received FIN Packet".format(
+                    self.destIP, self.destPort))
+            self.sendDelayedACK()
+            finAckPacket = RDTPacket.makeFINACKPacket(
+                self.getSeqNum(), self.getAckNum(), self.checksumEngine)
+            logging.debug(
+                "Connection({}:{}), Sending FINACK Packet".format(
+                    self.destIP, self.destPort))
+            self._send(finAckPacket)
+            self.changeFlagRequestedClose(True)
+            packetPool.giveBack(packet)
+        elif packet.isFINACK():
+            logging.debug(
+                "Connection({}:{}), Received FINACK Packet".format(
+                    self.destIP, self.destPort))
+            self.changeFlagReceivedFINACK(True)
+            packetPool.giveBack(packet)
+        else:
+            result, ackPacket = self.addToInputBuffer(packet)
+            if(result == ADDED):
+                logging.debug("Connection({}:{}), Received Packet(seqno={}, ackno={}, l={})".format(
+                    self.destIP, self.destPort, packet.seqNum, packet.ackNum, len(packet.data)))
+                # Already placed
+                if(not self.selectiveRepeat.inputBuffer.storesPackets):
+                    packetPool.giveBack(packet)
+            elif(result == DUPLICATE or result == OLD):  # ACK paquetes retransmitidos
                 logging.debug(
-                    "Connection({}:{}), Received ACK Packet(seqno={}, ackno={}, l={})".format(
+                    "Connection({}:{}), Received retransmited Packet(seqno={}, ackno={}, l={})".format(
                         self.destIP, self.destPort, packet.seqNum, packet.ackNum, len(
                             packet.data)))
-                self.updateOutPutWindow(packet.ackNum)
-            elif packet.isFIN():
-                logging.debug(
-                    "Connection({}:{}), Received FIN Packet".format(
-                        self.destIP, self.destPort))
-                finAckPacket = RDTPacket.makeFINACKPacket(
-                    self.getSeqNum(), self.getAckNum())
+                packetPool.giveBack(packet)
+            else:
                 logging.debug(
-                    "Connection({}:{}), Sending FINACK Packet".format(
-                        self.destIP, self.destPort))
-                self._send(finAckPacket)
-                self.changeFlagRequestedClose(True)
-            elif packet.isFINACK():
+                    "Connection({}:{}), Discarding received Packet(seqno={}, ackno={}, l={})".format(
+                        self.destIP, self.destPort, packet.seqNum, packet.ackNum, len(
+                            packet.data)))
+                packetPool.giveBack(packet)
+
+            if(ackPacket is not None):
                 logging.debug(
-                    "Connection({}:{}), Received FINACK Packet".format(
-                        self.destIP, self.destPort))
-                self.changeFlagReceivedFINACK(True)
-            else:
-                if(self.shouldAddToInputBuffer(packet)):
-                    logging.debug("Connection({}:{}), Received Packet(seqno={}, ackno={}, l={})".format(
-                        self.destIP, self.destPort, packet.seqNum, packet.ackNum, len(packet.data)))
-
-                    self.lockInputBuffer.acquire()
-                    self.inputBuffer[packet.seqNum] = packet
-                    self.lockInputBuffer.release()
-
-                    ackPacket = RDTPacket.makeACKPacket(
-                        packet.seqNum + len(packet.data))
-                    logging.debug(
-                        "Connection({}:{}), Sending ACK Packet(seqno={}, ackno={}, l={})".format(
-                            self.destIP, self.destPort, ackPacket.seqNum, ackPacket.ackNum, len(
-                                ackPacket.data)))
-                    self._send(ackPacket)
-                elif(self.shouldACK(packet)):  # ACK paquetes retransmitidos
-                    logging.debug(
-                        "Connection({}:{}), Received retransmited Packet(seqno={}, ackno={}, l={})".format(
-                            self.destIP, self.destPort, packet.seqNum, packet.ackNum, len(
-                                packet.data)))
-                    ackPacket = RDTPacket.makeACKPacket(
-                        packet.seqNum + len(packet.data))
-                    logging.debug(
-                        "Connection({}:{}), Sending ACK Packet(seqno={}, ackno={}, l={})".format(
-                            self.destIP, self.destPort, ackPacket.seqNum, ackPacket.ackNum, len(
-                                ackPacket.data)))
-                    self._send(ackPacket)
-                else:
-                    logging.debug(
-                        "Connection({}:{}), Discarding received Packet(seqno={}, ackno={}, l={})".format(
-                            self.destIP, self.destPort, packet.seqNum, packet.ackNum, len(
-                                packet.data)))
-        logging.info("Now socket is not receiving packets anymore...")
+                    "Connection({}:{}), Sending ACK Packet(ackno={}, window={}, SACK blocks={})".format(
+                        self.destIP, self.destPort, ackPacket.ackNum, ackPacket.window, len(
+                            ackPacket.data) // SACK_BLOCK.size))
+                self._send(ackPacket)
 
     """
         Implements the RECV selective repeat protocol
-        Returns next expected (in order) packet's payload
+        Returns next expected (in order) packet's payload, it's valid until
+            the next call to recv
     """
 
     def recv(self):
-        if(not self.getExpectedInput() and not self.wasRequestedClose()):
+        self.giveBackDeliveredPacket()
+        startTime = time.time()
+        selectiveRepeat = self.selectiveRepeat
+        self.lockInputBuffer.acquire()
+        if(selectiveRepeat.getExpectedInput() is None and not self.wasRequestedClose()):
             logging.debug(
                 "Connection({}:{}), packet {} not received yet, waiting... ".format(
-                    self.destIP, self.destPort, self.getAckNum()))
-        startTime = time.time()
-        while(not self.getExpectedInput() and not self.wasRequestedClose()):
+                    self.destIP, self.destPort, selectiveRepeat.ackNum))
+        while(selectiveRepeat.getExpectedInput() is None and not self.wasRequestedClose()):
             waitingTime = time.time() - startTime
             if(waitingTime > RECEIVE_TIMEOUT):
+                self.lockInputBuffer.release()
                 self.changeFlagLostConnection(True)
                 raise LostConnection
-            time.sleep(0.1)
-
-        expectedPacket = self.getExpectedInput()
+            self.inputBufferChanged.wait(RECEIVE_TIMEOUT - waitingTime)
+        expectedPacket = selectiveRepeat.getExpectedInput()
+        self.lockInputBuffer.release()
 
+        # Checksum was verified by waitForPacketsThread
         if(expectedPacket):
-            isCorrupt = expectedPacket.checksum != expectedPacket.calculateChecksum()
-            if(not isCorrupt):
-                logging.debug(
-                    "Connection({}:{}), packet {} received successfully".format(
-                        self.destIP, self.destPort, self.getAckNum()))
-                #logging.debug("Received packet checksum: {}".format(expectedPacket.checksum))
-                #logging.debug("Calculated packet checksum: {}".format(expectedPacket.calculateChecksum()))
-                self.lockInputBuffer.acquire()
-                del self.inputBuffer[self.getAckNum()]
-                self.lockInputBuffer.release()
-                self.addToAckNum(len(expectedPacket.data))
-                return expectedPacket.data
+            logging.debug(
+                "Connection({}:{}), packet {} received successfully".format(
+                    self.destIP, self.destPort, self.getAckNum()))
+            self.popExpectedInput()
+            self.deliveredPacket = expectedPacket
+            return expectedPacket.data
 
         if(self.wasRequestedClose()):
             logging.debug(
@@ -645,18 +865,78 @@ class RDTSocketSR:
                     self.destIP, self.destPort))
             return b''
 
+    """
+        Receives the rest of the stream by direct placement: every verified
+            segment is handed to 'place(offset, data)' as soon as it
+            arrives, even out of order, in the thread that receives the
+            packets. 'offset' is counted from the next byte that recv would
+            have returned.
+        inputBuffer is replaced by a PlacementWindow, that only keeps the
+            extents received, so the window doesn't take memory.
+        Blocks until the other side closes the connection and returns the
+            amount of bytes received. An exception raised by 'place' is
+            raised here
+    """
+
+    def recvDirect(self, place):
+        self.giveBackDeliveredPacket()
+        selectiveRepeat = self.selectiveRepeat
+        self.lockInputBuffer.acquire()
+        firstSeqNum = selectiveRepeat.ackNum
+        packets = selectiveRepeat.inputBuffer.popAll()
+        selectiveRepeat.inputBuffer = PlacementWindow(
+            selectiveRepeat.inputBuffer.capacity,
+            lambda seqNum, data: place(seqNum - firstSeqNum, data))
+        # Packets received before the call
+        for packet in packets:
+            if(self.placementError is None and
+                    selectiveRepeat.offer(packet)[0] == ADDED):
+                self.placeSegment(packet)
+            packetPool.giveBack(packet)
+
+        lastAckNum = selectiveRepeat.ackNum
+        lastProgress = time.time()
+        while(not self.wasRequestedClose() and self.placementError is None):
+            if(selectiveRepeat.ackNum != lastAckNum):
+                lastAckNum = selectiveRepeat.ackNum
+                lastProgress = time.time()
+            waitingTime = time.time() - lastProgress
+            if(waitingTime > RECEIVE_TIMEOUT):
+                self.lockInputBuffer.release()
+                self.changeFlagLostConnection(True)
+                raise LostConnection
+            self.inputBufferChanged.wait(RECEIVE_TIMEOUT - waitingTime)
+        error = self.placementError
+        receivedBytes = selectiveRepeat.ackNum - firstSeqNum
+        self.lockInputBuffer.release()
+
+        if(error is not None):
+            raise error
+        logging.debug(
+            "Connection({}:{}) requested close, {} bytes placed".format(
+                self.destIP, self.destPort, receivedBytes))
+        return receivedBytes
+
     ##################
     #   * Send API   #
     ##################
 
+    # See SelectiveRepeat.setRateLimits
+    def setRateLimits(self, sharedLimit=None, rate=0, burst=0):
+        self.selectiveRepeat.setRateLimits(sharedLimit, rate, burst)
+
+    # See SelectiveRepeat.setPacing
+    def setPacing(self, pacing):
+        self.selectiveRepeat.setPacing(pacing)
+
     """
         Sends a rdtpacket using UDP socket
     """
 
     def _send(self, packet):
         if(not self.wasRequestedClose()):
-            lenbytessent = self.socket.sendto(
-                packet.serialize(), (self.destIP, self.destPort))
+            lenbytessent = self.socket.sendmsg(
+                packet.serializeBuffers(), (), 0, (self.destIP, self.destPort))
             return lenbytessent
 
     """
@@ -664,34 +944,43 @@ class RDTSocketSR:
         Starts a resend-timer for every packet sent, calls 'resend' function
             after timer's timeout
         Returns the amount of bytes 'sent'.
+        'payloadChecksum' is the part of the checksum of 'bytes', if it was
+            calculated before (see ChecksumEngine.calculatePayload)
     """
 
-    def send(self, bytes):
+    def send(self, bytes, payloadChecksum=None):
         if(self.isClosed() or self.hasReceivedFINACK()):
             return 0
 
-        if(self.outPutWindowIsFull()):
+        selectiveRepeat = self.selectiveRepeat
+        self.lockOutPutWindow.acquire()
+        while(selectiveRepeat.outPutWindowIsFull(len(bytes))):
             logging.debug(
                 "Connection({}:{}), outPutWindow is full, waiting for ACKs".format(
                     self.destIP, self.destPort))
-
-        while self.outPutWindowIsFull():
-            time.sleep(0.2)
+            if(selectiveRepeat.outPutWindow.bytesInFlight > 0):
+                self.outPutWindowChanged.wait()
+            # Closed peer window: waits for its window update, if it's lost
+            # the window is probed with this packet after the RTO
+            elif(not self.outPutWindowChanged.wait(
+                    selectiveRepeat.rttEstimator.getRTO())):
+                break
+        pacedWindow = selectiveRepeat.getPacedWindow()
+        self.lockOutPutWindow.release()
 
         if(self.isLostConnection()):
             logging.debug(
                 "Connection({}:{}), Assuming lost connection, cannot send anymore.".format(
                     self.destIP, self.destPort))
             raise LostConnection
+        # Sleeps until the rate limits and the pacer allow the packet
+        if(selectiveRepeat.isThrottled()):
+            delay = selectiveRepeat.getThrottleDelay(
+                len(bytes) + RDT_HEADER_LENGTH, pacedWindow)
+            if(delay > 0):
+                time.sleep(delay)
 
-        packetSent = RDTPacket(
-            self.getSeqNum(),
-            self.getAckNum(),
-            None,
-            False,
-            False,
-            False,
-            bytes)
+        packetSent = selectiveRepeat.makeDataPacket(bytes, payloadChecksum)
 
         logging.debug("Sent Packet checksum: {}".format(packetSent.checksum))
         logging.debug(
@@ -705,42 +994,63 @@ class RDTSocketSR:
             self.lockOutPutWindow.release()
             return 0
 
-        self.outPutWindow.append((packetSent, False))
+        self.resendTimers[packetSent.seqNum] = retransmissionScheduler.schedule(
+            selectiveRepeat.onSend(packetSent), self.resend, (packetSent.seqNum,))
         self.lockOutPutWindow.release()
-        timerThread = Timer(RESEND_TIME, self.resend, (packetSent.seqNum,))
-        timerThread.daemon = True
-        timerThread.start()
-        self.addToSeqNum(len(bytes))
         return len(bytes)
 
     """
         Implements the selective repeat retransmission
-        Will be executed after some time, checking if an ACK was
-            received for the corresponding packet.
-            If not, then resends the packet and restars the timer
+        Will be executed by 'retransmissionScheduler' after the RTO,
+            checking if an ACK was received for the corresponding packet.
+            If not, then resends the packet and restars the timer with
+            the RTO backed off
     """
 
-    def resend(self, seqNum, tries=NRETRIES):
+    def resend(self, seqNum):
         if(self.isClosed() or self.hasReceivedFINACK()):
             return
-        if(tries <= 0):
+        selectiveRepeat = self.selectiveRepeat
+        self.lockOutPutWindow.acquire()
+        if(selectiveRepeat.getTriesLeft(seqNum) <= 0):
             self.changeFlagLostConnection(True)
-            self.lockOutPutWindow.acquire()
-            self.outPutWindow = []
+            selectiveRepeat.loseConnection()
+            self.outPutWindowChanged.notify_all()
             self.lockOutPutWindow.release()
+            self.cancelResendTimers()
             return
-        if(not self.wasACKED(seqNum)):
-            tuplePacketAck = self.findPacket(seqNum)
-            if(tuplePacketAck is not None and tuplePacketAck[0] is not None):
-                logging.debug(
-                    "Connection({}:{}), Resending Packet(seqno={}, ackno={}, l={}), tries left={}".format(
-                        self.destIP, self.destPort, tuplePacketAck[0].seqNum, tuplePacketAck[0].ackNum, len(
-                            tuplePacketAck[0].data), tries - 1))
-                self._send(tuplePacketAck[0])
-                timerThread = Timer(
-                    RESEND_TIME, self.resend, (seqNum, tries - 1))
-                timerThread.daemon = True
-                timerThread.start()
+        # SACKed packets are marked, the cumulatively ACKed ones aren't in
+        # the window anymore
+        packet = selectiveRepeat.retransmit(seqNum, TIMEOUT)
+        if(packet is not None):
+            logging.debug(
+                "Connection({}:{}), Resending Packet(seqno={}, ackno={}, l={}), tries left={}".format(
+                    self.destIP, self.destPort, packet.seqNum, packet.ackNum, len(
+                        packet.data), selectiveRepeat.getTriesLeft(seqNum)))
+            self._send(packet)
+            if(seqNum in self.resendTimers):  # Not ACKed meanwhile
+                self.resendTimers[seqNum] = retransmissionScheduler.schedule(
+                    selectiveRepeat.getResendTimeout(seqNum),
+                    self.resend, (seqNum,))
+        self.lockOutPutWindow.release()
+
+    def cancelResendTimers(self):
+        self.lockOutPutWindow.acquire()
+        for timer in self.resendTimers.values():
+            retransmissionScheduler.cancel(timer)
+        self.resendTimers = {}
+        self.selectiveRepeat.resendTries = {}
+        self.lockOutPutWindow.release()
+
+    """
+        Returns a snapshot of the sender state of the connection
+    """
+
+    def getStats(self):
+        self.lockOutPutWindow.acquire()
+        stats = self.selectiveRepeat.getStats()
+        self.lockOutPutWindow.release()
+        return stats
 
     ###################
     #   * Close API   #
@@ -767,7 +1077,7 @@ class RDTSocketSR:
         tries = NRETRIES
         while(tries > 0 and not self.hasReceivedFINACK()):
             packetFIN = RDTPacket.makeFINPacket(
-                self.getSeqNum(), self.getAckNum())
+                self.getSeqNum(), self.getAckNum(), self.checksumEngine)
             logging.debug(
                 "Connection({}:{}), sending FIN Packet(seqno={}, ackno={}, l={}), tries left={}".format(
                     self.destIP, self.destPort, packetFIN.seqNum, packetFIN.ackNum, len(
@@ -775,8 +1085,9 @@ class RDTSocketSR:
             self._send(packetFIN)
             tries -= 1
 
-            # Es como el timer... no es taaan horrible
-            time.sleep(1)
+            # Waits up to a second, waitForPacketsThread wakes it up when
+            # FINACK arrives
+            self.receivedFINACK.wait(1)
         if(self.hasReceivedFINACK()):
             logging.debug(
                 "Connection({}:{}) correctly closed...".format(
@@ -793,8 +1104,10 @@ class RDTSocketSR:
             logging.debug(
                 "Connection({}:{}), waiting to send correctly every packet".format(
                     self.destIP, self.destPort))
-        while(not self.isOutPutWindowEmpty()):
-            time.sleep(0.2)
+        self.lockOutPutWindow.acquire()
+        while(not self.selectiveRepeat.outPutWindow.isEmpty()):
+            self.outPutWindowChanged.wait()
+        self.lockOutPutWindow.release()
 
         if(not self.isLostConnection()):
             logging.debug(
@@ -812,12 +1125,17 @@ class RDTSocketSR:
             self.mainSocket.closeConnectionSocket((self.destIP, self.destPort))
         logging.debug(
             "Connecion({}:{}) ending receiving-thread".format(self.destIP, self.destPort))
+        self.sendDelayedACK()
         self.changeFlagRequestedClose(True)
         if(self.receivingThread is not None):
             self.receivingThread.join()
         logging.debug(
             "Connecion({}:{}), closing UDP-Socket".format(self.destIP, self.destPort))
         self.socket.close()
+        self.giveBackDeliveredPacket()
+        self.cancelResendTimers()
+        logging.debug("Connection({}:{}), stats: {}".format(
+            self.destIP, self.destPort, self.getStats()))
         logging.info("Socket closed...")
 
     def closeReceiver(self):
@@ -827,6 +1145,7 @@ class RDTSocketSR:
 
         logging.debug(
             "Connecion({}:{}) ending receiving-thread".format(self.destIP, self.destPort))
+        self.sendDelayedACK()
         self.changeFlagRequestedClose(True)
         if(self.receivingThread is not None):
             self.receivingThread.join()
@@ -834,6 +1153,10 @@ class RDTSocketSR:
         logging.debug(
             "Connecion({}:{}), closing UDP-Socket".format(self.destIP, self.destPort))
         self.socket.close()
+        self.giveBackDeliveredPacket()
+        self.cancelResendTimers()
+        logging.debug("Connection({}:{}), stats: {}".format(
+            self.destIP, self.destPort, self.getStats()))
         logging.info("Socket closed...")
         self.changeFlagClosed(True)
 
@@ -846,12 +1169,14 @@ class RDTSocketSR:
             "Server socket, ending listening-thread".format(self.destIP, self.destPort))
         if(self.listeningThread is not None):
             self.listeningThread.join()
+        if(self.demultiplexer is not None):
+            self.demultiplexer.stop()
         # Close unaccepted sockets running
         logging.debug(
             "Server socket, closing all unaccepted connections".format(
                 self.destIP, self.destPort))
         for _, conn in self.unacceptedConnections.items():
-            conn.requestedClose = True
+            conn.changeFlagRequestedClose(True)
             if(conn.receivingThread is not None):
                 conn.receivingThread.join()
             conn.socket.close()
@@ -3,24 +3,42 @@ import logging
 import random
 
 from .exceptions import LostConnection, ServerUnreachable
-from threading import Lock, Thread
+from threading import Condition, Lock, Thread
+import socket as sockets
 from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_REUSEADDR, timeout
 from .RDTPacket import RDTPacket, RDT_HEADER_LENGTH
+from .ChecksumEngine import getChecksumEngine, DEFAULT_CHECKSUM
+from .RTTEstimator import RTTEstimator, MAX_RTO
+from .TokenBucket import TokenBucket
+from .ConnectionDemultiplexer import ConnectionDemultiplexer
 from sys import getsizeof
 
 
 MSS = 1500
 NRETRIES = 18
-RESEND_TIME = 0.5
-RECEIVE_TIMEOUT = NRETRIES * RESEND_TIME
+RESEND_TIME = 0.5  # Timeout de retransmisión inicial, ver RTTEstimator
+# send espera NRETRIES veces el ACK, con el RTO duplicado hasta MAX_RTO cada
+# vez, antes de dar la conexión por perdida: el receptor espera lo mismo
+RECEIVE_TIMEOUT = NRETRIES * MAX_RTO
+# Las esperas de los límites de tasa más cortas que esto no se duermen, las
+# pagan los paquetes siguientes
+RATE_LIMIT_SLACK = 0.001
 
 
 class RDTSocketSW:
-    def __init__(self):
+    def __init__(self, checksumEngine=DEFAULT_CHECKSUM):
         self.mainSocket = None
         self.socket = socket(AF_INET, SOCK_DGRAM)  # Underlying UDP socket
+        # Ambos lados de la conexión deben usar el mismo engine
+        self.checksumEngine = getChecksumEngine(checksumEngine)
         self.seqNum = random.randint(0, 1000)
         self.ackNum = 0
+        self.rttEstimator = RTTEstimator(RESEND_TIME)
+        # TokenBuckets de los bytes enviados, ver setRateLimits
+        self.sharedRateLimit = None
+        self.connectionRate = 0
+        self.connectionBurst = 0
+        self.rateLimits = []
 
         # https://stackoverflow.com/questions/1365265/on-localhost-how-do-i-pick-a-free-port-number
         self.srcIP = ''  # Default source addr
@@ -30,8 +48,14 @@ class RDTSocketSW:
 
         self.listening = False
         self.listeningThread = None
+        self.maxQueuedConnections = 0
+        # Atiende todas las conexiones desde 'self.socket', ver listen
+        self.demultiplexer = None
         self.lockUnacceptedConnections = Lock()
         self.unacceptedConnections = {}          # Mapa de sockets en espera
+        # Lo notifica listenThread cuando hay una nueva conexión
+        self.unacceptedConnectionsChanged = Condition(
+            self.lockUnacceptedConnections)
 
         self.lockAcceptedConnections = Lock()
         self.acceptedConnections = {}            # Mapa de sockets aceptados
@@ -66,15 +90,19 @@ class RDTSocketSW:
         self.destIP, self.destPort = destAddr
 
         logging.info("Envío client_isn num: {}".format(self.seqNum))
-        self.socket.settimeout(RECEIVE_TIMEOUT)
         synAckPacket, addr = (None, None)
         receivedSYNACK = False
         tries = NRETRIES
+        synSent = 0
 
         while(not receivedSYNACK and tries > 0):
             try:
+                self.socket.settimeout(
+                    self.rttEstimator.getRTO(NRETRIES - tries))
                 synPacket = RDTPacket.makeSYNPacket(self.seqNum)
+                sentAt = time.monotonic()
                 self._send(synPacket)
+                synSent += 1
                 data, addr = self.socket.recvfrom(MSS)
                 synAckPacket = RDTPacket.fromSerializedPacket(data)
                 receivedSYNACK = synAckPacket.isSYNACK(
@@ -85,36 +113,54 @@ class RDTSocketSW:
         if(tries == 0):
             logging.info("Error establishing connection")
             raise ServerUnreachable
+        if(synSent == 1):  # Regla de Karn: sin muestras de reintentos
+            self.rttEstimator.addSample(time.monotonic() - sentAt)
 
         self.ackNum = synAckPacket.seqNum
         # El cliente ahora apunta al socket especifico de la conexión en vez de
         # al listen
-        self.destPort = int(synAckPacket.data.decode())
+        self.destPort = int(synAckPacket.data.tobytes().decode())
         logging.info("Connected to: {}:{}".format(*destAddr))
         return True
     """
         Se utiliza para asignarle una dirección especifica al socket (generalmente al socket del listen del servidor),
-        también se usa cuando se crea un socket para el cliente en el servidor
+        también se usa cuando se crea un socket para el cliente en el servidor.
+        Con 'reusePort' varios procesos pueden usar la misma dirección y el
+        kernel reparte los clientes entre ellos (SO_REUSEPORT)
     """
 
-    def bind(self, address):
+    def bind(self, address, reusePort=False):
         ip, port = address
         self.srcIP = ip
         self.srcPort = port
+        if(reusePort):
+            # No todas las plataformas lo tienen, se busca solo si se usa
+            reusePortOption = getattr(sockets, 'SO_REUSEPORT', None)
+            if(reusePortOption is None):
+                raise OSError('SO_REUSEPORT is not supported by this platform')
+            self.socket.setsockopt(SOL_SOCKET, reusePortOption, 1)
         self.socket.bind(address)
         self.srcPort = self.socket.getsockname()[1]
 
     """
         Se ejecuta del lado del servidor,
         crea un hilo donde se queda escuchando a nuevos clientes.
+        Con 'multiplex' las conexiones no tienen un socket propio: los
+        datagramas de todos los clientes llegan a este socket y un
+        ConnectionDemultiplexer los encola en la conexión de cada uno.
     """
 
-    def listen(self, maxQueuedConnections):
-        self.listeningThread = Thread(target=self.listenThread,
-                                      args=(maxQueuedConnections,))
-        self.listeningThread.daemon = True  # Closes with the main thread
+    def listen(self, maxQueuedConnections, multiplex=False):
+        self.maxQueuedConnections = maxQueuedConnections
         self.listening = True
-        self.listeningThread.start()
+        if(multiplex):
+            self.demultiplexer = ConnectionDemultiplexer(
+                self.socket, self.handleListenDatagram, MSS)
+            self.demultiplexer.start()
+        else:
+            self.listeningThread = Thread(target=self.listenThread)
+            self.listeningThread.daemon = True  # Closes with the main thread
+            self.listeningThread.start()
         logging.debug("Now server is listening...")
 
     def isNewClient(self, address):
@@ -141,12 +187,10 @@ class RDTSocketSW:
 
     """
         Se ejecuta del lado del servidor,
-        realiza el two way handshake con el cliente y crea un socket nuevo para la conexión.
-
-        Si recibe un mensaje "SYN" crea un socket en unacceptedConnections,
+        recibe los mensajes "SYN", ver handleSYN
     """
 
-    def listenThread(self, maxQueuedConnections):
+    def listenThread(self):
         self.socket.settimeout(1)
         data, address = (None, None)
 
@@ -156,57 +200,103 @@ class RDTSocketSW:
             except timeout:
                 continue  # Checks while condition again
             packet = RDTPacket.fromSerializedPacket(data)
+            if(packet.isSYN()):
+                self.handleSYN(packet, address)
 
-            if(packet.isSYN() and self.isNewClient(address)):
-                logging.info(
-                    "Requested connection from [{}:{}]".format(
-                        *address))
-                if(self.getAmountOfPendingConnections() >= maxQueuedConnections):
-                    logging.info(
-                        "Refused connection from [{}:{}] due pending connections overflow".format(
-                            *address))
-                    continue
-
-                newConnection = self.createConnection(address, packet.seqNum)
-
-                self.lockUnacceptedConnections.acquire()
-                self.unacceptedConnections[newConnection.getDestinationAddress(
-                )] = newConnection
-                self.lockUnacceptedConnections.release()
+    """
+        Lo llama el demultiplexor con los datagramas de clientes desconocidos
+    """
 
-                synAckPacket = RDTPacket.makeSYNACKPacket(
-                    newConnection.seqNum, newConnection.ackNum, newConnection.srcPort)
-                self.socket.sendto(synAckPacket.serialize(), address)
+    def handleListenDatagram(self, data, address):
+        packet = RDTPacket.fromSerializedPacket(bytes(data))
+        if(packet.isSYN()):
+            self.handleSYN(packet, address)
 
-                logging.debug(
-                    "Sent server Sequence number: {} y ACK number {}".format(
-                        newConnection.seqNum, newConnection.ackNum))
+    """
+        Se ejecuta del lado del servidor,
+        realiza el two way handshake con el cliente y crea un socket nuevo para la conexión,
+        que queda en unacceptedConnections.
+        Si el cliente ya estaba conectado (se perdió el SYNACK) reenvía el SYNACK
+    """
 
-            elif(packet.isSYN() and not self.isNewClient(address)):
-                logging.debug(
-                    "Requested connection from [{}:{}], wich is already connected".format(
+    def handleSYN(self, packet, address):
+        if(self.isNewClient(address)):
+            logging.info(
+                "Requested connection from [{}:{}]".format(
+                    *address))
+            if(self.getAmountOfPendingConnections() >= self.maxQueuedConnections):
+                logging.info(
+                    "Refused connection from [{}:{}] due pending connections overflow".format(
                         *address))
-                newConnection = self.getClient(address)
-                synAckPacket = RDTPacket.makeSYNACKPacket(
-                    newConnection.seqNum, newConnection.ackNum, newConnection.srcPort)
-                self.socket.sendto(synAckPacket.serialize(), address)
-                logging.debug(
-                    "Resending SYNACK server sequence number: {} y ACK number {}".format(
-                        newConnection.seqNum, newConnection.ackNum))
+                return
+
+            newConnection = self.createConnection(address, packet.seqNum)
+
+            self.lockUnacceptedConnections.acquire()
+            self.unacceptedConnections[newConnection.getDestinationAddress(
+            )] = newConnection
+            self.unacceptedConnectionsChanged.notify()
+            self.lockUnacceptedConnections.release()
+
+            synAckPacket = RDTPacket.makeSYNACKPacket(
+                newConnection.seqNum, newConnection.ackNum, newConnection.srcPort)
+            self.socket.sendto(synAckPacket.serialize(), address)
+
+            logging.debug(
+                "Sent server Sequence number: {} y ACK number {}".format(
+                    newConnection.seqNum, newConnection.ackNum))
+        else:
+            logging.debug(
+                "Requested connection from [{}:{}], wich is already connected".format(
+                    *address))
+            newConnection = self.getClient(address)
+            if(newConnection is None):  # Se cerró mientras tanto
+                return
+            synAckPacket = RDTPacket.makeSYNACKPacket(
+                newConnection.seqNum, newConnection.ackNum, newConnection.srcPort)
+            self.socket.sendto(synAckPacket.serialize(), address)
+            logging.debug(
+                "Resending SYNACK server sequence number: {} y ACK number {}".format(
+                    newConnection.seqNum, newConnection.ackNum))
 
     """
-        Lo ejecuta el servidor para crear un socket nuevo para la comunicación con el cliente
+        Lo ejecuta el servidor para crear un socket nuevo para la comunicación con el cliente.
+        Si el servidor está multiplexado, el socket de la conexión es un
+        DemultiplexedSocket sobre el socket del listen
     """
 
     def createConnection(self, clientAddress, initialAckNum):
-        newConnection = RDTSocketSW()
-        newConnection.bind(('', 0))
-        newConnection.socket.settimeout(RECEIVE_TIMEOUT)
+        newConnection = RDTSocketSW(self.checksumEngine)
+        newConnection.setRateLimits(
+            self.sharedRateLimit, self.connectionRate, self.connectionBurst)
         newConnection.setDestinationAddress(clientAddress)
         newConnection.ackNum = initialAckNum
         newConnection.mainSocket = self
+        if(self.demultiplexer is not None):
+            newConnection.socket.close()
+            newConnection.srcIP, newConnection.srcPort = (
+                self.srcIP, self.srcPort)
+            newConnection.socket = self.demultiplexer.register(
+                clientAddress, newConnection.handleDatagram)
+        else:
+            newConnection.bind(('', 0))
+        # Lo mismo que espera recv: el primer pedido del cliente
+        newConnection.socket.settimeout(RECEIVE_TIMEOUT)
         return newConnection
 
+    """
+        Lo llama el demultiplexor con cada datagrama del cliente de la conexión,
+        los SYN repetidos los responde el socket del listen
+    """
+
+    def handleDatagram(self, data, address):
+        data = bytes(data)
+        packet = RDTPacket.fromSerializedPacket(data)
+        if(packet.isSYN()):
+            self.mainSocket.handleSYN(packet, address)
+        else:
+            self.socket.deliver(data)
+
     def getDestinationAddress(self):
         return (self.destIP, self.destPort)
 
@@ -224,25 +314,28 @@ class RDTSocketSW:
 
     def popUnacceptedConnection(self):
         self.lockUnacceptedConnections.acquire()
-        # Obtengo primer key value pair en el diccionario
-        addr, connection = next(iter(self.unacceptedConnections.items()))
-        del self.unacceptedConnections[addr]
-        self.lockUnacceptedConnections.release()
+        # KeyboardInterrupt/SystemExit mientras espera: se libera el lock
+        # para poder cerrar el servidor
+        try:
+            while(not self.unacceptedConnections):
+                self.unacceptedConnectionsChanged.wait()
+            # Obtengo primer key value pair en el diccionario
+            addr, connection = next(iter(self.unacceptedConnections.items()))
+            del self.unacceptedConnections[addr]
+        finally:
+            self.lockUnacceptedConnections.release()
         return (addr, connection)
 
     """
         Poppea el primer socket de la lista unacceptedConnections[],
-        si la lista está vacía, bloquea el hilo de ejecución hasta que haya un socket disponible.
+        si la lista está vacía, bloquea el hilo de ejecución hasta que listenThread agregue un socket.
     """
 
     def accept(self):
         logging.debug("Waiting for new connections")
 
-        while(self.unacceptedConnectionsIsEmpty()):
-            time.sleep(0.2)
-        logging.debug("Accepted connection")
-
         addr, connection = self.popUnacceptedConnection()
+        logging.debug("Accepted connection")
 
         self.lockAcceptedConnections.acquire()
         self.acceptedConnections[addr] = connection
@@ -258,19 +351,47 @@ class RDTSocketSW:
             receivedSuccessfully = self.matchDestAddr(addr)
         return RDTPacket.fromSerializedPacket(data)
 
+    """
+        Limita los bytes enviados por la conexión, reintentos incluidos, como
+        RDTSocketSR.setRateLimits: 'sharedLimit' es un TokenBucket compartido
+        con otras conexiones y 'rate' bytes por segundo (ráfagas de 'burst'
+        bytes) el límite de esta conexión sola (0 es sin límite).
+        Las conexiones de un socket del listen heredan los mismos límites.
+        Con Stop & Wait no hay ventana que espaciar, no tiene pacing
+    """
+
+    def setRateLimits(self, sharedLimit=None, rate=0, burst=0):
+        self.sharedRateLimit = sharedLimit
+        self.connectionRate = rate
+        self.connectionBurst = burst
+        self.rateLimits = []
+        if(sharedLimit is not None):
+            self.rateLimits.append(sharedLimit)
+        if(rate > 0):
+            self.rateLimits.append(TokenBucket(rate, burst))
+
+    # Toma 'nbytes' de los límites de tasa y duerme hasta poder enviarlos
+    def throttle(self, nbytes):
+        delay = 0
+        for bucket in self.rateLimits:
+            delay = max(delay, bucket.take(nbytes))
+        if(delay > RATE_LIMIT_SLACK):
+            time.sleep(delay)
+
     def _send(self, packet):
         logging.info("Sending...")
-        return self.socket.sendto(
-            packet.serialize(), (self.destIP, self.destPort))
+        return self.socket.sendmsg(
+            packet.serializeBuffers(), (), 0, (self.destIP, self.destPort))
 
     """
         WORK IN PROGRESS
     """
 
-    def send(self, bytes):
+    def send(self, bytes, payloadChecksum=None):
         receivedAck = False
         bytesSent = 0
         tries = NRETRIES
+        attempts = 0
 
         logging.debug(
             "Start sending, destination [{}:{}]".format(
@@ -281,9 +402,17 @@ class RDTSocketSW:
                     "Sending SEQNO [{}], ACKNO [{}]".format(
                         self.seqNum, self.ackNum))
                 packetSent = RDTPacket(
-                    self.seqNum, self.ackNum, None, False, False, False, bytes)
-                bytesSent = self.socket.sendto(
-                    packetSent.serialize(), (self.destIP, self.destPort))
+                    self.seqNum, self.ackNum, None, False, False, False, bytes,
+                    self.checksumEngine, payloadChecksum=payloadChecksum)
+                self.socket.settimeout(
+                    self.rttEstimator.getRTO(NRETRIES - tries))
+                if(self.rateLimits):
+                    self.throttle(len(bytes) + RDT_HEADER_LENGTH)
+                sentAt = time.monotonic()
+                bytesSent = self.socket.sendmsg(
+                    packetSent.serializeBuffers(), (), 0,
+                    (self.destIP, self.destPort))
+                attempts += 1
 
                 recvPacket = self._recv(MSS)
 
@@ -291,6 +420,9 @@ class RDTSocketSW:
                     logging.info("Sent successfully")
                     self.seqNum += len(bytes)
                     receivedAck = True
+                    if(attempts == 1):  # Regla de Karn: sin muestras de reintentos
+                        self.rttEstimator.addSample(
+                            time.monotonic() - sentAt)
                 elif(recvPacket.isACK()):
                     logging.debug(
                         "Invalid ACK num [{}], expected [{}]".format(
@@ -313,26 +445,33 @@ class RDTSocketSW:
         logging.info("Receiving...")
         receivedSuccessfully = False
         receivedPacket = None
-        tries = NRETRIES
+        # Un único plazo de RECEIVE_TIMEOUT para el paquete esperado, como
+        # RDTSocketSR.recv: los paquetes repetidos o corruptos no lo renuevan
+        deadline = time.monotonic() + RECEIVE_TIMEOUT
         logging.debug("Waiting for packet [{}]".format(self.ackNum))
         while(not receivedSuccessfully):
+            remaining = deadline - time.monotonic()
+            if(remaining <= 0):
+                raise LostConnection
+            # El timeout del socket puede ser el RTO del último envío
+            self.socket.settimeout(remaining)
             try:
                 receivedPacket = self._recv(MSS)
             except timeout:
-                tries -= 1
-                if(tries < 0):
-                    raise LostConnection
-                else:
-                    continue
+                raise LostConnection
 
-            receivedSuccessfully = receivedPacket.seqNum == self.ackNum
-            isCorrupt = receivedPacket.checksum != receivedPacket.calculateChecksum()
-            if(receivedSuccessfully and not isCorrupt):
+            # Un paquete corrupto se responde con el ACK anterior, el emisor
+            # lo reenvía apenas recibe ese ACK (negativo)
+            isCorrupt = receivedPacket.isCorrupt(self.checksumEngine)
+            receivedSuccessfully = (
+                not isCorrupt and receivedPacket.seqNum == self.ackNum)
+            if(receivedSuccessfully):
                 self.ackNum += len(receivedPacket.data)
-            responsePacket = RDTPacket.makeACKPacket(self.ackNum)
+            responsePacket = RDTPacket.makeACKPacket(
+                self.ackNum, checksumEngine=self.checksumEngine)
             self._send(responsePacket)
 
-            if(receivedPacket.isFIN()):
+            if(not isCorrupt and receivedPacket.isFIN()):
                 logging.info("Received FIN packet")
                 return b''
         return receivedPacket.data
@@ -350,7 +489,10 @@ class RDTSocketSW:
                 logging.debug(
                     "Sending SEQNO [{}], ACKNO [{}]".format(
                         self.seqNum, self.ackNum))
-                finPacket = RDTPacket.makeFINPacket()
+                finPacket = RDTPacket.makeFINPacket(
+                    checksumEngine=self.checksumEngine)
+                self.socket.settimeout(
+                    self.rttEstimator.getRTO(NRETRIES - tries))
 
                 bytesSent = self.socket.sendto(
                     finPacket.serialize(), (self.destIP, self.destPort))
@@ -411,6 +553,8 @@ class RDTSocketSW:
         self.listening = False
         if(self.listeningThread):
             self.listeningThread.join()
+        if(self.demultiplexer is not None):
+            self.demultiplexer.stop()
 
         for _, conn in self.unacceptedConnections.items():
             conn.socket.close()
@@ -0,0 +1,54 @@
+from threading import Lock
+
+INITIAL_RTO = 0.5  # Until the first sample, same as the old RESEND_TIME
+MIN_RTO = 0.05
+MAX_RTO = 3
+ALPHA = 1 / 8      # SRTT gain
+BETA = 1 / 4       # RTTVAR gain
+K = 4
+CLOCK_GRANULARITY = 0.001
+
+
+"""
+    Retransmission timeout estimation of a connection (RFC 6298):
+    * Jacobson/Karels SRTT and RTTVAR, RTO = SRTT + K * RTTVAR
+    * Karn's rule: callers must only add samples of packets that weren't
+        retransmitted
+    * Exponential backoff: getRTO(retries) doubles the RTO on every retry
+    * The RTO is clamped between MIN_RTO and MAX_RTO
+"""
+
+
+class RTTEstimator:
+    def __init__(self, initialRTO=INITIAL_RTO, minRTO=MIN_RTO, maxRTO=MAX_RTO):
+        self.minRTO = minRTO
+        self.maxRTO = maxRTO
+
+        self.lock = Lock()
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initialRTO
+
+    def addSample(self, rtt):
+        self.lock.acquire()
+        if(self.srtt is None):
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + \
+                BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        rto = self.srtt + max(CLOCK_GRANULARITY, K * self.rttvar)
+        self.rto = min(max(rto, self.minRTO), self.maxRTO)
+        self.lock.release()
+
+    """
+        Returns the timeout for a packet that was already resent
+            'retries' times
+    """
+
+    def getRTO(self, retries=0):
+        return min(self.rto * (2 ** retries), self.maxRTO)
+
+    def getSRTT(self):
+        return self.srtt
@@ -0,0 +1,113 @@
+# Result of offering a received packet to the window
+ADDED = 0          # New packet, stored (should be ACKed)
+DUPLICATE = 1      # Already stored (should be ACKed again)
+OLD = 2            # Already delivered (should be ACKed again)
+FULL = 3           # Not enough space left, discarded
+
+
+"""
+    Scoreboard of the packets received by a Selective Repeat receiver,
+        indexed by sequence number.
+    'offer' classifies and stores a packet in a single operation, so the
+        receiving thread takes the lock once per packet.
+    Segments have different lengths (requests, last chunk of a file...),
+        so slots are keyed by seqNum instead of by offset from ackNum, and
+        the capacity is measured in bytes of payload.
+    The free space is advertised to the sender in every ACK (flow control).
+    ACKs are cumulative ('cumulativeAck' is the end of the contiguous
+        received data, even if it wasn't delivered yet) plus SACK blocks
+        with the ranges received beyond it.
+    It isn't thread safe, RDTSocketSR guards it (and ackNum) with
+        'lockInputBuffer'.
+"""
+
+
+class ReceiveWindow:
+    storesPackets = True
+
+    def __init__(self, capacity):
+        self.capacity = capacity                 # Bytes
+        self.packets = {}                        # seqNum -> packet
+        self.bufferedBytes = 0
+        self.cumulativeAck = None
+        self.lastAddedSeqNum = None
+
+    def __len__(self):
+        return len(self.packets)
+
+    def getFreeSpace(self):
+        return max(self.capacity - self.bufferedBytes, 0)
+
+    """
+        'ackNum' is the next expected byte. The expected packet is stored
+            even if the window is full
+    """
+
+    def offer(self, packet, ackNum):
+        seqNum = packet.seqNum
+        if(seqNum != ackNum and ackNum >= seqNum + len(packet.data)):
+            return OLD
+        if(seqNum in self.packets):
+            return DUPLICATE
+        if(seqNum != ackNum and
+                self.bufferedBytes + len(packet.data) > self.capacity):
+            return FULL
+        self.packets[seqNum] = packet
+        self.bufferedBytes += len(packet.data)
+        self.lastAddedSeqNum = seqNum
+        self.advance(ackNum)
+        return ADDED
+
+    # Moves cumulativeAck to the end of the contiguous stored packets
+    def advance(self, ackNum):
+        if(self.cumulativeAck is None or self.cumulativeAck < ackNum):
+            self.cumulativeAck = ackNum
+        packet = self.packets.get(self.cumulativeAck)
+        while(packet is not None and packet.data):
+            self.cumulativeAck += len(packet.data)
+            packet = self.packets.get(self.cumulativeAck)
+
+    def getCumulativeAck(self, ackNum):
+        self.advance(ackNum)
+        return self.cumulativeAck
+
+    """
+        Returns up to 'maxBlocks' [start, end) ranges stored beyond
+            cumulativeAck, the one with the last added packet first (RFC 2018)
+    """
+
+    def getSACKBlocks(self, ackNum, maxBlocks):
+        cumulativeAck = self.getCumulativeAck(ackNum)
+        # Every stored byte is in [ackNum, cumulativeAck), no holes
+        if(self.bufferedBytes <= cumulativeAck - ackNum):
+            return []
+        blocks = []
+        for seqNum in sorted(self.packets):
+            if(seqNum <= cumulativeAck):
+                continue
+            end = seqNum + len(self.packets[seqNum].data)
+            if(blocks and blocks[-1][1] == seqNum):
+                blocks[-1][1] = end
+            else:
+                blocks.append([seqNum, end])
+        for i, block in enumerate(blocks):
+            if(block[0] <= self.lastAddedSeqNum < block[1]):
+                blocks.insert(0, blocks.pop(i))
+                break
+        return blocks[:maxBlocks]
+
+    def get(self, seqNum):
+        return self.packets.get(seqNum)
+
+    def pop(self, seqNum):
+        packet = self.packets.pop(seqNum, None)
+        if(packet is not None):
+            self.bufferedBytes -= len(packet.data)
+        return packet
+
+    # Removes and returns every stored packet, sorted by seqNum
+    def popAll(self):
+        packets = [self.packets[seqNum] for seqNum in sorted(self.packets)]
+        self.packets = {}
+        self.bufferedBytes = 0
+        return packets
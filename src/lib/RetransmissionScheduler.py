@@ -0,0 +1,121 @@
+import heapq
+import itertools
+import logging
+import time
+
+from threading import Condition, Thread
+
+# Cancelled timers are removed lazily, the heap is rebuilt when they are
+# more than half of it
+MIN_TIMERS_TO_COMPACT = 64
+
+
+class ScheduledTimer:
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+"""
+    Runs the retransmission timers of every connection of the process in a
+        single thread, driven by a heap ordered by deadline.
+    * schedule: O(log n)
+    * cancel: O(1), the timer is discarded when it reaches the top of the heap
+    Callbacks run in the scheduler thread, so they must not block.
+"""
+
+
+class RetransmissionScheduler:
+    def __init__(self):
+        self.condition = Condition()
+        self.timers = []                         # Heap of (deadline, id, timer)
+        self.ids = itertools.count()             # Breaks deadline ties
+        self.cancelledTimers = 0
+        self.thread = None
+
+    """
+        Calls 'callback(*args)' after 'delay' seconds, unless the returned
+            timer is cancelled before
+    """
+
+    def schedule(self, delay, callback, args=()):
+        timer = ScheduledTimer(time.monotonic() + delay, callback, args)
+        self.condition.acquire()
+        if(self.thread is None):
+            self.thread = Thread(target=self.run)
+            self.thread.daemon = True  # Closes with the main thread
+            self.thread.start()
+        heapq.heappush(self.timers, (timer.deadline, next(self.ids), timer))
+        # Only wakes the thread if it has to fire earlier than planned
+        if(self.timers[0][2] is timer):
+            self.condition.notify()
+        self.condition.release()
+        return timer
+
+    """
+        Marks the timer as cancelled. It's checked with the condition
+            acquired, so a timer the scheduler thread is popping isn't
+            counted as a cancelled one still in the heap
+    """
+
+    def cancel(self, timer):
+        self.condition.acquire()
+        if(timer.cancelled):
+            self.condition.release()
+            return
+        timer.cancelled = True
+        self.cancelledTimers += 1
+        if(self.cancelledTimers > MIN_TIMERS_TO_COMPACT and
+                self.cancelledTimers * 2 > len(self.timers)):
+            self.timers = [x for x in self.timers if not x[2].cancelled]
+            heapq.heapify(self.timers)
+            self.cancelledTimers = 0
+        self.condition.release()
+
+    def getAmountOfPendingTimers(self):
+        self.condition.acquire()
+        n = len(self.timers) - self.cancelledTimers
+        self.condition.release()
+        return n
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            timer = self.popExpiredTimer()
+            self.condition.release()
+
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logging.exception("Retransmission timer failed")
+
+    """
+        Blocks (with the condition acquired) until there is a timer to fire
+    """
+
+    def popExpiredTimer(self):
+        while True:
+            if(not self.timers):
+                self.condition.wait()
+                continue
+            deadline, _, timer = self.timers[0]
+            if(timer.cancelled):
+                heapq.heappop(self.timers)
+                self.cancelledTimers -= 1
+                continue
+            now = time.monotonic()
+            if(deadline > now):
+                self.condition.wait(deadline - now)
+                continue
+            heapq.heappop(self.timers)
+            # Cancelling it from now on has no effect
+            timer.cancelled = True
+            return timer
+
+
+# Shared by every connection of the process
+retransmissionScheduler = RetransmissionScheduler()
@@ -0,0 +1,417 @@
+import time
+import random
+
+from lib.RDTPacket import RDTPacket, RDT_HEADER_LENGTH, MAX_SACK_BLOCKS
+from lib.SendWindow import SendWindow
+from lib.ReceiveWindow import ReceiveWindow, ADDED, DUPLICATE, OLD
+from lib.RTTEstimator import RTTEstimator, MAX_RTO
+from lib.TokenBucket import TokenBucket
+from lib.CongestionControl import getCongestionControl
+
+
+MSS = 1500
+INPUT_BUFFER_SIZE = 44 * MSS  # Bytes, UDP buffer size = 65535, 44 MSS
+# Max bytes in flight, also bounded by the window advertised by the receiver
+WINDOWSIZE = INPUT_BUFFER_SIZE
+NRETRIES = 18  # see doc
+RESEND_TIME = 0.5  # Initial retransmission timeout, see RTTEstimator
+# A packet is sent and resent NRETRIES times before the connection is lost,
+# the RTO backed off up to MAX_RTO every time: the receiver waits as long
+RECEIVE_TIMEOUT = (NRETRIES + 1) * MAX_RTO
+# An ACK is sent every ACK_EVERY full-sized in order packets, or
+# DELAYED_ACK_TIME after the first one not ACKed (RFC 1122)
+ACK_EVERY = 2
+DELAYED_ACK_TIME = 0.01
+# A packet is resent without waiting for its timer when this many later
+# packets were ACKed (RFC 6675 DupThresh)
+FAST_RETRANSMIT_THRESHOLD = 3
+# With pacing the window is sent at a rate of the window per SRTT (times
+# CongestionControl.getPacingGain), in bursts of up to PACING_BURST bytes
+PACING_BURST = 2 * MSS
+# Rate limit and pacing delays shorter than this aren't slept, the next
+# packets pay them (a sleep costs about as much)
+PACING_SLACK = 0.001
+
+# Why a packet is retransmitted, see 'retransmit'
+TIMEOUT = 0        # Its timer expired
+FAST = 1           # Later packets were ACKed
+NAKED = 2          # The receiver got it corrupted
+
+
+"""
+    State of a Selective Repeat connection and the rules that change it,
+        without I/O: sending and receiving datagrams, timers, waits and
+        locks belong to the transport that calls it (RDTSocketSR with
+        threads, AsyncRDTSocketSR with asyncio), so both of them put the
+        same packets on the wire.
+    * Send half: seqNum, the window of packets sent, the window advertised
+        by the peer, congestion control, RTT estimation, the tries left of
+        every packet resent, rate limits and pacing.
+    * Receive half: ackNum, the scoreboard of packets received, the
+        delayed ACK policy and the ACKs (with SACK blocks) and NAKs to send.
+    The operations return what the transport must do (packets to send,
+        timeouts, packets whose timers must be cancelled).
+    It isn't thread safe, RDTSocketSR guards the send half with
+        'lockOutPutWindow' and the receive half with 'lockInputBuffer'.
+"""
+
+
+class SelectiveRepeat:
+    def __init__(
+            self,
+            checksumEngine,
+            windowSize,
+            inputBufferSize,
+            congestionControl):
+        # Both sides of a connection must use the same engine
+        self.checksumEngine = checksumEngine
+
+        self.seqNum = random.randint(0, 1000)
+        self.ackNum = 0                          # expected next byte
+
+        # Scoreboard where will be store the incoming packets
+        self.inputBuffer = ReceiveWindow(inputBufferSize)
+        # Received packets not ACKed yet
+        self.unACKedPackets = 0
+        self.largestSegmentReceived = 0
+        self.advertisedWindow = inputBufferSize  # In the last ACK sent
+        self.corruptedPackets = 0                # Dropped and NAKed
+
+        self.outPutWindow = SendWindow()         # Window of packets sent
+        self.windowSize = windowSize             # Max bytes in flight
+        # Free space in the peer inputBuffer, updated by every ACK
+        self.peerWindow = windowSize
+        self.maxPeerWindow = windowSize
+        # Congestion window, see CongestionControl
+        self.congestionControl = getCongestionControl(congestionControl, MSS)
+        self.retransmissions = 0
+        self.fastRetransmits = 0
+        self.nakRetransmits = 0
+        # Resends left of the packets already resent by their timer, by
+        # seqNum. Fast and NAK retransmissions keep them
+        self.resendTries = {}
+        self.rttEstimator = RTTEstimator(RESEND_TIME)
+        # TokenBuckets of every byte sent, see setRateLimits
+        self.sharedRateLimit = None
+        self.connectionRate = 0
+        self.connectionBurst = 0
+        self.rateLimits = []
+        # TokenBucket that spreads the window over the RTT, see setPacing
+        self.pacer = None
+        self.throttledTime = 0                   # Seconds slept by send
+
+    # The window advertised by the peer in its SYN or SYNACK
+    def setPeerWindow(self, peerWindow):
+        self.peerWindow = peerWindow
+        self.maxPeerWindow = peerWindow
+
+    ####################
+    #   Receive half   #
+    ####################
+
+    """
+        Classifies a received packet and stores it if it's new and there is
+            space for it, the inmmediate expected packet ignores the space.
+        Returns the tuple (result, cumulative ACK before it) for 'acknowledge',
+            result is ADDED, DUPLICATE, OLD or FULL.
+        A segment ADDED to a PlacementWindow is only claimed: the transport
+            places it and then calls 'placed' or 'abandon'
+    """
+
+    def offer(self, packet):
+        previousCumulativeAck = self.inputBuffer.getCumulativeAck(self.ackNum)
+        return (self.inputBuffer.offer(packet, self.ackNum),
+                previousCumulativeAck)
+
+    # The claimed segment was written, the contiguous data is delivered
+    def placed(self, packet):
+        self.inputBuffer.placed(packet, self.ackNum)
+        self.ackNum = self.inputBuffer.deliver(self.ackNum)
+
+    def abandon(self, packet):
+        self.inputBuffer.abandon(packet)
+
+    """
+        Applies the ACK policy to an offered packet. Returns the tuple (ACK
+            packet to send now or None, True if the delayed ACK must be
+            scheduled).
+        Full-sized packets received in order are ACKed every ACK_EVERY, or
+            by the delayed ACK. Out of order packets, holes being filled,
+            short packets (end of a message), retransmissions and packets
+            that almost close the window are ACKed immediately
+    """
+
+    def acknowledge(self, packet, result, previousCumulativeAck):
+        if(result == ADDED):
+            length = len(packet.data)
+            self.largestSegmentReceived = max(
+                self.largestSegmentReceived, length)
+            self.unACKedPackets += 1
+            inOrder = (packet.seqNum == previousCumulativeAck and
+                       self.inputBuffer.cumulativeAck == packet.seqNum + length)
+            # If the sender can't send ACK_EVERY more packets it would wait
+            # for the delayed ACK
+            windowClosing = self.inputBuffer.getFreeSpace() < ACK_EVERY * MSS
+            if(not inOrder or length < self.largestSegmentReceived or
+                    windowClosing or self.unACKedPackets >= ACK_EVERY):
+                return (self.makeACKPacket(), False)
+            return (None, True)
+        if(result == DUPLICATE or result == OLD):
+            return (self.makeACKPacket(), False)
+        return (None, False)
+
+    """
+        Makes a cumulative ACK with the SACK blocks and the free space of
+            inputBuffer, it ACKs every packet received until now (a
+            delayed ACK pending isn't needed anymore)
+    """
+
+    def makeACKPacket(self):
+        self.unACKedPackets = 0
+        self.advertisedWindow = self.inputBuffer.getFreeSpace()
+        return RDTPacket.makeACKPacket(
+            self.inputBuffer.getCumulativeAck(self.ackNum),
+            self.advertisedWindow,
+            self.inputBuffer.getSACKBlocks(self.ackNum, MAX_SACK_BLOCKS),
+            self.checksumEngine)
+
+    # The ACK of the packets received and not ACKed yet, or None
+    def makeDelayedACKPacket(self):
+        if(self.unACKedPackets > 0):
+            return self.makeACKPacket()
+        return None
+
+    """
+        Counts a corrupted packet and returns the NAK that asks for it
+            again, it also carries the cumulative ACK and the window
+    """
+
+    def makeNAKPacket(self, seqNum):
+        self.corruptedPackets += 1
+        return RDTPacket.makeNAKPacket(
+            seqNum,
+            self.inputBuffer.getCumulativeAck(self.ackNum),
+            self.inputBuffer.getFreeSpace(),
+            self.checksumEngine)
+
+    def getExpectedInput(self):
+        return self.inputBuffer.get(self.ackNum)
+
+    """
+        Removes the expected packet from inputBuffer and moves ackNum to the
+            next one. Returns the tuple (packet or None, ACK to send or
+            None): the sender may be waiting for space, it's told that
+            there is again
+    """
+
+    def popExpectedInput(self):
+        packet = self.inputBuffer.pop(self.ackNum)
+        if(packet is not None):
+            self.ackNum += len(packet.data)
+        reopened = min(ACK_EVERY * MSS, self.inputBuffer.capacity // 2)
+        if(self.advertisedWindow < reopened and
+                self.inputBuffer.getFreeSpace() >= reopened):
+            return (packet, self.makeACKPacket())
+        return (packet, None)
+
+    #################
+    #   Send half   #
+    #################
+
+    """
+        Checks if 'nbytes' more can't be sent without exceeding the window
+            (the minimum between windowSize, the peer advertised window and
+            the congestion window).
+        If nothing is in flight a packet is always allowed by windowSize
+            and the congestion window, and by a peer window of at least half
+            the max advertised one (it will be the next packet to deliver),
+            but not by a closed peer window (the transport probes it after
+            the RTO)
+    """
+
+    def outPutWindowIsFull(self, nbytes=0):
+        bytesInFlight = self.outPutWindow.bytesInFlight
+        if(bytesInFlight + nbytes > self.peerWindow and (
+                bytesInFlight > 0 or self.peerWindow * 2 < self.maxPeerWindow)):
+            return True
+        return bytesInFlight > 0 and bytesInFlight + nbytes > min(
+            self.windowSize, self.congestionControl.getWindow())
+
+    # Bytes to send by RTT with pacing
+    def getPacedWindow(self):
+        return self.congestionControl.getPacingGain() * min(
+            self.windowSize, self.maxPeerWindow,
+            self.congestionControl.getWindow())
+
+    def makeDataPacket(self, bytes, payloadChecksum=None):
+        return RDTPacket(
+            self.seqNum,
+            self.ackNum,
+            None,
+            False,
+            False,
+            False,
+            bytes,
+            self.checksumEngine,
+            payloadChecksum=payloadChecksum)
+
+    """
+        Adds a packet just sent to outPutWindow and moves seqNum after it.
+        Returns the timeout of its resend timer
+    """
+
+    def onSend(self, packet):
+        self.outPutWindow.add(packet, time.monotonic())
+        self.congestionControl.onSend(packet.seqNum, len(packet.data))
+        self.seqNum += len(packet.data)
+        return self.rttEstimator.getRTO()
+
+    """
+        Marks as ACKed every packet before ackNum and inside the SACK blocks,
+            and removes all cumulative ACKed packets.
+        Returns the tuple (seqNums ACKed, whose timers must be cancelled,
+            seqNums to fast retransmit, True if the window may have room now)
+    """
+
+    def onACK(self, ackNum, peerWindow, sackBlocks=()):
+        windowGrew = peerWindow > self.peerWindow
+        self.peerWindow = peerWindow
+        self.maxPeerWindow = max(self.maxPeerWindow, peerWindow)
+        acked = self.outPutWindow.ackCumulative(ackNum)
+        for start, end in sackBlocks:
+            acked += self.outPutWindow.ackRange(start, end)
+        if(not acked):
+            return ([], [], windowGrew)
+        ackedBytes = 0
+        lastSentAt = None
+        for seqNum, length, sentAt in acked:
+            self.resendTries.pop(seqNum, None)
+            ackedBytes += length
+            if(sentAt is not None and
+                    (lastSentAt is None or sentAt > lastSentAt)):
+                lastSentAt = sentAt
+        # One sample per ACK, of the last packet not retransmitted
+        rtt = None
+        if(lastSentAt is not None):
+            rtt = time.monotonic() - lastSentAt
+            self.rttEstimator.addSample(rtt)
+        self.congestionControl.onAck(ackedBytes, rtt)
+        lost = self.outPutWindow.findLost(FAST_RETRANSMIT_THRESHOLD)
+        return ([seqNum for seqNum, _, _ in acked], lost, True)
+
+    """
+        Returns the packet of outPutWindow to resend, and counts its
+            retransmission by 'reason' (TIMEOUT, FAST or NAKED). Returns
+            None if it isn't in the window anymore or it was SACKed.
+        A TIMEOUT spends one of its tries and the congestion window is
+            reduced, a NAKed packet was delivered by the network so it
+            isn't. Retransmissions can't wait for the rate limits, the next
+            packets sent pay them
+    """
+
+    def retransmit(self, seqNum, reason):
+        found = self.outPutWindow.find(seqNum)
+        if(found is None or found[1]):
+            return None
+        packet = found[0]
+        for bucket in self.rateLimits:
+            bucket.take(len(packet.data) + RDT_HEADER_LENGTH)
+        self.outPutWindow.markRetransmitted(seqNum)
+        self.retransmissions += 1
+        if(reason == TIMEOUT):
+            self.resendTries[seqNum] = self.getTriesLeft(seqNum) - 1
+            self.congestionControl.onLoss(seqNum)
+        elif(reason == FAST):
+            self.fastRetransmits += 1
+            self.congestionControl.onFastRetransmit(seqNum)
+        else:
+            self.nakRetransmits += 1
+        return packet
+
+    # Resends left of a packet, NRETRIES until its timer expires
+    def getTriesLeft(self, seqNum):
+        return self.resendTries.get(seqNum, NRETRIES)
+
+    # RTO backed off by the resends of the packet
+    def getResendTimeout(self, seqNum):
+        return self.rttEstimator.getRTO(NRETRIES - self.getTriesLeft(seqNum))
+
+    # A packet ran out of tries, nothing will be ACKed anymore
+    def loseConnection(self):
+        self.outPutWindow.clear()
+        self.resendTries = {}
+
+    """
+        Limits the bytes sent by the connection, retransmissions included:
+            'sharedLimit' is a TokenBucket shared with other connections
+            (the budget of a server) and 'rate' bytes per second, with
+            bursts of 'burst' bytes, is the limit of this connection alone
+            (0 is no limit).
+        The connections of a listening socket get the same limits, each one
+            with a bucket of its own for 'rate'
+    """
+
+    def setRateLimits(self, sharedLimit=None, rate=0, burst=0):
+        self.sharedRateLimit = sharedLimit
+        self.connectionRate = rate
+        self.connectionBurst = burst
+        self.rateLimits = []
+        if(sharedLimit is not None):
+            self.rateLimits.append(sharedLimit)
+        if(rate > 0):
+            self.rateLimits.append(TokenBucket(rate, burst))
+
+    """
+        With pacing the packets of a window are spread over the RTT instead
+            of being sent in a burst as soon as the window opens. Inherited
+            by the connections of a listening socket
+    """
+
+    def setPacing(self, pacing):
+        self.pacer = None
+        if(pacing):
+            self.pacer = TokenBucket(self.windowSize / RESEND_TIME, PACING_BURST)
+
+    def isThrottled(self):
+        return bool(self.rateLimits) or self.pacer is not None
+
+    """
+        Takes a packet of 'nbytes' from the rate limits and the pacer and
+            returns how long the transport must wait before sending it, 0
+            if it's less than PACING_SLACK. The pacing rate is 'pacedWindow'
+            bytes per SRTT (no pacing until there is a sample)
+    """
+
+    def getThrottleDelay(self, nbytes, pacedWindow):
+        delay = 0
+        for bucket in self.rateLimits:
+            delay = max(delay, bucket.take(nbytes))
+        srtt = self.rttEstimator.getSRTT()
+        if(self.pacer is not None and srtt):
+            self.pacer.setRate(pacedWindow / srtt)
+            delay = max(delay, self.pacer.take(nbytes))
+        if(delay <= PACING_SLACK):
+            return 0
+        self.throttledTime += delay
+        return delay
+
+    """
+        Returns a snapshot of the sender state of the connection
+    """
+
+    def getStats(self):
+        stats = {
+            'congestionControl': self.congestionControl.name,
+            'bytesInFlight': self.outPutWindow.bytesInFlight,
+            'peerWindow': self.peerWindow,
+            'windowSize': self.windowSize,
+            'retransmissions': self.retransmissions,
+            'fastRetransmits': self.fastRetransmits,
+            'nakRetransmits': self.nakRetransmits,
+            'corruptedPackets': self.corruptedPackets,
+            'srtt': self.rttEstimator.getSRTT(),
+            'rto': self.rttEstimator.getRTO(),
+            'throttled': self.throttledTime,
+        }
+        stats.update(self.congestionControl.getStats())
+        return stats
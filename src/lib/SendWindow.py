@@ -0,0 +1,123 @@
+"""
+    Window of sent packets of a Selective Repeat sender, indexed by
+        sequence number.
+    Packets are contiguous (the next seqNum is seqNum + len(data)), so
+        the window slides from 'baseSeqNum' without scanning it, and an
+        ACKed range (cumulative ACK or SACK block) is walked packet by
+        packet from its first seqNum.
+    * add, find: O(1)
+    * ackRange: O(packets in the range)
+    * findLost: O(packets before the last lost one), only if there are holes
+    * slide: O(1) amortized, every packet is removed once
+    'bytesInFlight' counts the payload of the packets not ACKed yet, the
+        sender bounds it by the window advertised by the receiver.
+    It isn't thread safe, RDTSocketSR guards it with 'lockOutPutWindow'.
+"""
+
+
+class SendWindow:
+    def __init__(self):
+        # seqNum -> [packet, acked, sentAt (None once retransmitted),
+        #            fast retransmitted]
+        self.packets = {}
+        self.baseSeqNum = None                   # First not ACKed packet
+        self.bytesInFlight = 0
+        self.ackedPackets = 0                    # Beyond a hole (SACKed)
+
+    def __len__(self):
+        return len(self.packets)
+
+    def isEmpty(self):
+        return not self.packets
+
+    def add(self, packet, sentAt=None):
+        if(not self.packets):
+            self.baseSeqNum = packet.seqNum
+        self.packets[packet.seqNum] = [packet, False, sentAt, False]
+        self.bytesInFlight += len(packet.data)
+
+    """
+        Returns the tuple (packet, wasACKed boolean) of that seqNum,
+            or None if it isn't in the window
+    """
+
+    def find(self, seqNum):
+        entry = self.packets.get(seqNum)
+        if(entry is None):
+            return None
+        return (entry[0], entry[1])
+
+    """
+        Marks as ACKed the packets inside [start, end) and slides the window.
+        Returns the list of (seqNum, length, sentAt) of the packets that
+            weren't ACKed before, sentAt is None if the packet was
+            retransmitted (Karn's rule)
+    """
+
+    def ackRange(self, start, end):
+        acked = []
+        entry = self.packets.get(start)
+        while(entry is not None):
+            packet = entry[0]
+            length = len(packet.data)
+            if(packet.seqNum + length > end):
+                break
+            if(not entry[1]):
+                entry[1] = True
+                self.bytesInFlight -= length
+                self.ackedPackets += 1
+                acked.append((packet.seqNum, length, entry[2]))
+            entry = self.packets.get(packet.seqNum + length)
+        if(acked):
+            self.slide()
+        return acked
+
+    # Every byte before 'ackNum' was received
+    def ackCumulative(self, ackNum):
+        if(not self.packets):
+            return []
+        return self.ackRange(self.baseSeqNum, ackNum)
+
+    """
+        Returns the seqNums of the packets not ACKed with at least
+            'threshold' packets ACKed after them (RFC 6675), each packet is
+            returned once so it's fast retransmitted only once
+    """
+
+    def findLost(self, threshold):
+        lost = []
+        ackedAfter = self.ackedPackets
+        entry = self.packets.get(self.baseSeqNum)
+        while(entry is not None and ackedAfter >= threshold):
+            packet = entry[0]
+            if(entry[1]):
+                ackedAfter -= 1
+            elif(not entry[3]):
+                entry[3] = True
+                lost.append(packet.seqNum)
+            entry = self.packets.get(packet.seqNum + len(packet.data))
+        return lost
+
+    # Its ACK won't be used as RTT sample, it would be ambiguous
+    def markRetransmitted(self, seqNum):
+        entry = self.packets.get(seqNum)
+        if(entry is not None):
+            entry[2] = None
+
+    # Removes all cumulative ACKed packets
+    def slide(self):
+        entry = self.packets.get(self.baseSeqNum)
+        while(entry is not None and entry[1]):
+            packet = entry[0]
+            del self.packets[packet.seqNum]
+            self.ackedPackets -= 1
+            self.baseSeqNum = packet.seqNum + len(packet.data)
+            entry = self.packets.get(self.baseSeqNum)
+
+    def isBefore(self, seqNum):
+        return seqNum < self.baseSeqNum
+
+    def clear(self):
+        self.packets = {}
+        self.bytesInFlight = 0
+        self.ackedPackets = 0
@@ -0,0 +1,68 @@
+import time
+
+from threading import Lock
+
+
+"""
+    Token bucket that limits the bytes sent to 'rate' bytes per second,
+        allowing bursts of up to 'burst' bytes after a pause.
+    'take' never blocks: it takes the bytes even if the bucket goes into
+        debt and returns how long the caller must wait before sending them.
+        So senders sharing a bucket are served in the order they took from
+        it, and bytes that can't wait (retransmissions) are still counted.
+    The rate can be changed at any time (see RDTSocketSR pacing).
+    It's thread safe.
+"""
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate                         # Bytes per second
+        self.burst = burst                       # Bytes
+        self.lock = Lock()
+        self.tokens = burst                      # Negative if in debt
+        self.updatedAt = time.monotonic()
+        self.bytesTaken = 0
+        self.delays = 0                          # Takes that had to wait
+
+    # Called with the lock acquired
+    def refill(self, now):
+        self.tokens = min(
+            self.tokens + (now - self.updatedAt) * self.rate, self.burst)
+        self.updatedAt = now
+
+    """
+        Takes 'nbytes' from the bucket and returns the seconds to wait
+            before sending them (0 if they fit in the tokens left)
+    """
+
+    def take(self, nbytes):
+        self.lock.acquire()
+        self.refill(time.monotonic())
+        self.tokens -= nbytes
+        self.bytesTaken += nbytes
+        delay = 0
+        if(self.tokens < 0):
+            delay = -self.tokens / self.rate
+            self.delays += 1
+        self.lock.release()
+        return delay
+
+    def setRate(self, rate, burst=None):
+        self.lock.acquire()
+        self.refill(time.monotonic())
+        self.rate = rate
+        if(burst is not None):
+            self.burst = burst
+        self.lock.release()
+
+    def getStats(self):
+        self.lock.acquire()
+        stats = {
+            'rate': self.rate,
+            'burst': self.burst,
+            'bytesTaken': self.bytesTaken,
+            'delays': self.delays,
+        }
+        self.lock.release()
+        return stats
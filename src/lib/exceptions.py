@@ -4,3 +4,8 @@ class LostConnection(Exception):
 
 class ServerUnreachable(Exception):
     pass
+
+
+# The peer sent an error or an invalid packet in the middle of a transfer
+class TransferError(Exception):
+    pass
@@ -1,18 +1,40 @@
 import argparse
+import errno
 import logging
 import sys
 import os
+import shutil
 from pathlib import Path
 import time
+import asyncio
+import signal
+import socket
+import uuid
 
 from FileTransfer import FileTransfer, Packet
-from threading import Thread, Lock
-from lib.RDTSocketSR import RDTSocketSR
-from lib.RDTSocketSW import RDTSocketSW
-from lib.exceptions import LostConnection
+from threading import Thread
+from queue import Queue
+from multiprocessing import Manager, Process
+from lib.RDTSocketSR import RDTSocketSR, WINDOWSIZE, RECEIVE_TIMEOUT
+from lib.RDTSocketSW import RDTSocketSW, RECEIVE_TIMEOUT as SW_RECEIVE_TIMEOUT
+from lib.AsyncRDTSocketSR import AsyncRDTSocketSR
+from lib.ChunkCache import ChunkCache
+from lib.FileRegistry import FileRegistry
+from lib.AdmissionQueue import AdmissionQueue, ADMITTED, QUEUE_FULL
+from lib.TokenBucket import TokenBucket
+from lib.ChecksumEngine import CHECKSUM_ENGINES, DEFAULT_CHECKSUM, getChecksumEngine
+from lib.CongestionControl import CONGESTION_CONTROLS, DEFAULT_CONGESTION_CONTROL
+from lib.exceptions import LostConnection, TransferError
 
 RDT_SR = 1
 RDT_SW = 2
+# Connections handshaked and not accepted yet, further SYNs are ignored
+BACKLOG = 128
+# Accepted connections waiting for a thread of the pool, further ones are
+# answered OVERLOADED
+ADMISSION_QUEUE = 64
+# Threads that close the rejected connections, see reject_connections
+REJECT_CLOSERS = 4
 
 
 def getArgs():
@@ -82,19 +104,208 @@ def getArgs():
         metavar='',
         help='use Stop and Wait as RDT protocol')
 
-    return parser.parse_args()
+    optionals.add_argument(
+        '-c',
+        '--checksum',
+        type=str,
+        choices=list(CHECKSUM_ENGINES),
+        default=DEFAULT_CHECKSUM,
+        metavar='',
+        help='checksum engine ({}), must match the clients one'.format(
+            ', '.join(CHECKSUM_ENGINES)))
+    optionals.add_argument(
+        '-w',
+        '--window',
+        type=int,
+        default=WINDOWSIZE,
+        metavar='',
+        help='max bytes in flight and receive buffer size of Selective Repeat (default {})'.format(
+            WINDOWSIZE))
+    optionals.add_argument(
+        '-cc',
+        '--congestion-control',
+        type=str,
+        choices=list(CONGESTION_CONTROLS),
+        default=DEFAULT_CONGESTION_CONTROL,
+        dest='congestionControl',
+        metavar='',
+        help='congestion control of Selective Repeat ({})'.format(
+            ', '.join(CONGESTION_CONTROLS)))
+    optionals.add_argument(
+        '-b',
+        '--backlog',
+        type=int,
+        default=BACKLOG,
+        metavar='',
+        help='max connections waiting to be accepted (default {})'.format(
+            BACKLOG))
+    optionals.add_argument(
+        '-m',
+        '--multiplex',
+        action='store_true',
+        help='serve every client from the listening socket (one event loop instead of a socket and a thread per client)')
+    optionals.add_argument(
+        '-a',
+        '--asyncio',
+        action='store_true',
+        help='serve every client from a single asyncio event loop (Selective Repeat only)')
+    optionals.add_argument(
+        '-W',
+        '--workers',
+        type=int,
+        default=1,
+        metavar='',
+        help='server processes sharing the port with SO_REUSEPORT (default 1)')
+    optionals.add_argument(
+        '-D',
+        '--direct-placement',
+        action='store_true',
+        dest='directPlacement',
+        help='write every packet of an upload at its offset of the file as soon as it arrives, without buffering the out of order ones (Selective Repeat only)')
+    optionals.add_argument(
+        '-P',
+        '--pool-size',
+        type=int,
+        default=0,
+        dest='poolSize',
+        metavar='',
+        help='threads serving the clients (default 0, a thread by client)')
+    optionals.add_argument(
+        '-aq',
+        '--admission-queue',
+        type=int,
+        default=ADMISSION_QUEUE,
+        dest='admissionQueue',
+        metavar='',
+        help='clients waiting for a thread of the pool, further ones are answered overloaded (default {})'.format(
+            ADMISSION_QUEUE))
+    optionals.add_argument(
+        '-pc',
+        '--per-client',
+        type=int,
+        default=0,
+        dest='perClient',
+        metavar='',
+        help='connections of a client (IP) waiting or served by the pool (default 0, no limit)')
+    optionals.add_argument(
+        '-Q',
+        '--queue-timeout',
+        type=float,
+        default=0,
+        dest='queueTimeout',
+        metavar='',
+        help='seconds an upload waits for the transfers of the same file to finish, instead of being answered busy (default 0, threaded server only)')
+    optionals.add_argument(
+        '-C',
+        '--cache-size',
+        type=int,
+        default=0,
+        dest='cacheSize',
+        metavar='',
+        help='bytes of the files served kept in memory for the next downloads, by server process (default 0, no cache)')
+    optionals.add_argument(
+        '-hf',
+        '--hot-files',
+        type=str,
+        dest='hotFiles',
+        metavar='',
+        help='file with the names of the files loaded in the cache at startup, one by line')
+    optionals.add_argument(
+        '-r',
+        '--rate',
+        type=int,
+        default=0,
+        metavar='',
+        help='bytes per second sent by the server, shared by every client (default 0, no limit)')
+    optionals.add_argument(
+        '-rb',
+        '--rate-burst',
+        type=int,
+        dest='rateBurst',
+        metavar='',
+        help='bytes the server can send at once after a pause (default the window)')
+    optionals.add_argument(
+        '-cr',
+        '--client-rate',
+        type=int,
+        default=0,
+        dest='clientRate',
+        metavar='',
+        help='bytes per second sent to each client (default 0, no limit)')
+    optionals.add_argument(
+        '-cb',
+        '--client-burst',
+        type=int,
+        dest='clientBurst',
+        metavar='',
+        help='bytes sent at once to a client after a pause (default the window)')
+    optionals.add_argument(
+        '-pace',
+        '--pacing',
+        action='store_true',
+        help='spread the packets of every window over the RTT instead of sending them in a burst (Selective Repeat only)')
+
+    args = parser.parse_args()
+    if args.asyncio and args.rdtType == RDT_SW:
+        parser.error('--asyncio only supports Selective Repeat')
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--workers needs SO_REUSEPORT, not supported by this platform')
+    if args.poolSize < 0 or args.perClient < 0:
+        parser.error('--pool-size and --per-client must be positive')
+    # 0 would reject every client, even with idle threads
+    if args.admissionQueue < 1:
+        parser.error('--admission-queue must be at least 1')
+    if args.poolSize > 0 and args.asyncio:
+        parser.error('--pool-size: the asyncio server has no threads by client')
+    receiveTimeout = SW_RECEIVE_TIMEOUT if args.rdtType == RDT_SW else RECEIVE_TIMEOUT
+    if not 0 <= args.queueTimeout < receiveTimeout:
+        parser.error('--queue-timeout must be between 0 and {} seconds'.format(
+            receiveTimeout))
+    if args.queueTimeout > 0 and args.asyncio:
+        parser.error('--queue-timeout would block the asyncio loop')
+    if args.cacheSize < 0:
+        parser.error('--cache-size must be positive')
+    if args.hotFiles and args.cacheSize == 0:
+        parser.error('--hot-files requires --cache-size')
+    # With --multiplex the packets are placed by the demultiplexer thread,
+    # a write would stop every connection
+    if args.directPlacement and (
+            args.asyncio or args.multiplex or args.rdtType == RDT_SW):
+        parser.error(
+            '--direct-placement only supports the threaded Selective Repeat server without --multiplex')
+    if args.rateBurst is None:
+        args.rateBurst = args.window
+    if args.clientBurst is None:
+        args.clientBurst = args.window
+    if min(args.rate, args.rateBurst, args.clientRate, args.clientBurst) < 0:
+        parser.error('--rate, --client-rate and their bursts must be positive')
+    if args.pacing and args.rdtType == RDT_SW:
+        parser.error('--pacing only supports Selective Repeat')
+    return args
 
 
 args = getArgs()
 
 connections = []
-openFiles = []
-lockOpenFiles = Lock()
+# Downloads of a file run together, an upload takes it alone
+openFiles = FileRegistry()
+# Created by run_server if there is a cache, every process has its own
+chunkCache = None
+# Connections waiting for a thread of the pool, created by start_pool
+admission = None
+# Connections answered OVERLOADED by reject_connections
+rejections = Queue()
+# Rejected connections already answered, closed by close_rejected
+rejectedToClose = Queue()
+# Budget of every client of the process, created by set_rate_limits
+rateLimit = None
 
 
 def start_server(serverSocket):
-    serverSocket.bind((args.host, args.port))
-    serverSocket.listen(1)
+    serverSocket.bind((args.host, args.port), args.workers > 1)
+    serverSocket.listen(args.backlog, args.multiplex)
     try:
         os.makedirs(args.storage)
     except FileExistsError:
@@ -102,124 +313,468 @@ def start_server(serverSocket):
     except BaseException:
         raise
 
+    if args.poolSize > 0:
+        start_pool()
     while True:
         connSocket, addr = serverSocket.accept()
+        logging.info("New connection with {}:{}".format(*addr))
+        if args.poolSize > 0:
+            admit(connSocket, addr)
+            continue
         connThread = Thread(
             target=client_handle, args=(
                 connSocket, addr))
         connThread.daemon = True
-        logging.info("New connection with {}:{}".format(*addr))
         connThread.start()
     return
 
 
-def client_handle(connSocket, addr):
+# Starts the threads of the pool and the ones that answer and close the
+# rejected connections, so the accept loop never waits for a client
+def start_pool():
+    global admission
+    admission = AdmissionQueue(args.admissionQueue, args.perClient)
+    for i in range(args.poolSize):
+        poolThread = Thread(target=pool_worker, name='pool-{}'.format(i))
+        poolThread.daemon = True
+        poolThread.start()
+    rejectThread = Thread(target=reject_connections, name='reject')
+    rejectThread.daemon = True
+    rejectThread.start()
+    for i in range(REJECT_CLOSERS):
+        closeThread = Thread(target=close_rejected, name='close-{}'.format(i))
+        closeThread.daemon = True
+        closeThread.start()
 
-    bytes = connSocket.recv()
 
-    if (bytes == b''):
-        logging.info("Client({}:{}) shut down the connection".format(*addr))
-        connSocket.closeReceiver()
+def admit(connSocket, addr):
+    result = admission.admit((connSocket, addr), addr[0])
+    if result == ADMITTED:
+        logging.debug("Client({}:{}) queued, admission queue depth {}".format(
+            addr[0], addr[1], admission.getDepth()))
         return
+    logging.info("Client({}:{}) rejected, {}".format(
+        addr[0], addr[1],
+        'every thread of the pool is busy' if result == QUEUE_FULL
+        else 'too many connections of the client'))
+    rejections.put(connSocket)
+
+
+def pool_worker():
+    while True:
+        (connSocket, addr), clientIP, wait = admission.get()
+        logging.debug(
+            "Client({}:{}) waited {:.0f}ms for a thread, admission queue: {}".format(
+                addr[0], addr[1], wait * 1000, admission.getStats()))
+        try:
+            client_handle(connSocket, addr)
+        except Exception:
+            logging.exception("Client({}:{}) handler failed".format(*addr))
+        finally:
+            admission.done(clientIP)
+
+
+# Answers OVERLOADED in order of rejection. Closing a socket waits up to a
+# second for its receiving thread, so it's left to the REJECT_CLOSERS
+# threads of close_rejected or a burst of rejections would make the last
+# clients time out
+def reject_connections():
+    while True:
+        connSocket = rejections.get()
+        try:
+            FileTransfer.request(connSocket, FileTransfer.OVERLOADED, '')
+        except LostConnection:
+            pass
+        rejectedToClose.put(connSocket)
+
+
+def close_rejected():
+    while True:
+        rejectedToClose.get().closeReceiver()
+
+
+# Checks that the storage can hold a file of 'fileSize' bytes at 'filePath',
+# counting the space of the file it would replace
+def has_space_for(filePath, fileSize):
+    free = shutil.disk_usage(os.path.dirname(filePath)).free
+    if os.path.isfile(filePath):
+        free += os.path.getsize(filePath)
+    return free >= fileSize
+
+
+# Opens the file of an upload. If the client declared its size, the whole
+# file is reserved with posix_fallocate (in a few extents, instead of
+# growing it packet by packet) and None is returned when the storage can't
+# hold it, before anything is transferred
+def open_upload(filePath, fileSize):
+    if fileSize is None:
+        return open(filePath, 'wb')
+    if not has_space_for(filePath, fileSize):
+        return None
+    if fileSize == 0 or not hasattr(os, 'posix_fallocate'):
+        return open(filePath, 'wb')
+    # Preallocated aside, the file it replaces is kept if there is no space
+    tempPath = '{}.{}.upload'.format(filePath, uuid.uuid4().hex)
+    file = open(tempPath, 'xb')
+    try:
+        os.posix_fallocate(file.fileno(), 0, fileSize)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            file.close()
+            os.remove(tempPath)
+            return None
+        # Not supported by the filesystem
+        logging.debug("Cannot preallocate \"{}\"".format(filePath),
+                      exc_info=True)
+    os.replace(tempPath, filePath)
+    return file
+
 
+# A request of a client: what it asked for and, if it was answered OK,
+# the file opened for it (see open_request and close_request)
+class ClientRequest:
+    def __init__(self, addr, type, fileName, fileSize):
+        self.addr = addr
+        self.type = type
+        self.fileName = fileName
+        self.fileSize = fileSize                 # None if not declared
+        self.filePath = args.storage + '/' + fileName
+        self.response = FileTransfer.OK
+        self.file = None
+        self.startTime = None
+
+
+# Parses the request of a client, takes its file in openFiles and opens it.
+# Returns the ClientRequest, its response is the code to answer the client.
+# If it isn't OK the file was already released. An upload waits up to
+# 'queueTimeout' seconds for the file
+def open_request(addr, bytes, queueTimeout):
     packet = Packet.fromSerializedPacket(bytes)
-    file_name = packet.data.decode()
+    request = ClientRequest(addr, *FileTransfer.parse_request(packet))
     logging.info(
         "Client({}:{}) want to {} a file named \"{}\"".format(
             addr[0],
             addr[1],
-            'download' if packet.type == 0 else 'upload',
-            file_name))
+            'download' if request.type == 0 else 'upload',
+            request.fileName))
 
-    lockOpenFiles.acquire()
-    if file_name in openFiles:
+    if request.type == FileTransfer.RECEIVE:
+        acquired = openFiles.acquireRead(request.fileName)
+    else:
+        acquired = openFiles.acquireWrite(request.fileName, queueTimeout)
+    if not acquired:
         logging.info(
             "Client({}:{}) want to use a busy file, sending error".format(
                 *addr))
-        FileTransfer.request(connSocket, FileTransfer.BUSY_FILE, file_name)
-        lockOpenFiles.release()
-        connSocket.closeReceiver()
-        return
+        request.response = FileTransfer.BUSY_FILE
+        return request
     try:
-        path = Path(args.storage + '/' + file_name)
+        path = Path(request.filePath)
         path.parent.mkdir(exist_ok=True, parents=True)
-        file = open(args.storage + '/' + file_name,
-                    'rb' if packet.type == FileTransfer.RECEIVE else 'wb')
-
+        if request.type == FileTransfer.RECEIVE:
+            request.file = open(request.filePath, 'rb')
+        else:
+            request.file = open_upload(request.filePath, request.fileSize)
+        if request.file is None:
+            logging.info(
+                "Client({}:{}) upload of {} bytes doesn't fit in the storage, sending error".format(
+                    addr[0], addr[1], request.fileSize))
+            request.response = FileTransfer.NO_SPACE
     except BaseException:
         logging.debug("Client({}:{}) Cannot open the file \"{}\"".format(
-            addr[0], addr[1], args.storage + '/' + file_name))
-        FileTransfer.request(connSocket, FileTransfer.ERROR, file_name)
-        lockOpenFiles.release()
-        connSocket.closeReceiver()
-        return
+            addr[0], addr[1], request.filePath))
+        request.response = FileTransfer.ERROR
+    if request.response != FileTransfer.OK:
+        openFiles.release(request.fileName)
+        return request
 
-    openFiles.append(file_name)
     logging.info("Client({}:{}) beginning transaction".format(*addr))
-    FileTransfer.request(connSocket, FileTransfer.OK, file_name)
-    lockOpenFiles.release()
+    request.startTime = time.time()
+    return request
 
-    if packet.type == FileTransfer.RECEIVE:
-        # If the client want to receive a file, then the server send packets
-        connections.append((connSocket, FileTransfer.SEND))
-        try:
-            FileTransfer.send_file(connSocket, file)
+
+# Closes the file of a request answered OK and releases it in openFiles.
+# The chunks cached of an uploaded file are dropped, it changed
+def close_request(request):
+    if request is None or request.response != FileTransfer.OK:
+        return
+    if request.type == FileTransfer.SEND and chunkCache is not None:
+        chunkCache.invalidate(request.filePath)
+    request.file.close()
+    openFiles.release(request.fileName)
+
+
+def finish_download(request):
+    logging.info("Client({}:{}) download completed".format(*request.addr))
+    if chunkCache is not None:
+        logging.debug("Chunk cache: {}".format(chunkCache.getStats()))
+
+
+# Logs the result of an upload that finished without losing the connection.
+# If the client declared the size and sent a different amount, the file is
+# removed (and was preallocated with the declared size). Returns True if
+# it's complete
+def finish_upload(request, received):
+    addr = request.addr
+    elapsedTime = time.time() - request.startTime
+    if request.fileSize is not None and received != request.fileSize:
+        logging.info(
+            "Client({}:{}) sent {} of {} bytes ({:.0f}%), removing incompleted file".format(
+                addr[0], addr[1], received, request.fileSize,
+                100 * received / request.fileSize if request.fileSize else 100))
+        os.remove(request.filePath)
+        return False
+    logging.info(
+        "Client({}:{}) upload completed, {} bytes in {:.0f}ms ({:.0f} KB/s)".format(
+            addr[0], addr[1], received, elapsedTime * 1000,
+            received / 1000 / max(elapsedTime, 1e-3)))
+    return True
+
+
+# Logs a transfer that failed, 'request' is None if the request wasn't
+# received. An upload answered OK is removed, it's incomplete
+def transfer_failed(addr, request, error):
+    upload = (request is not None and request.response == FileTransfer.OK
+              and request.type == FileTransfer.SEND)
+    if isinstance(error, LostConnection):
+        logging.info("Client({}:{}) Lost connection{}".format(
+            addr[0], addr[1], ', removing incompleted file' if upload else ''))
+    else:  # Error sent by the client, invalid packet placed, I/O error
+        logging.exception("Client({}:{}) transfer failed{}".format(
+            addr[0], addr[1], ', removing incompleted file' if upload else ''))
+    if upload:
+        os.remove(request.filePath)
+
+
+def client_handle(connSocket, addr):
+    request = None
+    try:
+        bytes = connSocket.recv()
+
+        if (bytes == b''):
+            logging.info(
+                "Client({}:{}) shut down the connection".format(*addr))
+            connSocket.closeReceiver()
+            return
+
+        request = open_request(addr, bytes, args.queueTimeout)
+        FileTransfer.request(connSocket, request.response, request.fileName)
+        if request.response != FileTransfer.OK:
+            connSocket.closeReceiver()
+            return
+
+        if request.type == FileTransfer.RECEIVE:
+            # If the client want to receive a file, then the server send packets
+            connections.append((connSocket, FileTransfer.SEND))
+            FileTransfer.send_file(connSocket, request.file, chunkCache)
             connSocket.closeSender()
-            logging.info("Client({}:{}) download completed".format(*addr))
-        except LostConnection:
-            logging.info("Client({}:{}) Lost connection".format(*addr))
+            finish_download(request)
+
+        elif request.type == FileTransfer.SEND:
+            # If the client want to send a file, then the server receive packets
+            connections.append((connSocket, FileTransfer.RECEIVE))
+            if args.directPlacement:
+                received = FileTransfer.recv_file_direct(
+                    connSocket, request.file)
+            else:
+                received = FileTransfer.recv_file(connSocket, request.file)
+            finish_upload(request, received)
             connSocket.closeReceiver()
 
-    elif packet.type == FileTransfer.SEND:
-        # If the client want to send a file, then the server receive packets
-        connections.append((connSocket, FileTransfer.RECEIVE))
-        try:
-            FileTransfer.recv_file(connSocket, file)
-            logging.info("Client({}:{}) upload completed".format(*addr))
-        except LostConnection:
+        else:
             logging.info(
-                "Client({}:{}) Lost connection, removing incompleted file")
-            os.remove(args.storage + '/' + file_name)
+                "Client({}:{}) sent an invalid operation".format(*addr))
+            connSocket.closeReceiver()
+    except (LostConnection, TransferError, OSError) as e:
+        transfer_failed(addr, request, e)
         connSocket.closeReceiver()
+    finally:
+        close_request(request)
+    return
 
-    else:
-        logging.info("Client({}:{}) sent an invalid operation")
-        file.close()
-        connSocket.closeReceiver()
+
+async def start_server_async(serverSocket):
+    await serverSocket.bind((args.host, args.port), args.workers > 1)
+    serverSocket.listen(args.backlog)
+    try:
+        os.makedirs(args.storage)
+    except FileExistsError:
+        pass
+
+    handlers = set()  # Keeps a reference to the running tasks
+    while True:
+        connSocket, addr = await serverSocket.accept()
+        logging.info("New connection with {}:{}".format(*addr))
+        handler = asyncio.ensure_future(client_handle_async(connSocket, addr))
+        handlers.add(handler)
+        handler.add_done_callback(handlers.discard)
+
+
+# Same as client_handle, but the transfer is a coroutine of the event loop.
+# The files are read and written in the loop too, they are local and small
+# chunks. The uploads don't wait for the file, it would block the loop
+async def client_handle_async(connSocket, addr):
+    request = None
+    try:
+        bytes = await connSocket.recv()
+
+        if (bytes == b''):
+            logging.info(
+                "Client({}:{}) shut down the connection".format(*addr))
+            await connSocket.closeReceiver()
+            return
+
+        request = open_request(addr, bytes, 0)
+        await FileTransfer.request_async(
+            connSocket, request.response, request.fileName)
+        if request.response != FileTransfer.OK:
+            await connSocket.closeReceiver()
+            return
+
+        if request.type == FileTransfer.RECEIVE:
+            await FileTransfer.send_file_async(
+                connSocket, request.file, chunkCache)
+            await connSocket.closeSender()
+            finish_download(request)
+
+        elif request.type == FileTransfer.SEND:
+            received = await FileTransfer.recv_file_async(
+                connSocket, request.file)
+            finish_upload(request, received)
+            await connSocket.closeReceiver()
+
+        else:
+            logging.info(
+                "Client({}:{}) sent an invalid operation".format(*addr))
+            await connSocket.closeReceiver()
+    except (LostConnection, TransferError, OSError) as e:
+        transfer_failed(addr, request, e)
+        await connSocket.closeReceiver()
+    finally:
+        close_request(request)
+
+
+# Creates the chunk cache of this process and loads the hot files in it
+def start_cache():
+    global chunkCache
+    chunkCache = ChunkCache(args.cacheSize)
+    if not args.hotFiles:
         return
+    try:
+        with open(args.hotFiles) as hotFiles:
+            names = [line.strip() for line in hotFiles if line.strip()]
+    except OSError:
+        logging.info("Cannot open the hot files list \"{}\"".format(
+            args.hotFiles))
+        return
+    checksumEngine = getChecksumEngine(args.checksum)
+    for name in names:
+        try:
+            with open(args.storage + '/' + name, 'rb') as file:
+                for _ in FileTransfer.read_checksummed_packets(
+                        file, chunkCache, checksumEngine):
+                    pass
+        except OSError:
+            logging.info("Cannot load \"{}\" in the cache".format(name))
+    stats = chunkCache.getStats()
+    logging.info("Chunk cache: {} bytes of {} hot files loaded, {} evicted chunks".format(
+        stats['size'], len(names), stats['evictions']))
+    chunkCache.resetStats()
 
-    file.close()
-    lockOpenFiles.acquire()
-    openFiles.remove(file_name)
-    lockOpenFiles.release()
-    return
+
+# The connections of 'serverSocket' inherit its limits. The budget of the
+# server is split between the workers: a bucket shared by the processes would
+# take a round trip to the Manager by packet
+def set_rate_limits(serverSocket):
+    global rateLimit
+    if args.rate > 0:
+        rateLimit = TokenBucket(
+            args.rate / args.workers, args.rateBurst / args.workers)
+    serverSocket.setRateLimits(rateLimit, args.clientRate, args.clientBurst)
+    if args.pacing:
+        serverSocket.setPacing(True)
+
+
+def run_server():
+    serverSocket = None
+    try:
+        if args.cacheSize > 0:
+            start_cache()
+        if args.asyncio:
+            serverSocket = AsyncRDTSocketSR(
+                args.checksum, args.window, args.window, args.congestionControl)
+        elif args.rdtType == RDT_SR:
+            serverSocket = RDTSocketSR(
+                args.checksum, args.window, args.window, args.congestionControl)
+        else:
+            serverSocket = RDTSocketSW(args.checksum)
+        set_rate_limits(serverSocket)
+        logging.info("Server: Welcome!!!")
+        if args.asyncio:
+            asyncio.run(start_server_async(serverSocket))
+        else:
+            start_server(serverSocket)
+    except BaseException:  # KeyboardInterrupt, SystemExit...
+        print("")
+        if chunkCache is not None:
+            logging.info("Chunk cache: {}".format(chunkCache.getStats()))
+        if admission is not None:
+            logging.info("Admission queue: {}".format(admission.getStats()))
+        if rateLimit is not None:
+            logging.info("Rate limit: {}".format(rateLimit.getStats()))
+        logging.info("Server: Goodbye!!!")
+        for conn, type in connections:
+            try:
+                if type == FileTransfer.SEND:
+                    conn.closeReceiver()
+                else:
+                    conn.closeReceiver()
+            except BaseException:  # KeyboardInterrupt, SystemExit...
+                print("")
+                exit()
+        serverSocket.closeServer()
+
+
+def stop_worker(signum, frame):
+    raise SystemExit
+
+
+# Ctrl+C reaches every process of the terminal, only the parent handles it
+# and stops the workers with SIGTERM. The busy files table comes as
+# arguments: with the spawn and forkserver start methods the worker imports
+# this script again instead of inheriting the globals of the parent
+def run_worker(files, waitingWriters, released):
+    global openFiles
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop_worker)
+    openFiles = FileRegistry(files, waitingWriters, released)
+    run_server()
 
 
 logging.basicConfig(level=args.verboseLevel, filename="server.log",
-                    format='%(asctime)s [%(levelname)s]: %(message)s',
+                    format='%(asctime)s [%(levelname)s]{}: %(message)s'.format(
+                        ' %(processName)s' if args.workers > 1 else ''),
                     datefmt='%Y/%m/%d %I:%M:%S %p')
 
-serverSocket = None
-try:
-    if args.rdtType == RDT_SR:
-        serverSocket = RDTSocketSR()
+if __name__ == '__main__':
+    if args.workers == 1:
+        run_server()
     else:
-        serverSocket = RDTSocketSW()
-    logging.info("Server: Welcome!!!")
-    start_server(serverSocket)
-except BaseException:  # KeyboardInterrupt, SystemExit...
-    print("")
-    logging.info("Server: Goodbye!!!")
-    for conn, type in connections:
+        # The busy files table is served by the manager process, every
+        # worker locks it and reads it through IPC
+        manager = Manager()
+        sharedFiles = (manager.dict(), manager.dict(), manager.Condition())
+        workers = [Process(target=run_worker, args=sharedFiles,
+                           name='worker-{}'.format(i))
+                   for i in range(args.workers)]
+        for worker in workers:
+            worker.start()
         try:
-            if type == FileTransfer.SEND:
-                conn.closeReceiver()
-            else:
-                conn.closeReceiver()
-        except BaseException:  # KeyboardInterrupt, SystemExit...
-            print("")
-            exit()
-    serverSocket.closeServer()
-except BaseException:
-    serverSocket.closeServer()
-    exit()
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()  # SIGTERM
+            for worker in workers:
+                worker.join()
+        manager.shutdown()
@@ -2,13 +2,16 @@ import argparse
 import logging
 import time
 import sys
+import os
 
 from socket import socket, AF_INET, SOCK_STREAM
 
 from FileTransfer import FileTransfer, Packet
 from lib.exceptions import ServerUnreachable, LostConnection
-from lib.RDTSocketSR import RDTSocketSR
+from lib.RDTSocketSR import RDTSocketSR, WINDOWSIZE
 from lib.RDTSocketSW import RDTSocketSW
+from lib.ChecksumEngine import CHECKSUM_ENGINES, DEFAULT_CHECKSUM
+from lib.CongestionControl import CONGESTION_CONTROLS, DEFAULT_CONGESTION_CONTROL
 
 RDT_SR = 1
 RDT_SW = 2
@@ -88,6 +91,34 @@ def getArgs():
         metavar='',
         help='use Stop and Wait as RDT protocol')
 
+    optionals.add_argument(
+        '-c',
+        '--checksum',
+        type=str,
+        choices=list(CHECKSUM_ENGINES),
+        default=DEFAULT_CHECKSUM,
+        metavar='',
+        help='checksum engine ({}), must match the server one'.format(
+            ', '.join(CHECKSUM_ENGINES)))
+    optionals.add_argument(
+        '-w',
+        '--window',
+        type=int,
+        default=WINDOWSIZE,
+        metavar='',
+        help='max bytes in flight and receive buffer size of Selective Repeat (default {})'.format(
+            WINDOWSIZE))
+    optionals.add_argument(
+        '-cc',
+        '--congestion-control',
+        type=str,
+        choices=list(CONGESTION_CONTROLS),
+        default=DEFAULT_CONGESTION_CONTROL,
+        dest='congestionControl',
+        metavar='',
+        help='congestion control of Selective Repeat ({})'.format(
+            ', '.join(CONGESTION_CONTROLS)))
+
     return parser.parse_args()
 
 
@@ -103,14 +134,16 @@ except BaseException:
     exit(-1)
 try:
     if args.rdtType == RDT_SR:
-        client_socket = RDTSocketSR()
+        client_socket = RDTSocketSR(
+            args.checksum, args.window, args.window, args.congestionControl)
     else:
-        client_socket = RDTSocketSW()
+        client_socket = RDTSocketSW(args.checksum)
 
     client_socket.connect((args.host, args.port))
 
-    # we want to upload a file
-    FileTransfer.request(client_socket, FileTransfer.SEND, args.name)
+    # we want to upload a file, the server reserves its size
+    fileSize = os.fstat(f.fileno()).st_size
+    FileTransfer.request_upload(client_socket, args.name, fileSize)
 
     # server responses if the query was accepted
     responsePacket = Packet.fromSerializedPacket(client_socket.recv())
@@ -123,7 +156,8 @@ try:
 
         elapsedTime = (finishTime - startTime) / 1000000  # Convert ns to ms
         logging.debug(
-            "Finished uploading the file in {:.0f}ms".format(elapsedTime))
+            "Finished uploading the file ({} bytes) in {:.0f}ms ({:.0f} KB/s)".format(
+                fileSize, elapsedTime, fileSize / max(elapsedTime, 1)))
 
     if responsePacket.type == FileTransfer.BUSY_FILE:
         logging.info("The file you are trying to access is currently busy")
@@ -135,6 +169,16 @@ try:
         client_socket.closeReceiver()
         f.close()
         exit()
+    if responsePacket.type == FileTransfer.OVERLOADED:
+        logging.info("The server is overloaded, try again later")
+        client_socket.closeReceiver()
+        f.close()
+        exit()
+    if responsePacket.type == FileTransfer.NO_SPACE:
+        logging.info("The server doesn't have space for the file")
+        client_socket.closeReceiver()
+        f.close()
+        exit()
 
 except ServerUnreachable:
     logging.info("Server unreachable...")